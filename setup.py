@@ -45,6 +45,9 @@ setup(
             'rwproperty',
             'zope.container',
         ),
+        numpy=(
+            'numpy',
+        ),
     ),
     install_requires=[
         'persistent',
@@ -66,5 +69,7 @@ setup(
     [console_scripts]
     profile = pjpersist.tests.performance:main
     json_speed_test = pjpersist.tests.json_speed_test:main
+    serialize_speed_test = pjpersist.tests.serialize_speed_test:main
+    dbref_speed_test = pjpersist.tests.dbref_speed_test:main
     ''',
 )
@@ -15,6 +15,8 @@
 """PostGreSQL/JSONB Persistent Data Manager"""
 from __future__ import absolute_import
 
+import hashlib
+import json
 import logging
 import psycopg2
 import psycopg2.extensions
@@ -29,8 +31,9 @@ import zope.interface
 from persistent.interfaces import GHOST
 from persistent.mapping import PersistentMapping
 
-from pjpersist import interfaces, serialize
-from pjpersist.querystats import QueryReport
+from pjpersist import interfaces, jsoncodec, serialize
+from pjpersist.querystats import QueryReport, AggregatedQueryReport
+from pjpersist.querystats import TransactionTimings
 
 
 PJ_ACCESS_LOGGING = False
@@ -47,6 +50,33 @@ PJ_ENABLE_GLOBAL_QUERY_STATS = False
 GLOBAL_QUERY_STATS = threading.local()
 GLOBAL_QUERY_STATS.report = None
 
+# Aggregate query statistics per statement fingerprint instead of keeping
+# every executed query. Memory usage is bounded, so this is safe to use with
+# PJ_ENABLE_GLOBAL_QUERY_STATS in production.
+PJ_AGGREGATE_QUERY_STATS = False
+
+# Collect time spent per transaction phase (serialize, deserialize, sql,
+# flush, commit, vote), see PJDataManager.last_timings. This is cheap.
+PJ_COLLECT_TIMINGS = True
+
+# Run EXPLAIN (FORMAT JSON) on queries slower than this many seconds. The
+# plan is logged to TABLE_LOG and attached to the query statistics.
+# None disables the feature.
+PJ_EXPLAIN_SLOW_QUERY_TIME = None
+
+# Statements that can be explained
+EXPLAINABLE_QUERY_TYPES = ('select', 'insert', 'update', 'delete', 'with')
+
+# Do not decode objects fetched by queries right away. The fetched document
+# is kept with the data manager and only converted when the object is first
+# accessed. Can be changed per data manager with `PJDataManager.defer_load`.
+PJ_DEFER_LOAD = False
+
+# Objects flushed more than once in a transaction update the already written
+# document with `jsonb_set()` instead of writing it again, as long as at most
+# this many keys changed. 0 always writes complete documents.
+PJ_PARTIAL_UPDATE_MAX_CHANGES = 10
+
 # Maximum query length to output qith query log
 MAX_QUERY_ARGUMENT_LENGTH = 500
 
@@ -55,9 +85,32 @@ PJ_AUTO_CREATE_TABLES = True
 
 # set to True to automatically create IColumnSerialization columns
 # will also create tables regardless of the PJ_AUTO_CREATE_TABLES setting
-# so this is super expensive
+# the columns of a table are only checked on the first store of the process
 PJ_AUTO_CREATE_COLUMNS = True
 
+# IColumnSerialization columns that exist and are indexed, keyed by
+# (database, table). Columns are only checked once per process, after the
+# transaction checking them was committed.
+CHECKED_SQL_COLUMNS = {}
+
+# Flag the latest state of every document with `is_current`, so loading
+# documents and searching mapped tables only touch the live states through
+# partial indexes instead of joining the state history on the transaction
+# id. Tables created without the flag need `migrate.mark_current_states()`.
+PJ_TRACK_CURRENT_STATE = False
+
+# Partial indexes on the current states, used with PJ_TRACK_CURRENT_STATE,
+# as (name suffix, statement)
+CURRENT_STATE_INDEXES = (
+    ('cur_pid', 'CREATE UNIQUE INDEX IF NOT EXISTS %(name)s '
+                'ON %(table)s_state (pid) WHERE is_current'),
+    ('cur_gin', 'CREATE INDEX IF NOT EXISTS %(name)s '
+                'ON %(table)s_state USING GIN (data) WHERE is_current'),
+)
+
+# PostgreSQL truncates longer names
+MAX_IDENTIFIER_LENGTH = 63
+
 
 TABLE_LOG = logging.getLogger('pjpersist.table')
 
@@ -69,6 +122,57 @@ psycopg2.extras.register_uuid()
 notify = None
 
 
+def _same_json(a, b):
+    """Whether two JSON values have the same JSON representation"""
+    if type(a) is not type(b):
+        return False
+    if type(a) is dict:
+        if len(a) != len(b):
+            return False
+        for key, value in a.iteritems():
+            if key not in b or not _same_json(value, b[key]):
+                return False
+        return True
+    if type(a) is list:
+        if len(a) != len(b):
+            return False
+        for value, other in zip(a, b):
+            if not _same_json(value, other):
+                return False
+        return True
+    return a == b
+
+
+def _diff_json(old, new, limit, path=(), changes=None):
+    """Return the changes turning document `old` into `new`
+
+    Changes are (path, value) tuples, where a value of `None` instead of a
+    one-tuple marks a removed key. None is returned when there are more than
+    `limit` changes.
+    """
+    if changes is None:
+        changes = []
+    for key, value in new.iteritems():
+        if key in old:
+            oldvalue = old[key]
+            if type(value) is dict and type(oldvalue) is dict:
+                if _diff_json(oldvalue, value, limit, path + (key,),
+                              changes) is None:
+                    return None
+                continue
+            if _same_json(oldvalue, value):
+                continue
+        changes.append((path + (key,), (value,)))
+        if len(changes) > limit:
+            return None
+    for key in old:
+        if key not in new:
+            changes.append((path + (key,), None))
+            if len(changes) > limit:
+                return None
+    return changes
+
+
 class StoredEvent(object):
     __slots__ = ('obj', )
 
@@ -78,6 +182,10 @@ class StoredEvent(object):
 
 class Json(psycopg2.extras.Json):
     """In logs, we want to have the JSON value not just Json object at <>"""
+
+    def dumps(self, obj):
+        return jsoncodec.dumps(obj)
+
     def __repr__(self):
         if PJ_ACCESS_LOGGING:
             try:
@@ -89,6 +197,30 @@ class Json(psycopg2.extras.Json):
             return '<%s>' % (self.__class__.__name__, )
 
 
+class JsonText(object):
+    """The text of a JSON value, exactly as `data ->> key` returns it
+
+    Text columns of IColumnSerialization objects are written from the
+    document this way, since queries read the key from the column instead.
+    """
+
+    def __init__(self, value):
+        self.json = Json(value)
+
+    def __conform__(self, proto):
+        if proto is psycopg2.extensions.ISQLQuote:
+            return self
+
+    def prepare(self, conn):
+        self.json.prepare(conn)
+
+    def getquoted(self):
+        return "(%s::jsonb #>> '{}')" % self.json.getquoted()
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.json)
+
+
 class PJPersistCursor(psycopg2.extras.DictCursor):
     def __init__(self, datamanager, flush, *args, **kwargs):
         super(PJPersistCursor, self).__init__(*args, **kwargs)
@@ -168,19 +300,65 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
             return r
         return arg
 
+    def _explain(self, sql, args):
+        """Return the JSON plan of the query or None if it cannot be
+        explained"""
+        # Use a separate plain cursor, so that the results of the explained
+        # query stay available.
+        cur = None
+        try:
+            cur = self.connection.cursor()
+            cur.execute("SAVEPOINT before_explain")
+            try:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, args)
+                plan = cur.fetchone()[0]
+            except psycopg2.Error, e:
+                cur.execute("ROLLBACK TO SAVEPOINT before_explain")
+                LOG.debug("Cannot explain %s: %s", sql, e)
+                return None
+            cur.execute("RELEASE SAVEPOINT before_explain")
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+        except Exception:
+            # Explaining must never affect the outcome of the query.
+            LOG.warning("Failed to explain %s", sql, exc_info=True)
+            return None
+        finally:
+            if cur is not None:
+                cur.close()
+        return plan
+
+    def _should_explain(self, sql, duration):
+        if PJ_EXPLAIN_SLOW_QUERY_TIME is None:
+            return False
+        if duration < PJ_EXPLAIN_SLOW_QUERY_TIME:
+            return False
+        query_type = sql.strip().split(None, 1)[0].lower()
+        return query_type in EXPLAINABLE_QUERY_TYPES
+
     def _execute_and_log(self, sql, args):
         # Very useful logging of every SQL command with traceback to code.
         # __traceback_info__ = (self.datamanager.database, sql, args)
+        timings = self.datamanager._timings
         t0 = time.time()
+        failed = True
         try:
             res = super(PJPersistCursor, self).execute(sql, args)
+            failed = False
         finally:
             t1 = time.time()
+            if timings is not None:
+                timings.add('sql', t1 - t0)
             db = self.datamanager.database
 
+            plan = None
+            if not failed and self._should_explain(sql, t1-t0):
+                plan = self._explain(sql, args)
+
             debug = (PJ_ACCESS_LOGGING or
                      PJ_ENABLE_QUERY_STATS or
-                     PJ_ENABLE_QUERY_STATS)
+                     PJ_ENABLE_GLOBAL_QUERY_STATS or
+                     plan is not None)
 
             if debug:
                 saneargs = [self._sanitize_arg(a) for a in args] \
@@ -189,16 +367,29 @@ class PJPersistCursor(psycopg2.extras.DictCursor):
             if PJ_ACCESS_LOGGING:
                 self.log_query(sql, saneargs, t1-t0)
 
+            if plan is not None:
+                TABLE_LOG.info(
+                    "Slow query %s,\n args:%r,\n time:%sms,\n plan:%s",
+                    sql, saneargs, (t1-t0)*1000, json.dumps(plan))
+
             if PJ_ENABLE_QUERY_STATS:
-                self.datamanager._query_report.record(sql, saneargs, t1-t0, db)
+                self.datamanager._query_report.record(
+                    sql, saneargs, t1-t0, db, plan)
 
             if PJ_ENABLE_GLOBAL_QUERY_STATS:
                 if getattr(GLOBAL_QUERY_STATS, 'report', None) is None:
-                    GLOBAL_QUERY_STATS.report = QueryReport()
-                GLOBAL_QUERY_STATS.report.record(sql, saneargs, t1-t0, db)
+                    GLOBAL_QUERY_STATS.report = create_query_report()
+                GLOBAL_QUERY_STATS.report.record(
+                    sql, saneargs, t1-t0, db, plan)
         return res
 
 
+def create_query_report():
+    if PJ_AGGREGATE_QUERY_STATS:
+        return AggregatedQueryReport()
+    return QueryReport()
+
+
 def check_for_conflict(e, sql):
     """Check whether exception indicates serialization failure and raise
     ConflictError in this case.
@@ -271,6 +462,14 @@ class PJDataManager(object):
         self._in_commit = False
         self._commit_failed = False
         self._object_cache = {}
+        # Whether objects fetched by queries are decoded on first access
+        self.defer_load = PJ_DEFER_LOAD
+        # Whether objects are loaded as read-only snapshots, which cannot be
+        # changed. Set it before any objects are loaded.
+        self.snapshot = False
+        # Timings of the last finished transaction, a mapping from phase to
+        # {'count': <calls>, 'time': <seconds>}
+        self.last_timings = None
         self._cleanup()
 
     def _cleanup(self):
@@ -284,6 +483,21 @@ class PJDataManager(object):
         self._modified_objects = {}
         self._removed_objects = {}
         self._stored_objects = {}
+        # Documents fetched along with objects that were not loaded yet, keyed
+        # by DBRef. `setstate()` uses them instead of querying again.
+        self._latest_states = {}
+        # Documents written in this transaction, keyed by (table, id). Used
+        # to update them partially when they are flushed again.
+        self._written_docs = {}
+        # Blobs stored in this transaction. Their ids are reset on abort.
+        self._inserted_blobs = []
+        # IColumnSerialization columns checked in this transaction, keyed
+        # like CHECKED_SQL_COLUMNS. They are only added there on commit, as
+        # an abort reverts the changes to the tables.
+        self._checked_sql_columns = {}
+        # Classes of references looked up by `ObjectReader.resolve_many()`,
+        # keyed by DBRef.
+        self._resolved_classes = {}
         self.annotations = {}
 
         # transaction related
@@ -294,7 +508,8 @@ class PJDataManager(object):
 
         self.transaction_manager = transaction.manager
 
-        self._query_report = QueryReport()
+        self._query_report = create_query_report()
+        self._timings = TransactionTimings() if PJ_COLLECT_TIMINGS else None
         self._commit_failed = False
         if self._root is not None:
             LOG.debug('invalidate root')
@@ -403,6 +618,8 @@ class PJDataManager(object):
 
         for tbl in tables:
             self._create_doc_table(self.database, tbl)
+            # The table might have been created before fields were promoted.
+            self._create_promoted_columns(tbl)
 
         with self.getCursor(False) as cur:
             cur.connection.commit()
@@ -421,6 +638,8 @@ class PJDataManager(object):
                 LOG.info("Creating data table %s with extra columns: '%s'" % (table, extra_columns))
                 if extra_columns:
                     extra_columns += ', '
+                if PJ_TRACK_CURRENT_STATE:
+                    extra_columns += 'is_current BOOLEAN NOT NULL DEFAULT TRUE, '
                 cur.execute('''
                     CREATE TABLE %s (
                         id BIGSERIAL PRIMARY KEY,
@@ -440,27 +659,177 @@ class PJDataManager(object):
                 cur.execute('''
                     CREATE INDEX %s_data_gin ON %s_state USING GIN (data);
                     ''' % (table, table))
+                if PJ_TRACK_CURRENT_STATE:
+                    create_current_state_indexes(cur, table)
+                self._create_promoted_columns(table)
+
+    def _create_promoted_columns(self, table):
+        """Create the columns and indexes of the promoted fields of a table.
+
+        Every promoted key gets a generated column of its type with a btree
+        index, plus a btree index on the JSONB value of the key, which is
+        used by comparisons like the ones of `JGET`.
+        """
+        fields = serialize.PROMOTED_FIELDS.get(table)
+        if not fields:
+            return
+        with self.getCursor(False) as cur:
+            for key, pgtype in sorted(fields.items()):
+                column = serialize.get_promoted_column_name(key)
+                keys = key.split('.')
+                if len(keys) == 1:
+                    text = "data ->> '%s'" % key
+                    value = "data -> '%s'" % key
+                else:
+                    text = "data #>> '{%s}'" % ','.join(keys)
+                    value = "data #> '{%s}'" % ','.join(keys)
+                if pgtype != 'text':
+                    text = '%s(%s)' % (self._create_cast_function(pgtype), text)
+                cur.execute('''
+                    ALTER TABLE %s_state ADD COLUMN IF NOT EXISTS
+                    %s %s GENERATED ALWAYS AS (%s) STORED
+                    ''' % (table, column, pgtype, text))
+                cur.execute('''
+                    CREATE INDEX IF NOT EXISTS %s_%s ON %s_state (%s)
+                    ''' % (table, column, table, column))
+                cur.execute('''
+                    CREATE INDEX IF NOT EXISTS %s_%s_jsonb ON %s_state ((%s))
+                    ''' % (table, column, table, value))
+
+    def _create_cast_function(self, pgtype):
+        """Create the function converting text to the type for generated
+        columns and return its name.
+
+        Values that cannot be converted result in NULL instead of an error,
+        which would make writing the document fail.
+        """
+        name = 'pj_to_' + pgtype.replace(' ', '_')
+        with self.getCursor(False) as cur:
+            cur.execute("SELECT to_regprocedure(%s)", (name + '(text)',))
+            if cur.fetchone()[0] is None:
+                cur.execute('''
+                    CREATE FUNCTION %s(value text) RETURNS %s
+                    LANGUAGE plpgsql IMMUTABLE STRICT AS $$
+                    BEGIN
+                        RETURN value::%s;
+                    EXCEPTION WHEN data_exception THEN
+                        RETURN NULL;
+                    END $$''' % (name, pgtype, pgtype))
+        return name
+
+    def _create_blob_table(self, table):
+        LOG.info("Creating blob table %s_blobs" % (table, ))
+        with self.getCursor(False) as cur:
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS %s_blobs (
+                    id BIGSERIAL PRIMARY KEY,
+                    digest BYTEA NOT NULL UNIQUE,
+                    data BYTEA NOT NULL)''' % (table, ), autocreate=False)
+
+    def _insert_blob(self, table, data):
+        # Blobs are stored by their content, so that storing the same data
+        # again, like a large string of a document flushed again, does not
+        # add another row.
+        sql = """
+            INSERT INTO %s_blobs (digest, data) VALUES (%%s, %%s)
+            ON CONFLICT (digest) DO UPDATE SET digest = EXCLUDED.digest
+            RETURNING id""" % table
+        args = (psycopg2.Binary(hashlib.sha256(data).digest()),
+                psycopg2.Binary(data))
+        with self.getCursor(False) as cur:
+            psycopg2.extras.DictCursor.execute(cur, "SAVEPOINT before_insert_blob")
+            try:
+                cur.execute(sql, args, autocreate=False)
+                _id = cur.fetchone()[0]
+            except psycopg2.ProgrammingError:
+                if not PJ_AUTO_CREATE_TABLES:
+                    raise
+                psycopg2.extras.DictCursor.execute(cur, "ROLLBACK TO SAVEPOINT before_insert_blob")
+                self._create_blob_table(table)
+                cur.execute(sql, args, autocreate=False)
+                _id = cur.fetchone()[0]
+            else:
+                psycopg2.extras.DictCursor.execute(cur, "RELEASE SAVEPOINT before_insert_blob")
+        return _id
+
+    def _read_blob(self, table, _id, offset=0, size=None):
+        """Read the data of a blob, or a part of it"""
+        # substring() positions start at 1
+        if size is None:
+            sql = "SELECT substring(data FROM %%s) FROM %s_blobs WHERE id = %%s"
+            args = (offset + 1, _id)
+        else:
+            sql = "SELECT substring(data FROM %%s FOR %%s) FROM %s_blobs WHERE id = %%s"
+            args = (offset + 1, size, _id)
+        with self.getCursor(False) as cur:
+            cur.execute(sql % table, args)
+            res = cur.fetchone()
+        if res is None:
+            raise KeyError((table, _id))
+        return str(res[0])
 
     def _ensure_sql_columns(self, obj, table):
         # create the table required for the object, with the necessary
         # _pj_column_fields translated to SQL types
-        if PJ_AUTO_CREATE_COLUMNS:
-            if interfaces.IColumnSerialization.providedBy(obj):
-                # XXX: exercise for later, not just create but check
-                #      the columns
-                # SELECT column_name
-                #  FROM INFORMATION_SCHEMA.COLUMNS
-                #  WHERE table_name = '<name of table>';
-                columns = []
-                for field in obj._pj_column_fields:
-                    pgtype = serialize.PYTHON_TO_PG_TYPES[field._type]
-                    columns.append("%s %s" % (field.__name__, pgtype))
-
-                columns = ', '.join(columns)
-
-                self._create_doc_table(self.database, table, columns)
-                return True
-        return False
+        if not PJ_AUTO_CREATE_COLUMNS:
+            return False
+        if not interfaces.IColumnSerialization.providedBy(obj):
+            return False
+        columns = [(field.__name__, serialize.PYTHON_TO_PG_TYPES[field._type])
+                   for field in obj._pj_column_fields]
+        key = (self.database, table)
+        checked = CHECKED_SQL_COLUMNS.get(key, set()) | \
+            self._checked_sql_columns.get(key, set())
+        if all(name in checked for name, pgtype in columns):
+            return True
+        self._create_doc_table(
+            self.database, table,
+            ', '.join('%s %s' % column for column in columns))
+        with self.getCursor(False) as cur:
+            cur.execute('''
+                SELECT attname, format_type(atttypid, atttypmod)
+                FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0
+                  AND NOT attisdropped''', ('%s_state' % table, ))
+            existing = dict(cur.fetchall())
+            for name, pgtype in columns:
+                cur.execute('SELECT %s::regtype::text', (pgtype, ))
+                pgtype = cur.fetchone()[0]
+                if name not in existing:
+                    LOG.info('Adding column %s %s to %s_state',
+                             name, pgtype, table)
+                    cur.execute('ALTER TABLE %s_state ADD COLUMN %s %s' % (
+                        table, name, pgtype))
+                    if pgtype == 'text':
+                        # Queries read text values from the column, so the
+                        # documents written before need them too.
+                        cur.execute(
+                            "UPDATE %s_state SET %s = data ->> '%s'" % (
+                                table, name, name))
+                elif existing[name] != pgtype:
+                    raise TypeError(
+                        'Column %s of %s_state has type %s instead of %s' % (
+                            name, table, existing[name], pgtype))
+                cur.execute(
+                    'CREATE INDEX IF NOT EXISTS %s_%s ON %s_state (%s)' % (
+                        table, name, table, name))
+        self._checked_sql_columns.setdefault(key, set()).update(
+            name for name, pgtype in columns)
+        return True
+
+    def _get_column_data(self, obj, doc):
+        """Return the values of the IColumnSerialization columns of `obj`
+
+        Text columns are taken from the document `doc`, so they always hold
+        what `data ->> key` returns, even when `getattr()` finds a class
+        default or property value that is not in the document.
+        """
+        column_data = obj._pj_get_column_fields()
+        for field in obj._pj_column_fields:
+            if serialize.PYTHON_TO_PG_TYPES[field._type] == 'text':
+                column_data[field.__name__] = JsonText(
+                    doc.get(field.__name__))
+        return column_data
 
     def _insert_doc(self, database, table, doc, _id=None, column_data=None):
 
@@ -500,12 +869,52 @@ class PJDataManager(object):
                 table, columns, self.get_transaction_id(), _id, placeholders)
 
             cur.execute(sql, tuple(values))
+        if PJ_PARTIAL_UPDATE_MAX_CHANGES:
+            self._written_docs[(table, _id)] = dict(doc)
         return _id
 
+    def _update_doc_partially(self, table, doc, _id, column_data):
+        """Apply the changes to the document written before in this
+        transaction. Returns False when a complete write is needed."""
+        written = self._written_docs.get((table, _id))
+        if written is None:
+            return False
+        changes = _diff_json(written, doc, PJ_PARTIAL_UPDATE_MAX_CHANGES)
+        if changes is None:
+            return False
+
+        columns = []
+        values = []
+        if changes:
+            expr = 'data'
+            for path, value in changes:
+                values.append(list(path))
+                if value is None:
+                    expr = '(' + expr + ' #- %s::text[])'
+                else:
+                    expr = 'jsonb_set(' + expr + ', %s::text[], %s::jsonb)'
+                    values.append(Json(value[0]))
+            columns.append('data=' + expr)
+        if column_data:
+            for colname, value in column_data.items():
+                columns.append(colname + '=%s')
+                values.append(value)
+        if columns:
+            sql = "UPDATE %s_state SET %s WHERE tid=%%s AND pid=%%s" % (
+                table, ', '.join(columns))
+            with self.getCursor() as cur:
+                cur.execute(sql, tuple(values) + (self.get_transaction_id(), _id))
+        self._written_docs[(table, _id)] = dict(doc)
+        return True
+
     def _update_doc(self, database, table, doc, _id, column_data=None):
+        del doc[interfaces.ATTR_NAME_PY_TYPE]
+        if PJ_PARTIAL_UPDATE_MAX_CHANGES and self._update_doc_partially(
+                table, doc, _id, column_data):
+            return _id
+
         # Insert the document into the table.
         with self.getCursor() as cur:
-            del doc[interfaces.ATTR_NAME_PY_TYPE]
             builtins = dict(data=Json(doc))
 
             if column_data is None:
@@ -523,10 +932,16 @@ class PJDataManager(object):
             sql1 = "INSERT INTO %s_state (tid, pid, %s) VALUES (%d, %d, %s)" % (
                 table, columns, self.get_transaction_id(), _id, placeholders)
 
+            if PJ_TRACK_CURRENT_STATE:
+                cur.execute(
+                    "UPDATE %s_state SET is_current = false "
+                    "WHERE pid = %d AND is_current AND tid <> %d" % (
+                        table, _id, self.get_transaction_id()))
+
             psycopg2.extras.DictCursor.execute(cur, "SAVEPOINT before_insert")
             try:
                 cur.execute(sql1, tuple(values))
-            except psycopg2.IntegrityError:
+            except psycopg2.IntegrityError, err:
                 psycopg2.extras.DictCursor.execute(cur, "ROLLBACK TO SAVEPOINT before_insert")
                 columns = []
                 values = []
@@ -536,15 +951,24 @@ class PJDataManager(object):
                 columns = ', '.join(columns)
                 sql2 = "UPDATE %s_state SET %s WHERE tid=%%s AND pid=%%s" % (table, columns)
                 cur.execute(sql2, tuple(values) + (self.get_transaction_id(), _id))
+                if PJ_TRACK_CURRENT_STATE and not cur.rowcount:
+                    # Another transaction wrote a new current state.
+                    raise interfaces.ConflictError(str(err), sql1)
             else:
                 psycopg2.extras.DictCursor.execute(cur, "RELEASE SAVEPOINT before_insert")
 
             sql3 = "UPDATE %s SET tid=%d WHERE id = %d" % (table, self.get_transaction_id(), _id)
 
             cur.execute(sql3)
+        if PJ_PARTIAL_UPDATE_MAX_CHANGES:
+            self._written_docs[(table, _id)] = dict(doc)
         return _id
 
     def _get_doc(self, database, table, _id):
+        if PJ_TRACK_CURRENT_STATE:
+            join = 's.pid = m.id AND s.is_current'
+        else:
+            join = 'm.id = s.pid AND m.tid = s.tid'
         with self.getCursor() as cur:
             sql = """
 SELECT
@@ -554,9 +978,9 @@ SELECT
     s.data
 FROM
     %s m
-    JOIN %s_state s ON m.id = s.pid AND m.tid = s.tid
+    JOIN %s_state s ON %s
 WHERE
-    m.id=%%s""" % (table, table)
+    m.id=%%s""" % (table, table, join)
             cur.execute(sql, (_id, ))
             res = cur.fetchone()
             if res:
@@ -582,35 +1006,66 @@ WHERE
             res = cur.fetchone()
             return res[0] if res is not None else None
 
+    def _get_doc_py_types(self, database, table, ids):
+        """Return a mapping of the given ids to the stored class paths"""
+        with self.getCursor() as cur:
+            sql = """
+SELECT
+    id, package || '.' || class_name
+FROM
+    %s
+WHERE
+    id = ANY(%%s)
+""" % table
+            cur.execute(sql, (list(ids),))
+            return dict(cur.fetchall())
+
     def _get_table_from_object(self, obj):
         return self._writer.get_table_name(obj)
 
+    def _timing_start(self, phase):
+        if self._timings is None:
+            return None
+        return self._timings.start(phase)
+
+    def _timing_stop(self, phase, started):
+        if self._timings is not None:
+            self._timings.stop(phase, started)
+
+    def _save_timings(self):
+        if self._timings is not None:
+            self.last_timings = self._timings.as_dict()
+
     def _flush_objects(self):
-        # self.root.on_flush()
-        # Now write every registered object, but make sure we write each
-        # object just once.
-        written = set()
-        # Make sure that we do not compute the list of flushable objects all
-        # at once. While writing objects, new sub-objects might be registered
-        # that also need saving.
-        todo = set(self._registered_objects.keys())
-        while todo:
-            obj_id = todo.pop()
-            obj = self._registered_objects[obj_id]
-            # __traceback_info__ = obj
-            obj = self._get_doc_object(obj)  # make sure that obj is not a subobject
-            self._writer.store(obj)
-            written.add(obj_id)
-            todo = set(self._registered_objects.keys()) - written
+        started = self._timing_start('flush')
+        try:
+            # self.root.on_flush()
+            # Now write every registered object, but make sure we write each
+            # object just once.
+            written = set()
+            # Make sure that we do not compute the list of flushable objects all
+            # at once. While writing objects, new sub-objects might be registered
+            # that also need saving.
+            todo = set(self._registered_objects.keys())
+            while todo:
+                obj_id = todo.pop()
+                obj = self._registered_objects[obj_id]
+                # __traceback_info__ = obj
+                obj = self._get_doc_object(obj)  # make sure that obj is not a subobject
+                self._writer.store(obj)
+                written.add(obj_id)
+                todo = set(self._registered_objects.keys()) - written
+        finally:
+            self._timing_stop('flush', started)
 
     def _get_doc_object(self, obj):
-        seen = []
+        seen = set()
         # Make sure we write the object representing a document in a
         # table and not a sub-object.
         while getattr(obj, interfaces.ATTR_NAME_SUB_OBJECT, False):
             if id(obj) in seen:
                 raise interfaces.CircularReferenceError(obj)
-            seen.append(id(obj))
+            seen.add(id(obj))
             obj = obj._p_pj_doc_object
         if obj._p_state == GHOST:
             obj._p_activate()
@@ -661,7 +1116,7 @@ WHERE
             _id = None
         res = self._writer.store(obj, _id=_id)
         obj._p_changed = False
-        self._object_cache[obj._p_oid.as_key()] = obj
+        self._object_cache[obj._p_oid] = obj
         self._inserted_objects[id(obj)] = obj
         return res
 
@@ -680,9 +1135,8 @@ WHERE
                 cur.execute('DELETE FROM %s WHERE id=%%s' % table, (obj._p_oid.id,))
             except:
                 pass
-        cache_key = obj._p_oid.as_key()
-        if cache_key in self._object_cache:
-            del self._object_cache[cache_key]
+        self._written_docs.pop((table, obj._p_oid.id), None)
+        self._object_cache.pop(obj._p_oid, None)
         # Edge case: The object was just added in this transaction.
         if id(obj) in self._inserted_objects:
             # but it still had to be removed from PostGreSQL, because insert
@@ -701,7 +1155,9 @@ WHERE
 
     def setstate(self, obj):
         dbref = obj._p_oid
-        doc = self._get_doc_by_dbref(dbref)
+        doc = self._latest_states.pop(dbref, None)
+        if doc is None:
+            doc = self._get_doc_by_dbref(dbref)
         self._reader.set_ghost_state(obj, doc)
 
     # TODO: implement oldstate() method
@@ -709,6 +1165,9 @@ WHERE
         raise KeyError(tid)
 
     def register(self, obj):
+        if self.snapshot:
+            raise interfaces.ReadOnlyError(
+                'Objects loaded as snapshots cannot be modified', obj)
         self._join_txn()
 
         # Do not bring back removed objects. But only main the document
@@ -731,15 +1190,20 @@ WHERE
         # should not call from two-phase commit
         assert not self._in_commit
         self._report_stats()
+        self._save_timings()
         try:
             self._conn.rollback()
         except psycopg2.InterfaceError:
             # this happens usually when PG is restarted and the connection dies
             # our only chance to exit the spiral is to abort the transaction
             pass
+        # The rows of blobs stored in the transaction are gone.
+        for blob in self._inserted_blobs:
+            blob.table = blob.id = blob._jar = None
         self._cleanup()
 
     def commit(self, transaction):
+        started = self._timing_start('commit')
         try:
             # Now write every registered object, but make sure we write each
             # object just once.
@@ -752,6 +1216,8 @@ WHERE
         except:
             self._commit_failed = True
             raise
+        finally:
+            self._timing_stop('commit', started)
 
     def _tpc_cleanup(self):
         """Performs cleanup operations to support tpc_finish and tpc_abort."""
@@ -766,6 +1232,13 @@ WHERE
         """
         Stores transaction id and commit datetime then performs commit
         """
+        started = self._timing_start('vote')
+        try:
+            self._tpc_vote(transaction)
+        finally:
+            self._timing_stop('vote', started)
+
+    def _tpc_vote(self, transaction):
         with self.getCursor(False) as cur:
             psycopg2.extras.DictCursor.execute(cur, "SAVEPOINT before_insert_transaction")
             isql = "INSERT INTO transactions(tid) VALUES(%s)"
@@ -795,6 +1268,8 @@ CREATE TABLE transactions (
                 psycopg2.extras.DictCursor.execute(cur, "RELEASE SAVEPOINT before_insert_transaction")
         try:
             self._conn.commit()
+            for key, checked in self._checked_sql_columns.items():
+                CHECKED_SQL_COLUMNS.setdefault(key, set()).update(checked)
             if callable(notify):
                 for obj in self._stored_objects.values():
                     # notify a store object
@@ -808,6 +1283,7 @@ CREATE TABLE transactions (
             self._report_stats()
         except:
             pass
+        self._save_timings()
         self._cleanup()
         self._tpc_cleanup()
 
@@ -826,6 +1302,26 @@ CREATE TABLE transactions (
         TABLE_LOG.info(stats)
 
 
+def get_index_name(table, suffix):
+    """Return the name of an index of the table.
+
+    Names PostgreSQL would truncate end with a hash of the full name
+    instead, so that they stay unique.
+    """
+    name = '%s_%s' % (table, suffix)
+    if len(name) > MAX_IDENTIFIER_LENGTH:
+        digest = hashlib.md5(name).hexdigest()[:8]
+        name = '%s_%s' % (name[:MAX_IDENTIFIER_LENGTH - 9], digest)
+    return name
+
+
+def create_current_state_indexes(cur, table):
+    """Create the partial indexes of the current states of a table"""
+    for suffix, sql in CURRENT_STATE_INDEXES:
+        cur.execute(sql % {'name': get_index_name(table, suffix),
+                           'table': table})
+
+
 def get_database_name_from_dsn(dsn):
     m = re.match(r'.*dbname *= *(.+?)( |$)', dsn)
     if m:
@@ -34,6 +34,7 @@ ATTR_NAME_DOC_OBJECT = '_p_pj_doc_object'
 ATTR_NAME_STATE = '_p_pj_state'
 ATTR_NAME_TX_ID = '_p_pj_tid'
 ATTR_NAME_PY_TYPE = '_py_persistent_type'
+ATTR_NAME_LAZY_CONTAINERS = '_p_pj_lazy_containers'
 
 
 class CircularReferenceError(Exception):
@@ -44,10 +45,32 @@ class ConflictError(transaction.interfaces.TransientError):
     pass
 
 
+class NPlusOneQueryError(Exception):
+    pass
+
+
+class ReadOnlyError(TypeError):
+    """An object loaded as a read-only snapshot was modified."""
+
+
 class IObjectSerializer(zope.interface.Interface):
     """An object serializer allows for custom serialization output for
     objects."""
 
+    write_types = zope.interface.Attribute(
+        'Types whose instances (including subclasses) are written by this '
+        'serializer, unless an earlier one applies. When empty, '
+        '`can_write()` is asked.')
+
+    read_types = zope.interface.Attribute(
+        'The `_py_type` tags of states that are read by this serializer, '
+        'unless an earlier one applies. When empty, `can_read()` is asked.')
+
+    encode_state = zope.interface.Attribute(
+        'Whether the written states contain values, like `Blob`s, which '
+        'are serialized by the writer. Their states are converted back '
+        'before the state is read.')
+
     def can_read(state):
         """Returns a boolean indicating whether this serializer can deserialize
         this state."""
@@ -67,7 +90,11 @@ class IObjectWriter(zope.interface.Interface):
     """The object writer stores an object in the database."""
 
     def get_non_persistent_state(obj, seen):
-        """Convert a non-persistent object to a JSONB state/document."""
+        """Convert a non-persistent object to a JSONB state/document.
+
+        `seen` is the set of ids of the objects whose state is being
+        written, see `get_state()`.
+        """
 
     def get_persistent_state(obj, seen):
         """Convert a persistent object to a JSONB state/document."""
@@ -76,7 +103,8 @@ class IObjectWriter(zope.interface.Interface):
         """Convert an arbitrary object to a JSONB state/document.
 
         A ``CircularReferenceError`` is raised, if a non-persistent loop is
-        detected.
+        detected. `seen` is the set of ids of the non-persistent objects that
+        contain the object.
         """
 
     def store(obj, id=None):
@@ -103,6 +131,20 @@ class IObjectReader(zope.interface.Interface):
         of.
         """
 
+    def get_snapshot(state, obj=None):
+        """Get a read-only object from the given state.
+
+        Dictionaries and lists are loaded as read-only subclasses of `dict`
+        and `list` instead of persistent containers.
+        """
+
+    def get_snapshot_object(dbref, doc):
+        """Get a read-only persistent object from its document.
+
+        The object is not cached by the data manager and changing it raises
+        a `ReadOnlyError`.
+        """
+
     def set_ghost_state(obj):
         """Convert a ghosted object to an active object by loading its state.
         """
@@ -118,6 +160,10 @@ class IPJDataManager(persistent.interfaces.IPersistentDataManager):
     root = zope.interface.Attribute(
         """Get the root object, which is a mapping.""")
 
+    snapshot = zope.interface.Attribute(
+        """When true, objects are loaded as read-only snapshots and
+        registering a changed object raises a `ReadOnlyError`.""")
+
     def create_tables(tables):
         """Create passed tables and persistence_name_map, use this instead
         of PJ_AUTO_CREATE_TABLES"""
@@ -209,7 +255,11 @@ class IColumnSerialization(zope.interface.Interface):
         required=True)
 
     def _pj_get_column_fields():
-        """Get Column Fields as a mapping from name to value."""
+        """Get Column Fields as a mapping from name to value.
+
+        Text columns are written from the stored document instead, since
+        queries read those keys from the column.
+        """
 
 
 class IBroken(zope.interface.Interface):
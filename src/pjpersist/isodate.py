@@ -0,0 +1,172 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Fixed-format ISO 8601 codec for dates, times and datetimes
+
+Values are written as `YYYY-MM-DD`, `HH:MM:SS[.ffffff][+HH:MM]` and
+`YYYY-MM-DDTHH:MM:SS[.ffffff][+HH:MM]`. Microseconds and the UTC offset are
+only added when present, so naive values without microseconds keep the
+format used by earlier versions.
+
+Parsing is done by slicing, which is a lot faster than `strptime()`.
+"""
+from __future__ import absolute_import
+
+import datetime
+
+ZERO = datetime.timedelta(0)
+
+
+class FixedOffset(datetime.tzinfo):
+    """A timezone with a fixed offset from UTC, in minutes"""
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self._offset = datetime.timedelta(minutes=minutes)
+
+    def utcoffset(self, dt):
+        return self._offset
+
+    def dst(self, dt):
+        return ZERO
+
+    def tzname(self, dt):
+        if not self.minutes:
+            return 'UTC'
+        return format_offset(self._offset)
+
+    def __reduce__(self):
+        return get_offset, (self.minutes,)
+
+    def __repr__(self):
+        return '<FixedOffset %s>' % self.tzname(None)
+
+
+OFFSETS = {}
+
+
+def get_offset(minutes):
+    """Return the shared timezone for the given UTC offset in minutes"""
+    try:
+        return OFFSETS[minutes]
+    except KeyError:
+        tz = OFFSETS[minutes] = FixedOffset(minutes)
+        return tz
+
+
+UTC = get_offset(0)
+
+
+def format_offset(offset):
+    minutes = offset.days * 1440 + offset.seconds // 60
+    sign = '+'
+    if minutes < 0:
+        sign = '-'
+        minutes = -minutes
+    return '%s%02d:%02d' % (sign, minutes // 60, minutes % 60)
+
+
+def _format_time(obj):
+    value = '%02d:%02d:%02d' % (obj.hour, obj.minute, obj.second)
+    if obj.microsecond:
+        value += '.%06d' % obj.microsecond
+    if obj.tzinfo is not None:
+        offset = obj.utcoffset()
+        if offset is not None:
+            value += format_offset(offset)
+    return value
+
+
+def format_date(obj):
+    return '%04d-%02d-%02d' % (obj.year, obj.month, obj.day)
+
+
+def format_time(obj):
+    return _format_time(obj)
+
+
+def format_datetime(obj):
+    return '%04d-%02d-%02dT%s' % (
+        obj.year, obj.month, obj.day, _format_time(obj))
+
+
+def _parse_offset(value, orig):
+    if value == 'Z':
+        return UTC
+    sign = value[0]
+    if sign not in '+-':
+        raise ValueError('Invalid UTC offset: %r' % orig)
+    if len(value) == 3:
+        # +HH
+        minutes = int(value[1:3]) * 60
+    elif len(value) == 5:
+        # +HHMM
+        minutes = int(value[1:3]) * 60 + int(value[3:5])
+    elif len(value) == 6 and value[3] == ':':
+        # +HH:MM
+        minutes = int(value[1:3]) * 60 + int(value[4:6])
+    else:
+        raise ValueError('Invalid UTC offset: %r' % orig)
+    if sign == '-':
+        minutes = -minutes
+    return get_offset(minutes)
+
+
+def _parse_time(value, pos):
+    """Parse `HH:MM:SS[.ffffff][offset]` from the given position on"""
+    if value[pos + 2:pos + 3] != ':' or value[pos + 5:pos + 6] != ':':
+        raise ValueError('Invalid ISO time: %r' % value)
+    hour = int(value[pos:pos + 2])
+    minute = int(value[pos + 3:pos + 5])
+    second = int(value[pos + 6:pos + 8])
+    pos += 8
+    end = len(value)
+    microsecond = 0
+    if pos < end and value[pos] == '.':
+        start = pos = pos + 1
+        while pos < end and value[pos].isdigit():
+            pos += 1
+        if pos == start:
+            raise ValueError('Invalid ISO time: %r' % value)
+        # Anything beyond microseconds is truncated.
+        microsecond = int(value[start:min(pos, start + 6)].ljust(6, '0'))
+    tzinfo = None
+    if pos < end:
+        tzinfo = _parse_offset(value[pos:], value)
+    return hour, minute, second, microsecond, tzinfo
+
+
+def _parse_date(value):
+    if value[4:5] != '-' or value[7:8] != '-':
+        raise ValueError('Invalid ISO date: %r' % value)
+    return int(value[0:4]), int(value[5:7]), int(value[8:10])
+
+
+def parse_date(value):
+    if len(value) != 10:
+        raise ValueError('Invalid ISO date: %r' % value)
+    return datetime.date(*_parse_date(value))
+
+
+def parse_time(value):
+    hour, minute, second, microsecond, tzinfo = _parse_time(value, 0)
+    return datetime.time(hour, minute, second, microsecond, tzinfo)
+
+
+def parse_datetime(value):
+    if value[10:11] not in ('T', ' '):
+        raise ValueError('Invalid ISO datetime: %r' % value)
+    year, month, day = _parse_date(value)
+    hour, minute, second, microsecond, tzinfo = _parse_time(value, 11)
+    return datetime.datetime(
+        year, month, day, hour, minute, second, microsecond, tzinfo)
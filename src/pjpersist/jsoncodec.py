@@ -0,0 +1,82 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""The JSON codec used to talk to PostGreSQL
+
+Documents written through `datamanager.Json`, JSONB values read by psycopg2
+and JSON literals built by `mquery` and `sqlbuilder` all use `dumps()` and
+`loads()` of this module. Use `set_codec()` to select another
+implementation.
+"""
+from __future__ import absolute_import
+
+import json
+
+import psycopg2.extras
+
+# Mapping from codec name to a (dumps, loads) tuple
+CODECS = {
+    'json': (json.dumps, json.loads),
+}
+
+try:
+    import simplejson
+except ImportError:  # pragma: no cover
+    pass
+else:
+    def simplejson_loads(s):
+        # Under Python 2 simplejson returns ASCII strings as `str`, unless
+        # it is given `unicode`.
+        if isinstance(s, str):
+            s = s.decode('utf-8')
+        return simplejson.loads(s)
+
+    CODECS['simplejson'] = (simplejson.dumps, simplejson_loads)
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    pass
+else:
+    try:
+        ujson.dumps(0.0, double_precision=15)
+    except TypeError:
+        # ujson 2 writes the shortest representation of floats that reads
+        # back the same.
+        ujson_dumps = ujson.dumps
+    else:  # pragma: no cover
+        # Older versions round floats to 9 digits by default and to 15 at
+        # most, so they lose the last digits of some floats.
+        def ujson_dumps(obj):
+            return ujson.dumps(obj, double_precision=15)
+    CODECS['ujson'] = (ujson_dumps, ujson.loads)
+
+CODEC = 'json'
+dumps, loads = CODECS[CODEC]
+
+
+def register_codec(name, dumps, loads):
+    """Make a custom codec available to `set_codec()`"""
+    CODECS[name] = (dumps, loads)
+
+
+def set_codec(name):
+    """Use the named codec for all JSON encoding and decoding"""
+    global CODEC, dumps, loads
+    try:
+        codec = CODECS[name]
+    except KeyError:
+        raise ValueError('Unknown JSON codec: %r' % name)
+    CODEC = name
+    dumps, loads = codec
+    psycopg2.extras.register_default_jsonb(globally=True, loads=loads)
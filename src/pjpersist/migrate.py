@@ -0,0 +1,159 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Migration of stored documents"""
+from __future__ import absolute_import
+
+from pjpersist import interfaces, serialize
+from pjpersist.datamanager import Json, create_current_state_indexes
+
+# Keys whose values name a class
+TYPE_TAG_KEYS = ('_py_type', interfaces.ATTR_NAME_PY_TYPE, '_py_factory')
+
+
+def convert_type_tags(state, mapping):
+    """Replace the class names in the state according to the mapping
+
+    Returns whether anything was changed.
+    """
+    changed = False
+    if isinstance(state, dict):
+        if state.get('_py_type') == 'type':
+            path = mapping.get(state.get('path'))
+            if path is not None:
+                state['path'] = path
+                changed = True
+        for key, value in state.items():
+            if key in TYPE_TAG_KEYS:
+                tag = mapping.get(value)
+                if tag is not None:
+                    state[key] = tag
+                    changed = True
+            elif isinstance(value, (dict, list)):
+                changed = convert_type_tags(value, mapping) or changed
+    elif isinstance(state, list):
+        for value in state:
+            if isinstance(value, (dict, list)):
+                changed = convert_type_tags(value, mapping) or changed
+    return changed
+
+
+def get_state_tables(conn):
+    """Return the names of all tables with document states"""
+    return _get_tables(conn, '_state')
+
+
+def get_blob_tables(conn):
+    """Return the names of all tables with blobs"""
+    return _get_tables(conn, '_blobs')
+
+
+def _get_tables(conn, suffix):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT table_name FROM information_schema.tables
+            WHERE table_schema = current_schema()
+              AND table_name LIKE %s
+            ORDER BY table_name""", ('%' + suffix.replace('_', r'\_'),))
+        return [row[0][:-len(suffix)] for row in cur.fetchall()]
+
+
+def migrate_type_tags(conn, tables=None, expand=False, batch_size=1000):
+    """Rewrite stored documents to use the registered class aliases
+
+    With `expand` aliases are replaced by the full dotted names again, which
+    is needed before an alias can be removed. All tables holding documents
+    are migrated, unless `tables` is given. The changes are not committed.
+    Returns the number of updated documents.
+    """
+    if expand:
+        mapping = serialize.CLASS_ALIASES
+    else:
+        mapping = serialize.CLASS_ALIAS_NAMES
+    if not mapping:
+        return 0
+    if tables is None:
+        tables = get_state_tables(conn)
+    count = 0
+    for table in tables:
+        with conn.cursor('pj_migrate_type_tags') as reader:
+            reader.itersize = batch_size
+            reader.execute('SELECT sid, data FROM %s_state' % table)
+            with conn.cursor() as writer:
+                for sid, data in reader:
+                    if not convert_type_tags(data, mapping):
+                        continue
+                    writer.execute(
+                        'UPDATE %s_state SET data = %%s WHERE sid = %%s'
+                        % table, (Json(data), sid))
+                    count += 1
+    return count
+
+
+def mark_current_states(conn, tables=None):
+    """Add the `is_current` flag and its indexes to existing state tables
+
+    This is needed before `datamanager.PJ_TRACK_CURRENT_STATE` is enabled
+    for tables created without it. Only the state the document row points to
+    is flagged. All tables holding documents are migrated, unless `tables`
+    is given. The changes are not committed. Returns the number of states
+    whose flag was changed.
+    """
+    if tables is None:
+        tables = get_state_tables(conn)
+    count = 0
+    with conn.cursor() as cur:
+        for table in tables:
+            cur.execute(
+                'ALTER TABLE %s_state ADD COLUMN IF NOT EXISTS '
+                'is_current BOOLEAN NOT NULL DEFAULT FALSE' % table)
+            cur.execute('''
+                UPDATE %s_state s SET is_current = (s.tid = m.tid)
+                FROM %s m
+                WHERE m.id = s.pid AND s.is_current <> (s.tid = m.tid)
+                ''' % (table, table))
+            count += cur.rowcount
+            cur.execute(
+                'ALTER TABLE %s_state ALTER COLUMN is_current SET DEFAULT TRUE'
+                % table)
+            create_current_state_indexes(cur, table)
+    return count
+
+
+def remove_unused_blobs(conn):
+    """Delete the blobs no document state refers to anymore
+
+    Blobs of earlier states of documents are kept as long as those states
+    exist. Blobs are shared by documents storing the same data, so this
+    should not run while documents are written. The changes are not
+    committed. Returns the number of deleted blobs.
+    """
+    count = 0
+    with conn.cursor() as cur:
+        cur.execute('CREATE TEMPORARY TABLE pj_used_blobs (tbl text, id bigint)')
+        for table in get_state_tables(conn):
+            cur.execute("""
+                INSERT INTO pj_used_blobs
+                SELECT lower(ref ->> 'table'), (ref ->> 'id')::bigint
+                FROM %s_state, jsonb_path_query(
+                    data, 'strict $.**?(@._py_type == "BLOB")') AS ref
+                """ % table)
+        for table in get_blob_tables(conn):
+            cur.execute("""
+                DELETE FROM %s_blobs b WHERE NOT EXISTS (
+                    SELECT 1 FROM pj_used_blobs u
+                    WHERE u.tbl = %%s AND u.id = b.id)
+                """ % table, (table,))
+            count += cur.rowcount
+        cur.execute('DROP TABLE pj_used_blobs')
+    return count
@@ -12,11 +12,25 @@
 #
 ##############################################################################
 """Mongo-like queries for PJ"""
+import copy
 
-import json
+from pjpersist import jsoncodec
+from pjpersist import migrate
 from pjpersist import sqlbuilder as sb
 from pjpersist import serialize
 
+# Whether values naming classes that have an alias also match documents
+# still using the dotted names, see `serialize.register_class_alias()`.
+# Turn it off once `migrate.migrate_type_tags()` converted all documents.
+MATCH_DOTTED_TYPE_TAGS = True
+
+
+class QueryWriter(serialize.ObjectWriter):
+    """Serializes query values like documents, without storing anything"""
+
+    def store(self, obj, ref_only=False, _id=None):
+        raise ValueError('Unsaved objects cannot be queried for: %r' % obj)
+
 
 class Converter(object):
     """Translator for MongoDB queries -> sqlbuilder expressions.
@@ -28,9 +42,24 @@ class Converter(object):
 
     simplified = False
 
-    def __init__(self, table, field):
+    def __init__(self, table, field, jar=None):
         self.table = table
         self.field = field
+        # Values are serialized like the documents of the data manager, so
+        # that references are written in the same format.
+        self.writer = QueryWriter(jar)
+
+    def get_states(self, value):
+        """Return the serialized value and, when it names classes by their
+        alias, the form written before the alias was registered."""
+        state = self.writer.get_state(value)
+        states = [state]
+        if MATCH_DOTTED_TYPE_TAGS and serialize.CLASS_ALIASES and \
+                isinstance(state, (dict, list)):
+            dotted = copy.deepcopy(state)
+            if migrate.convert_type_tags(dotted, serialize.CLASS_ALIASES):
+                states.append(dotted)
+        return states
 
     def convert(self, query):
         clauses = []
@@ -38,8 +67,8 @@ class Converter(object):
         for key, value in sorted(query.items()):
             accessor = self.getField(doc, key, json=True)
             # some values, esp. datetime must go through PJ serialize
-            pjvalue = serialize.ObjectWriter(None).get_state(value)
-            jvalue = json.dumps(pjvalue)
+            pjvalues = self.get_states(value)
+            jvalue = jsoncodec.dumps(pjvalues[0])
 
             if key == '_id':
                 jvalue = value
@@ -65,11 +94,14 @@ class Converter(object):
                     # Let's ignore the membership case for test clarity
                     clauses.append(accessor == jvalue)
                 else:
-                    options = [
-                        accessor == jvalue,
-                        sb.JSONB_SUBSET(sb.JSONB(json.dumps([pjvalue])),
-                                        accessor)
-                    ]
+                    options = []
+                    for pjvalue in pjvalues:
+                        options += [
+                            accessor == jsoncodec.dumps(pjvalue),
+                            sb.JSONB_SUBSET(
+                                sb.JSONB(jsoncodec.dumps([pjvalue])),
+                                accessor)
+                        ]
                     if value is None:
                         options.append(sb.ISNULL(accessor))
                     clauses.append(sb.OR(*options))
@@ -97,8 +129,8 @@ class Converter(object):
     def operator_expr(self, operator, field, key, op2):
         op1 = self.getField(field, key, json=True)
         # some values, esp. datetime must go through PJ serialize
-        pjvalue = serialize.ObjectWriter(None).get_state(op2)
-        op2j = json.dumps(pjvalue)
+        pjvalues = self.get_states(op2)
+        op2j = jsoncodec.dumps(pjvalues[0])
 
         if key == '_id':
             op2j = op2
@@ -112,7 +144,8 @@ class Converter(object):
         if operator == '$lte':
             return op1 <= op2j
         if operator == '$ne':
-            return op1 != op2j
+            return sb.AND(*(op1 != jsoncodec.dumps(pjvalue)
+                            for pjvalue in pjvalues))
         if operator == '$in':
             if not op2:
                 # SQL burps on empty lists with IN:
@@ -121,8 +154,8 @@ class Converter(object):
             # implements the classic "in" (contains) and the "any" operator.
             # There is an optimization for strings:
             #      sb.JSONB_CONTAINS_ANY(op1, [unicode(e) for e in op2])
-            ops = [sb.IN(op1, [sb.JSONB(json.dumps(el)) for el in op2])]
-            ops += [sb.JSONB_SUPERSET(op1, json.dumps(el)) for el in op2]
+            ops = [sb.IN(op1, [sb.JSONB(jsoncodec.dumps(el)) for el in op2])]
+            ops += [sb.JSONB_SUPERSET(op1, jsoncodec.dumps(el)) for el in op2]
             return sb.OR(*ops)
         if operator == '$nin':
             if not op2:
@@ -133,8 +166,8 @@ class Converter(object):
             # operator.
             # There is an optimization for strings:
             #      sb.JSONB_CONTAINS_ANY(op1, [unicode(e) for e in op2])
-            ops = [sb.IN(op1, [sb.JSONB(json.dumps(el)) for el in op2]),]
-            ops += [sb.JSONB_SUPERSET(op1, json.dumps(el)) for el in op2]
+            ops = [sb.IN(op1, [sb.JSONB(jsoncodec.dumps(el)) for el in op2]),]
+            ops += [sb.JSONB_SUPERSET(op1, jsoncodec.dumps(el)) for el in op2]
             return sb.NOT(sb.OR(*ops))
         if operator == '$not':
             # MongoDB's rationalization for this operator:
@@ -155,7 +188,8 @@ class Converter(object):
         if operator == '$nany':
             return sb.NOT(sb.JSONB_CONTAINS_ANY(op1, op2))
         if operator == '$all':
-            return sb.JSONB_SUPERSET(op1, op2j)
+            return sb.OR(*(sb.JSONB_SUPERSET(op1, jsoncodec.dumps(pjvalue))
+                           for pjvalue in pjvalues))
         if operator == '$elemMatch':
             op1 = sb.NoTables(op1)
             # SELECT data FROM tbl WHERE EXISTS (
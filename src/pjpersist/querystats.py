@@ -15,18 +15,31 @@
 """Statistics on executed queries"""
 from __future__ import absolute_import
 
+import bisect
+import json
+import linecache
+import os
+import random
+import re
 import sys
+import time
 from collections import namedtuple
 
-from zope.exceptions import exceptionformatter
+from repoze.lru import LRUCache
+
+from pjpersist import interfaces
 
 
 QueryStats = namedtuple("QueryStats",
-                        ["query", "args", "time", "traceback", "database"])
+                        ["query", "args", "time", "traceback", "database",
+                         "plan"])
 
 QueryTotals = namedtuple('QueryTotals',
                          ["total_queries", "total_time", "sorted_queries"])
 
+RepeatedQuery = namedtuple('RepeatedQuery',
+                           ["query", "count", "call_site"])
+
 
 # Number of most expensive queries to print out
 NUM_OF_QUERIES_TO_REPORT = 10
@@ -36,20 +49,273 @@ REPORT_TRACEBACK = False
 # Traceback limit
 TB_LIMIT = 15  # 15 should be sufficient to figure
 
+# Fraction of queries to collect the traceback for, when reporting tracebacks
+TRACEBACK_SAMPLE_RATE = 1.0
+
+# Always collect the traceback for queries slower than this (in seconds),
+# regardless of the sample rate. None disables the threshold.
+TRACEBACK_SLOW_THRESHOLD = None
+
+# Detect N+1 query patterns: the same SELECT statement executed repeatedly
+# from the same call site within one transaction
+DETECT_N_PLUS_ONE = False
+# Number of executions from the same call site to flag a statement
+N_PLUS_ONE_THRESHOLD = 10
+# Raise NPlusOneQueryError as soon as a N+1 pattern is detected (for tests)
+RAISE_ON_N_PLUS_ONE = False
+
+# Frames from these files are pjpersist internals, the call site of a query
+# is the first frame outside of them
+PJ_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+PJ_TESTS_DIRS = (os.path.join(PJ_PACKAGE_DIR, 'tests'),
+                 os.path.join(PJ_PACKAGE_DIR, 'zope', 'tests'))
+
+# Maximum number of distinct statement fingerprints kept by the aggregated
+# report, all further statements are accounted under OVERFLOW_FINGERPRINT
+MAX_FINGERPRINTS = 500
+OVERFLOW_FINGERPRINT = '<other statements>'
+
+# Upper bounds (in seconds) of the latency histogram buckets, growing
+# geometrically from 10us to roughly 100s
+HISTOGRAM_BUCKETS = tuple(0.00001 * 1.3 ** i for i in range(62))
+
+FINGERPRINT_CACHE = LRUCache(1000)
+
+_FINGERPRINT_RULES = [
+    # string literals, including escaped quotes
+    (re.compile(r"(?:(?<!\w)[eE])?'(?:[^']|'')*'"), '?'),
+    # psycopg2 placeholders, positional and named
+    (re.compile(r"%(?:\([^)]*\))?s"), '?'),
+    # numbers, but not digits being part of identifiers
+    (re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b"), '?'),
+    # lists of values, like in IN (?, ?, ?) or array[?, ?]
+    (re.compile(r"\?(?:\s*,\s*\?)+"), '?, ...'),
+    (re.compile(r"\s+"), ' '),
+]
+
+
+def fingerprint(query):
+    """Normalize an SQL statement to its fingerprint
+
+    Literals and placeholders are replaced with `?`, so that all executions
+    of the same statement share the same fingerprint.
+    """
+    fp = FINGERPRINT_CACHE.get(query)
+    if fp is None:
+        fp = query
+        for regex, repl in _FINGERPRINT_RULES:
+            fp = regex.sub(repl, fp)
+        fp = fp.strip()
+        FINGERPRINT_CACHE.put(query, fp)
+    return fp
+
+
+class LatencyHistogram(object):
+    """Latency histogram with a fixed number of buckets
+
+    Memory usage does not depend on the number of recorded values, the
+    percentiles are approximated by the upper bound of the bucket.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        if not self.count:
+            return 0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for idx, cnt in enumerate(self.buckets):
+            seen += cnt
+            if cnt and seen >= rank:
+                break
+        if idx < len(HISTOGRAM_BUCKETS):
+            value = HISTOGRAM_BUCKETS[idx]
+        else:
+            value = self.max
+        return min(max(value, self.min), self.max)
+
+
+class FingerprintStats(object):
+    """Aggregated statistics of a single statement fingerprint"""
+
+    def __init__(self, fingerprint, database=None):
+        self.fingerprint = fingerprint
+        self.database = database
+        self.count = 0
+        self.total_time = 0
+        self.histogram = LatencyHistogram()
+        self.plan = None
+
+    @property
+    def mean(self):
+        return self.total_time / self.count if self.count else 0
+
+    def record(self, elapsed_time):
+        self.count += 1
+        self.total_time += elapsed_time
+        self.histogram.add(elapsed_time)
+
+    def __repr__(self):
+        return '<%s %r count=%s>' % (
+            self.__class__.__name__, self.fingerprint, self.count)
+
+
+# Phases of a transaction timed by TransactionTimings
+PHASES = ('serialize', 'deserialize', 'sql', 'flush', 'commit', 'vote')
+
+
+class TransactionTimings(object):
+    """Accumulate wall time and call counts per transaction phase
+
+    Phases can overlap, e.g. `flush` includes `serialize` and `sql`. Nested
+    calls of the same phase are counted, but their time is only accounted
+    for once.
+    """
+
+    def __init__(self):
+        self.counts = dict.fromkeys(PHASES, 0)
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self._depth = dict.fromkeys(PHASES, 0)
+
+    def start(self, phase):
+        depth = self._depth[phase]
+        self._depth[phase] = depth + 1
+        return time.time() if depth == 0 else None
+
+    def add(self, phase, elapsed):
+        self.counts[phase] += 1
+        self.times[phase] += elapsed
+
+    def stop(self, phase, started):
+        self._depth[phase] -= 1
+        self.counts[phase] += 1
+        if started is not None:
+            self.times[phase] += time.time() - started
+
+    def as_dict(self):
+        return {phase: {'count': self.counts[phase],
+                        'time': self.times[phase]}
+                for phase in PHASES}
+
+
+def extract_frames(frame, limit):
+    """Extract raw (filename, lineno, name, traceback_info) tuples
+
+    This is cheap compared to formatting, which is deferred to
+    `format_frames`.
+    """
+    frames = []
+    while frame is not None and len(frames) < limit:
+        code = frame.f_code
+        # Accessing f_locals is expensive, so only do it when the function
+        # sets a __traceback_info__ at all.
+        if '__traceback_info__' in code.co_varnames:
+            tbi = frame.f_locals.get('__traceback_info__')
+        else:
+            tbi = None
+        frames.append((code.co_filename, frame.f_lineno, code.co_name, tbi))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+
+_INTERNAL_FILES = {}
+
+
+def is_internal_frame(filename):
+    if filename in _INTERNAL_FILES:
+        return _INTERNAL_FILES[filename]
+    path = os.path.abspath(filename)
+    internal = (path.startswith(PJ_PACKAGE_DIR + os.sep) and
+                not path.startswith(PJ_TESTS_DIRS))
+    _INTERNAL_FILES[filename] = internal
+    return internal
+
+
+def find_call_site(frame):
+    """Return the first (filename, lineno, name) outside of pjpersist"""
+    while frame is not None:
+        code = frame.f_code
+        if not is_internal_frame(code.co_filename):
+            return (code.co_filename, frame.f_lineno, code.co_name)
+        frame = frame.f_back
+    return None
+
+
+def format_frames(frames):
+    """Format frames collected by `extract_frames` like a traceback"""
+    result = []
+    for filename, lineno, name, tbi in frames:
+        result.append('  File "%s", line %d, in %s\n' % (
+            filename, lineno, name))
+        line = linecache.getline(filename, lineno).strip()
+        if line:
+            result.append('    %s\n' % line)
+        if tbi is not None:
+            result.append('   - __traceback_info__: %s\n' % (tbi, ))
+    return ''.join(result)
+
 
 class QueryReport(object):
     def __init__(self):
         self.qlog = []
         self.report_traceback = REPORT_TRACEBACK
+        self.traceback_sample_rate = TRACEBACK_SAMPLE_RATE
+        self.traceback_slow_threshold = TRACEBACK_SLOW_THRESHOLD
+        self.detect_n_plus_one = DETECT_N_PLUS_ONE
+        self.n_plus_one_threshold = N_PLUS_ONE_THRESHOLD
+        self.raise_on_n_plus_one = RAISE_ON_N_PLUS_ONE
+        self.call_sites = {}
 
-    def record(self, query, args, elapsed_time, database=None):
+    def record(self, query, args, elapsed_time, database=None, plan=None):
         """Record executed query
 
         elapsed_time is time, elapsed by executing query, in secodes
+        plan is the JSON query plan, if the query was explained
         """
-        traceback = self._collect_traceback()
+        if self._should_collect_traceback(elapsed_time):
+            traceback = self._collect_traceback()
+        else:
+            traceback = None
         self.qlog.append(QueryStats(query, args, elapsed_time,
-                                    traceback, database))
+                                    traceback, database, plan))
+        if self.detect_n_plus_one:
+            self._record_call_site(query)
+
+    def _record_call_site(self, query):
+        fp = fingerprint(query)
+        if not fp[:6].lower() == 'select':
+            # Only reads can be N+1 queries, writes are issued per object
+            # while flushing anyway.
+            return
+        key = (fp, find_call_site(sys._getframe(2)))
+        count = self.call_sites[key] = self.call_sites.get(key, 0) + 1
+        if count == self.n_plus_one_threshold and self.raise_on_n_plus_one:
+            raise interfaces.NPlusOneQueryError(
+                RepeatedQuery(fp, count, key[1]))
+
+    def calc_repeated_queries(self):
+        """Return RepeatedQuery objects for statements executed at least
+        n_plus_one_threshold times from the same call site, most frequent
+        first.
+        """
+        found = [RepeatedQuery(fp, count, call_site)
+                 for (fp, call_site), count in self.call_sites.items()
+                 if count >= self.n_plus_one_threshold]
+        found.sort(key=lambda r: r.count, reverse=True)
+        return found
 
     def calc_totals(self):
         """Calculate totals and return QueryTotals object
@@ -78,9 +344,21 @@ class QueryReport(object):
             p("*** %s" % q.query)
             p("... ARGS: %s" % (q.args,))
             p("... TIME: %.4fms" % (q.time * 1000))
+            if q.plan is not None:
+                p("... PLAN: %s" % json.dumps(q.plan))
             if self.report_traceback and q.traceback:
-                p(q.traceback)
+                p(format_frames(q.traceback))
             p("")
+        repeated = self.calc_repeated_queries()
+        if repeated:
+            p(sep)
+            p("Possible N+1 queries:")
+            for r in repeated:
+                p("*** %s" % r.query)
+                p("... COUNT: %s" % r.count)
+                if r.call_site is not None:
+                    p('... FROM: File "%s", line %d, in %s' % r.call_site)
+                p("")
         p(sep)
         p("Queries executed: %s" % totals.total_queries)
         p("Time spent: %.4fms" % (totals.total_time * 1000))
@@ -89,14 +367,107 @@ class QueryReport(object):
 
     def clear(self):
         self.qlog = []
+        self.call_sites = {}
+
+    def _should_collect_traceback(self, elapsed_time):
+        if not self.report_traceback:
+            return False
+        threshold = self.traceback_slow_threshold
+        if threshold is not None and elapsed_time >= threshold:
+            return True
+        return random.random() < self.traceback_sample_rate
 
     def _collect_traceback(self):
-        try:
-            raise ValueError('boom')
-        except:
-            # we need here exceptionformatter, otherwise __traceback_info__
-            # is not added
-            stack = exceptionformatter.extract_stack(
-                sys.exc_info()[2].tb_frame.f_back, limit=TB_LIMIT)
-            tb = ''.join(stack[:-2])
-            return tb
+        # Skip this method, record() and the cursor method calling it.
+        frame = sys._getframe(1)
+        for i in range(2):
+            if frame.f_back is None:
+                break
+            frame = frame.f_back
+        return extract_frames(frame, TB_LIMIT)
+
+
+class AggregatedQueryReport(object):
+    """Query report aggregating statistics per statement fingerprint
+
+    Unlike `QueryReport` it does not keep the individual queries, so memory
+    usage is bounded and it can be left enabled in production.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.total_queries = 0
+        self.total_time = 0
+        # for API compatibility with QueryReport
+        self.report_traceback = False
+
+    def record(self, query, args, elapsed_time, database=None, plan=None):
+        """Record executed query
+
+        elapsed_time is time, elapsed by executing query, in secodes
+        plan is the JSON query plan, if the query was explained
+        """
+        fp = fingerprint(query)
+        stats = self.stats.get(fp)
+        if stats is None:
+            if len(self.stats) >= MAX_FINGERPRINTS:
+                fp = OVERFLOW_FINGERPRINT
+                stats = self.stats.get(fp)
+            if stats is None:
+                stats = self.stats[fp] = FingerprintStats(fp, database)
+        stats.record(elapsed_time)
+        if plan is not None:
+            # Only the most recent plan is kept to bound memory usage.
+            stats.plan = plan
+        self.total_queries += 1
+        self.total_time += elapsed_time
+
+    def calc_totals(self):
+        """Calculate totals and return QueryTotals object
+
+        The sorted_queries are FingerprintStats objects sorted by total time.
+        """
+        sorted_queries = sorted(self.stats.values(),
+                                key=lambda s: s.total_time)
+        return QueryTotals(self.total_queries, self.total_time,
+                           sorted_queries)
+
+    def calc_and_report(self):
+        """Calculate totals and print out report
+        """
+        if not self.total_queries:
+            return "Query report: no queries were executed"
+        totals = self.calc_totals()
+        sep = '-' * 60
+
+        report = []
+        p = report.append
+
+        p("Query report:")
+        p(sep)
+        p("%s most expensive statements by total time:"
+          % NUM_OF_QUERIES_TO_REPORT)
+        for s in totals.sorted_queries[-NUM_OF_QUERIES_TO_REPORT:]:
+            hist = s.histogram
+            p("*** %s" % s.fingerprint)
+            p("... COUNT: %s" % s.count)
+            p("... TOTAL: %.4fms" % (s.total_time * 1000))
+            p("... MEAN: %.4fms" % (s.mean * 1000))
+            p("... P50: %.4fms P95: %.4fms P99: %.4fms" % (
+                hist.percentile(50) * 1000,
+                hist.percentile(95) * 1000,
+                hist.percentile(99) * 1000))
+            if s.plan is not None:
+                p("... PLAN: %s" % json.dumps(s.plan))
+            p("")
+        p(sep)
+        p("Queries executed: %s" % totals.total_queries)
+        p("Distinct statements: %s" % len(totals.sorted_queries))
+        p("Time spent: %.4fms" % (totals.total_time * 1000))
+
+        return "\n".join(report)
+
+    def clear(self):
+        self.stats = {}
+        self.total_queries = 0
+        self.total_time = 0
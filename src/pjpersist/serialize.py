@@ -17,11 +17,13 @@ from __future__ import absolute_import
 import uuid
 import copy_reg
 import datetime
+import re
 
 import persistent.interfaces
 import persistent.dict
 import persistent.list
 import types
+import weakref
 import zope.interface
 from repoze.lru import LRUCache
 
@@ -30,25 +32,92 @@ from decimal import Decimal
 
 from . import interfaces
 from . import broken
+from . import isodate
 
-ALWAYS_READ_FULL_DOC = True
+# Read the complete document instead of just its class when resolving a
+# reference to a table holding several classes. The document is kept for
+# activating the object later, so this saves a query when most resolved
+# objects are used, but transfers documents that might never be needed.
+ALWAYS_READ_FULL_DOC = False
 
-SERIALIZERS = []
+
+
+def _count_change(name):
+    method = getattr(list, name)
+
+    def counted(self, *args):
+        self.version += 1
+        return method(self, *args)
+    counted.__name__ = name
+    return counted
+
+
+class SerializerList(list):
+    """A list of serializers counting its changes in `version`
+
+    `get_serializer_registry()` notices any change with a single comparison.
+    """
+
+    version = 0
+
+    __setitem__ = _count_change('__setitem__')
+    __delitem__ = _count_change('__delitem__')
+    __setslice__ = _count_change('__setslice__')
+    __delslice__ = _count_change('__delslice__')
+    __iadd__ = _count_change('__iadd__')
+    __imul__ = _count_change('__imul__')
+    append = _count_change('append')
+    extend = _count_change('extend')
+    insert = _count_change('insert')
+    pop = _count_change('pop')
+    remove = _count_change('remove')
+    reverse = _count_change('reverse')
+    sort = _count_change('sort')
+
+
+SERIALIZERS = SerializerList()
 AVAILABLE_NAME_MAPPINGS = set()
 PATH_RESOLVE_CACHE = {}
 TABLE_KLASS_MAP = {}
+# JSON keys, which are also kept in generated, indexed columns of the state
+# table. Mapping from table to {key: PostgreSQL type}, see
+# `register_promoted_fields()`.
+PROMOTED_FIELDS = {}
 DBREF_RESOLVE_CACHE = LRUCache(500)
+# Store the class of referenced objects along with the reference, so that
+# loading the reference does not need to look the class up. Documents
+# written without the class can still be read.
+DBREF_WITH_CLASS = False
+# Write references as {'_py_ref': [table, id]}, adding the database only
+# when it differs from the one of the data manager. Both formats are read.
+DBREF_COMPACT = False
+# Binary strings of at least this many bytes are stored in the
+# `<table>_blobs` table of the document instead of inside the document
+# and are loaded as `Blob` objects. None disables this.
+BLOB_THRESHOLD = None
+# Mapping from type to the way ObjectWriter serializes its instances
+SERIALIZATION_PLANS = {}
+PY_TYPE_CACHE = {}
+# Short names written into documents instead of the dotted names of classes,
+# see `register_class_alias()`. Mapping from alias to dotted name and back.
+CLASS_ALIASES = {}
+CLASS_ALIAS_NAMES = {}
+# Cache of the type tags written for classes, aliases or dotted names
+TYPE_TAG_CACHE = {}
+# `_py_type` values with a special meaning, which cannot be aliases
+RESERVED_TYPE_TAGS = frozenset(['BINARY', 'BLOB', 'DBREF', 'type'])
+# Classes whose dotted names are written and read as fixed type tags by
+# this module or the serializers of this package, which cannot get aliases
+RESERVED_CLASSES = frozenset([
+    'datetime.date', 'datetime.time', 'datetime.datetime', 'numpy.ndarray'])
 
-FMT_DATE = "%Y-%m-%d"
-FMT_TIME = "%H:%M:%S"
-FMT_DATETIME = "%Y-%m-%dT%H:%M:%S"
 
 # actually we should extract this somehow from psycopg2
 PYTHON_TO_PG_TYPES = {
     unicode: "text",
     str: "text",
     bool: "bool",
-    float: "double",
+    float: "double precision",
     int: "integer",
     long: "bigint",
     (int, long): "bigint",
@@ -75,6 +144,60 @@ def get_dotted_name(obj, escape=False, state=False):
     return name
 
 
+def get_py_type(klass):
+    """Return the dotted name of the class"""
+    try:
+        return PY_TYPE_CACHE[klass]
+    except KeyError:
+        name = PY_TYPE_CACHE[klass] = get_dotted_name(klass)
+        return name
+
+
+def get_type_tag(klass):
+    """Return the name of the class written into documents, which is its
+    alias if it has one"""
+    try:
+        return TYPE_TAG_CACHE[klass]
+    except KeyError:
+        name = get_py_type(klass)
+        tag = TYPE_TAG_CACHE[klass] = CLASS_ALIAS_NAMES.get(name, name)
+        return tag
+
+
+def register_class_alias(alias, klass):
+    """Write `alias` into documents instead of the dotted name of `klass`
+
+    `klass` can be given as object or as dotted name. Documents using the
+    dotted name can still be read. Aliases must be stable, since they are
+    stored, and they cannot contain dots, so they never clash with dotted
+    names. Built-in classes and classes whose type tags are handled by the
+    reader, the writer or a serializer cannot have an alias.
+
+    Queries compare the stored JSON, so SQL written by hand only matches
+    the documents using the form it names. Run
+    `migrate.migrate_type_tags()` after registering aliases to convert the
+    stored documents. Until then, `mquery` matches both forms for equality
+    and containment, see `mquery.MATCH_DOTTED_TYPE_TAGS`.
+    """
+    if not isinstance(klass, basestring):
+        klass = get_py_type(klass)
+    if '.' in alias or alias in RESERVED_TYPE_TAGS:
+        raise ValueError('Invalid class alias: %r' % alias)
+    if klass in RESERVED_CLASSES or klass.startswith('__builtin__.') or any(
+            klass in getattr(serializer, 'read_types', ())
+            for serializer in SERIALIZERS):
+        raise ValueError('%s cannot have an alias' % klass)
+    if CLASS_ALIASES.get(alias, klass) != klass:
+        raise ValueError('Class alias %r is already used for %s' % (
+            alias, CLASS_ALIASES[alias]))
+    if CLASS_ALIAS_NAMES.get(klass, alias) != alias:
+        raise ValueError('%s already has the alias %r' % (
+            klass, CLASS_ALIAS_NAMES[klass]))
+    CLASS_ALIASES[alias] = klass
+    CLASS_ALIAS_NAMES[klass] = alias
+    TYPE_TAG_CACHE.clear()
+
+
 class PersistentDict(persistent.dict.PersistentDict):
     _p_pj_sub_object = True
 
@@ -108,42 +231,130 @@ class PersistentList(persistent.list.PersistentList):
     _p_pj_sub_object = True
 
 
-class DBRef(object):
-    def __init__(self, table, id, database=None):
-        self._table = table
-        self._id = id
-        self._database = database
-        self.__calculate_hash()
+def _read_only(self, *args, **kw):
+    raise interfaces.ReadOnlyError(
+        '%s objects cannot be modified' % self.__class__.__name__)
 
-    def __calculate_hash(self):
-        self.hash = hash(str(self.database) + str(self.table) + str(self.id))
 
-    @property
-    def database(self):
-        return self._database
+class ReadOnlyDict(dict):
+    """A dictionary loaded as part of a read-only snapshot"""
 
-    @database.setter
-    def database(self, value):
-        self._database = value
-        self.__calculate_hash()
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
 
-    @property
-    def table(self):
-        return self._table
+    def __reduce__(self):
+        # Copies are not read-only anymore.
+        return dict, (dict(self),)
 
-    @table.setter
-    def table(self, value):
-        self._table = value
-        self.__calculate_hash()
 
-    @property
-    def id(self):
-        return self._id
+class ReadOnlyList(list):
+    """A list loaded as part of a read-only snapshot"""
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+class SnapshotJar(object):
+    """The data manager of persistent objects loaded as snapshots
+
+    Nothing is ever loaded or stored through it. It only refuses changes.
+    """
+
+    def register(self, obj):
+        raise interfaces.ReadOnlyError(
+            'Objects loaded as snapshots cannot be modified', obj)
+
+    def setstate(self, obj):
+        # Snapshots are never ghosts unless explicitly deactivated, after
+        # which their state is gone for good.
+        raise interfaces.ReadOnlyError(
+            'Objects loaded as snapshots cannot be reloaded', obj)
+
+
+SNAPSHOT_JAR = SnapshotJar()
+
+
+class LazyData(object):
+    """Converts the raw state of a lazy container on first access"""
+
+    def __get__(self, inst, klass):
+        if inst is None:
+            return self
+        data = inst._pj_convert(inst._v_pj_raw_state)
+        # Write to the instance dictionary directly, so that the container
+        # is not marked as changed and the descriptor is not used anymore.
+        inst.__dict__['data'] = data
+        del inst._v_pj_raw_state
+        del inst._v_pj_reader
+        return data
+
+
+class LazyContainerMixin(object):
+    """Keeps the raw JSONB state until the container is accessed"""
+
+    _v_pj_raw_state = None
+    _v_pj_reader = None
+    data = LazyData()
+
+    def __init__(self, state, reader, obj):
+        self._v_pj_raw_state = state
+        self._v_pj_reader = reader
+        setattr(self, interfaces.ATTR_NAME_DOC_OBJECT, obj)
+        self._p_jar = reader._jar
+        self._p_oid = 1  # set fake oid (needed for update _p_state, _p_changed)
+
+    def _pj_convert(self, state):
+        reader = self._v_pj_reader
+        obj = getattr(self, interfaces.ATTR_NAME_DOC_OBJECT)
+        orig_lazy = reader.lazyContainers
+        reader.lazyContainers = True
+        try:
+            return self._pj_convert_state(reader, state, obj)
+        finally:
+            reader.lazyContainers = orig_lazy
+
+    def __getstate__(self):
+        # Make sure the data is converted before it is pickled or copied.
+        self.data
+        return super(LazyContainerMixin, self).__getstate__()
+
 
-    @id.setter
-    def id(self, value):
-        self._id = value
-        self.__calculate_hash()
+class LazyPersistentDict(LazyContainerMixin, PersistentDict):
+
+    def _pj_convert_state(self, reader, state, obj):
+        return reader.get_dict_items(state, obj)
+
+
+class LazyPersistentList(LazyContainerMixin, PersistentList):
+
+    def _pj_convert_state(self, reader, state, obj):
+        reader._resolve_refs(state)
+        return [reader.get_object(value, obj) for value in state]
+
+
+class DBRef(object):
+    """Immutable reference to a document
+
+    References compare and hash like their (database, table, id) tuple, so
+    they can be used as cache keys directly.
+    """
+    __slots__ = ('table', 'id', 'database', '_hash')
+
+    def __init__(self, table, id, database=None):
+        object.__setattr__(self, 'table', table)
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'database', database)
+        object.__setattr__(self, '_hash', hash((database, table, id)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('DBRef is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('DBRef is immutable')
 
     def __setstate__(self, state):
         self.__init__(state['table'], state['id'], state['database'])
@@ -154,20 +365,25 @@ class DBRef(object):
                 'id': self.id}
 
     def __hash__(self):
-        return self.hash
+        return self._hash
 
     def __eq__(self, other):
-        if other is None:
+        if self is other:
+            return True
+        if not isinstance(other, DBRef) or self._hash != other._hash:
             return False
-        return self.hash == other.hash
+        return (self.id == other.id and self.table == other.table
+                and self.database == other.database)
 
-    def __neq__(self, other):
-        return self.hash != other.hash
+    def __ne__(self, other):
+        return not self.__eq__(other)
 
     def __repr__(self):
         return 'DBRef(%r, %r, %r)' % (self.table, self.id, self.database)
 
     def as_key(self):
+        # Caches are keyed by the reference itself now, this string is kept
+        # for code outside of pjpersist.
         return '%s::%s::%d' % (self.database, self.table, self.id)
 
     def as_tuple(self):
@@ -184,9 +400,94 @@ class Binary(str):
     pass
 
 
+class Blob(object):
+    """Binary data stored outside of the document
+
+    The data is kept in the `<table>_blobs` table of the document's table and
+    only loaded when needed. Blobs can be read like files. Blobs with the
+    same data share their row, see `migrate.remove_unused_blobs()` for
+    removing unused ones.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._jar = None
+        self._pos = 0
+        self.table = None
+        self.id = None
+        self.size = len(data)
+
+    @classmethod
+    def from_state(cls, jar, state):
+        blob = cls.__new__(cls)
+        blob._data = None
+        blob._jar = jar
+        blob._pos = 0
+        blob.table = state['table']
+        blob.id = state['id']
+        blob.size = state['size']
+        return blob
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._jar._read_blob(self.table, self.id)
+        return self._data
+
+    def read(self, size=-1):
+        start = self._pos
+        if size is None or size < 0 or start + size > self.size:
+            size = max(self.size - start, 0)
+        if self._data is not None:
+            chunk = self._data[start:start + size]
+        elif size:
+            chunk = self._jar._read_blob(self.table, self.id, start, size)
+        else:
+            chunk = ''
+        self._pos = start + len(chunk)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = max(offset, 0)
+
+    def tell(self):
+        return self._pos
+
+    def __len__(self):
+        return self.size
+
+    def __eq__(self, other):
+        if isinstance(other, Blob):
+            if self.id is not None and other.id is not None:
+                return (self.table, self.id) == (other.table, other.id)
+            other = other.data
+        return self.data == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<%s %s %s bytes>' % (
+            self.__class__.__name__,
+            self.id if self.id is not None else 'new', self.size)
+
+
 class ObjectSerializer(object):
     zope.interface.implements(interfaces.IObjectSerializer)
 
+    # Serializers listing the types they write and the `_py_type` tags they
+    # read are looked up directly, all others are asked via `can_write()`
+    # and `can_read()`.
+    write_types = ()
+    read_types = ()
+    # Whether the written states contain values that are serialized in
+    # turn, like `Blob`s. Such values are read back before `read()`.
+    encode_state = False
+
     def can_read(self, state):
         raise NotImplementedError
 
@@ -200,6 +501,83 @@ class ObjectSerializer(object):
         raise NotImplementedError
 
 
+class SerializerRegistry(object):
+    """Index of the given serializers by type and `_py_type` tag
+
+    The index only narrows down the candidates. They are kept in their
+    order in the list, so the first serializer that applies wins, just as
+    if the whole list was asked.
+    """
+
+    def __init__(self, serializers):
+        # The indexed list and its state, see `get_serializer_registry()`.
+        self.source = serializers
+        self.version = getattr(serializers, 'version', None)
+        self.count = len(serializers)
+        self.serializers = list(serializers)
+        self.writers = {}
+        self.readers = {}
+
+    def _candidates(self, matches, types_attr):
+        # Serializers declaring types are taken for granted when one of
+        # them matches, all others have to be asked. Nothing after the
+        # first one taken for granted can ever be reached.
+        candidates = []
+        for serializer in self.serializers:
+            types = getattr(serializer, types_attr, ())
+            if not types:
+                candidates.append((serializer, True))
+            elif matches(types):
+                candidates.append((serializer, False))
+                break
+        return candidates
+
+    def find_writer(self, obj):
+        objectType = type(obj)
+        try:
+            candidates = self.writers[objectType]
+        except KeyError:
+            # Honor inheritance, just like `isinstance()` would.
+            mro = set(getattr(objectType, '__mro__', (objectType,)))
+            candidates = self.writers[objectType] = self._candidates(
+                lambda types: not mro.isdisjoint(types), 'write_types')
+        for serializer, ask in candidates:
+            if not ask or serializer.can_write(obj):
+                return serializer
+        return None
+
+    def find_reader(self, state, py_type=None):
+        try:
+            candidates = self.readers[py_type]
+        except KeyError:
+            candidates = self.readers[py_type] = self._candidates(
+                lambda types: py_type is not None and py_type in types,
+                'read_types')
+        for serializer, ask in candidates:
+            if not ask or serializer.can_read(state):
+                return serializer
+        return None
+
+
+SERIALIZER_REGISTRY = SerializerRegistry(SERIALIZERS)
+
+
+def get_serializer_registry():
+    """Return the registry for the current list of `SERIALIZERS`
+
+    Any change of a `SerializerList` is noticed. When `SERIALIZERS` is
+    replaced by a plain list, only changes of its length are.
+    """
+    global SERIALIZER_REGISTRY
+    registry = SERIALIZER_REGISTRY
+    if registry.source is not SERIALIZERS or \
+            registry.version != getattr(SERIALIZERS, 'version', None) or \
+            registry.count != len(SERIALIZERS):
+        # The list was replaced or modified, so re-index.
+        registry = SERIALIZER_REGISTRY = SerializerRegistry(SERIALIZERS)
+    return registry
+
+
 attrs = {
     interfaces.ATTR_NAME_TABLE,
     interfaces.ATTR_NAME_SUB_OBJECT,
@@ -207,6 +585,45 @@ attrs = {
 }
 
 
+class AttrDescriptor(object):
+    """Class attribute holding a pjpersist marker per instance
+
+    The values are kept outside of the instance, so that they survive
+    ghostification and are never stored. They are keyed by `id()` to not
+    depend on the instance's `__hash__()` and dropped as soon as the
+    instance is garbage collected.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def _remove(self, ref):
+        values = self.values
+        entry = values.get(ref.key)
+        if entry is not None and entry[0] is ref:
+            del values[ref.key]
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return None
+        entry = self.values.get(id(instance))
+        if entry is None:
+            return None
+        ref, value = entry
+        # The id of a garbage collected instance can be reused.
+        if ref() is not instance:
+            return None
+        return value
+
+    def __set__(self, instance, value):
+        key = id(instance)
+        if value is None:
+            self.values.pop(key, None)
+        else:
+            self.values[key] = (
+                weakref.KeyedRef(instance, self._remove, key), value)
+
+
 def prepare_class(klass):
     """
     Adds pjpersist specific attributes to the class
@@ -218,20 +635,6 @@ def prepare_class(klass):
     except TypeError:
         return klass
 
-    class AttrDescriptor(object):
-        def __init__(self):
-            self.name = {}
-
-        def __get__(self, instance, owner):
-            path = id(instance)
-            if path not in self.name:
-                return None
-            return self.name[path]
-
-        def __set__(self, instance, value):
-            path = id(instance)
-            self.name[path] = value
-
     for attr in attrs:
         if not hasattr(klass, attr):
             setattr(klass, attr, AttrDescriptor())
@@ -244,20 +647,6 @@ def prepare_obj(obj):
     Adds pjpersist specific attributes to the class
     """
 
-    class AttrDescriptor(object):
-        def __init__(self):
-            self.name = {}
-
-        def __get__(self, instance, owner):
-            path = id(instance)
-            if path not in self.name:
-                return None
-            return self.name[path]
-
-        def __set__(self, instance, value):
-            path = id(instance)
-            self.name[path] = value
-
     klass = obj.__class__
     for attr in attrs:
         attr_value = getattr(obj, attr, None)
@@ -278,6 +667,8 @@ class ObjectWriter(object):
         :return:
         """
         self._jar = jar
+        # The persistent object whose document is being written
+        self._doc_object = None
 
     def get_table_name(self, obj):
         db_name = getattr(
@@ -297,17 +688,18 @@ class ObjectWriter(object):
         return db_name, table_name
 
     def get_non_persistent_state(self, obj, seen):
+        if not isinstance(seen, set):
+            seen = set(seen)
+        return self._walk(self._write_non_persistent(obj, seen))
+
+    def _write_non_persistent(self, obj, seen):
         # XXX: Look at the pickle library how to properly handle all types and
         # old-style classes with all of the possible pickle extensions.
 
-        # Only non-persistent, custom objects can produce unresolvable
-        # circular references.
+        # Non-persistent, custom objects and containers can produce
+        # unresolvable circular references.
         if id(obj) in seen:
             raise interfaces.CircularReferenceError(obj)
-        # Add the current object to the list of seen objects.
-        if not (type(obj) in interfaces.REFERENCE_SAFE_TYPES or
-                    getattr(obj, '_pj_reference_safe', False)):
-            seen.append(id(obj))
         # Get the state of the object. Only pickable objects can be reduced.
         reduce_fn = copy_reg.dispatch_table.get(type(obj))
         if reduce_fn is not None:
@@ -334,17 +726,41 @@ class ObjectWriter(object):
                         args == (obj.__class__, object, None):
             # This is the simple case, which means we can produce a nicer
             # JSONB output.
-            state = {'_py_type': get_dotted_name(args[0])}
+            state = {'_py_type': get_type_tag(args[0])}
+            args = None
         elif factory == copy_reg.__newobj__ and args == (obj.__class__,):
             # Another simple case for persistent objects that do not want
             # their own document.
-            state = {interfaces.ATTR_NAME_PY_TYPE: get_dotted_name(args[0])}
+            state = {interfaces.ATTR_NAME_PY_TYPE: get_type_tag(args[0])}
+            args = None
         else:
-            state = {'_py_factory': get_dotted_name(factory),
-                     '_py_factory_args': self.get_state(args, obj, seen)}
+            state = {'_py_factory': get_type_tag(factory)}
+        # The object is on the path of the objects being serialized until
+        # all of its attributes are written.
+        tracked = not (type(obj) in interfaces.REFERENCE_SAFE_TYPES or
+                       getattr(obj, '_pj_reference_safe', False))
+        if tracked:
+            seen.add(id(obj))
+        return self._write_object_state(
+            obj, state, args, obj_state, seen, tracked)
+
+    def _write_object_state(self, obj, state, args, obj_state, seen, tracked):
+        native = interfaces.PJ_NATIVE_TYPES
+        encode = self._encode
+        if args is not None:
+            args = encode(args, obj, seen)
+            if type(args) is types.GeneratorType:
+                args = yield args
+            state['_py_factory_args'] = args
         for name, value in obj_state.items():
-            state[name] = self.get_state(value, obj, seen)
-        return state
+            if type(value) not in native:
+                value = encode(value, obj, seen)
+                if type(value) is types.GeneratorType:
+                    value = yield value
+            state[name] = value
+        if tracked:
+            seen.discard(id(obj))
+        yield state
 
     def get_persistent_state(self, obj, seen):
         # Persistent sub-objects are stored by reference, the key being
@@ -359,47 +775,158 @@ class ObjectWriter(object):
             dbref = obj._p_oid
         # Create the reference sub-document. The _p_type value helps with the
         # deserialization later.
-        return dbref.as_json()
+        if not DBREF_COMPACT:
+            state = dbref.as_json()
+        elif self._jar is not None and dbref.database == self._jar.database:
+            state = {'_py_ref': [dbref.table, dbref.id]}
+        else:
+            state = {'_py_ref': [dbref.table, dbref.id, dbref.database]}
+        if DBREF_WITH_CLASS:
+            state[interfaces.ATTR_NAME_PY_TYPE] = get_type_tag(obj.__class__)
+        return state
 
     def get_state(self, obj, pobj=None, seen=None):
-        seen = seen or []
+        if type(obj) in interfaces.PJ_NATIVE_TYPES:
+            # If we have a native type, we'll just use it as the state.
+            return obj
+        if seen is None:
+            seen = set()
+        elif not isinstance(seen, set):
+            seen = set(seen)
+        return self._walk(self._encode(obj, pobj, seen))
+
+    def _walk(self, state):
+        """Complete the state returned by an encoder.
+
+        Encoders of containers and custom objects are generators. They yield
+        the generators of their sub-objects, receive the finished states of
+        those and yield their own state in the end. The generators are driven
+        from an explicit stack, so that deeply nested structures do not hit
+        the recursion limit.
+        """
+        GeneratorType = types.GeneratorType
+        if type(state) is not GeneratorType:
+            return state
+        stack = [state]
+        push = stack.append
+        pop = stack.pop
+        value = None
+        while True:
+            value = stack[-1].send(value)
+            if type(value) is GeneratorType:
+                push(value)
+                value = None
+                continue
+            # The state of the top-most encoder is complete.
+            pop()
+            if not stack:
+                return value
+
+    def _encode(self, obj, pobj, seen):
         objectType = type(obj)
         if objectType in interfaces.PJ_NATIVE_TYPES:
-            # If we have a native type, we'll just use it as the state.
             return obj
-        if isinstance(obj, str):
-            # In Python 2, strings can be ASCII, encoded unicode or binary
-            # data. Unfortunately, BSON cannot handle that. So, if we have a
-            # string that cannot be UTF-8 decoded (luckily ASCII is a valid
-            # subset of UTF-8), then we use the BSON binary type.
-            try:
-                obj.decode('utf-8')
-                return obj
-            except UnicodeError:
-                return {'_py_type': 'BINARY', 'data': obj.encode('base64')}
-        # Some objects might not naturally serialize well and create a very
-        # ugly JSONB entry. Thus, we allow custom serializers to be
-        # registered, which can encode/decode different types of objects.
-        for serializer in SERIALIZERS:
-            if serializer.can_write(obj):
+        # Look up how objects of this type get serialized, so that we do not
+        # go through all the type checks for every object.
+        try:
+            encoder, use_serializers = SERIALIZATION_PLANS[objectType]
+        except KeyError:
+            encoder, use_serializers = SERIALIZATION_PLANS[objectType] = \
+                self._compile_plan(objectType)
+        if use_serializers and SERIALIZERS:
+            # Some objects might not naturally serialize well and create a
+            # very ugly JSONB entry. Thus, we allow custom serializers to be
+            # registered, which can encode/decode different types of objects.
+            serializer = get_serializer_registry().find_writer(obj)
+            if serializer is not None:
+                if serializer.encode_state:
+                    return self._encode(serializer.write(obj), pobj, seen)
                 return serializer.write(obj)
-
+        return getattr(self, encoder)(obj, pobj, seen)
+
+    @staticmethod
+    def _compile_plan(objectType):
+        """Return the (encoder method name, use custom serializers) plan for
+        the given type"""
+        if issubclass(objectType, str):
+            return '_write_str', False
+        if issubclass(objectType, Blob):
+            return '_write_blob', False
         if objectType == datetime.date:
-            return {'_py_type': 'datetime.date',
-                    'value': obj.strftime(FMT_DATE)}
+            return '_write_date', True
         if objectType == datetime.time:
-            return {'_py_type': 'datetime.time',
-                    'value': obj.strftime(FMT_TIME)}
+            return '_write_time', True
         if objectType == datetime.datetime:
-            return {'_py_type': 'datetime.datetime',
-                    'value': obj.strftime(FMT_DATETIME)}
-
-        if isinstance(obj, (type, types.ClassType)):
-            # We frequently store class and function paths as meta-data, so we
-            # need to be able to properly encode those.
-            return {'_py_type': 'type',
-                    'path': get_dotted_name(obj)}
-
+            return '_write_datetime', True
+        if issubclass(objectType, (type, types.ClassType)):
+            return '_write_type', True
+        # Unconverted lazy containers are written as they were read.
+        if issubclass(objectType, LazyPersistentList):
+            return '_write_lazy_list', True
+        if issubclass(objectType, LazyPersistentDict):
+            return '_write_lazy_dict', True
+        # Builtin sequences and mappings cannot be sub-objects.
+        if objectType in (tuple, list):
+            return '_write_list', True
+        if objectType is dict:
+            return '_write_dict', True
+        if issubclass(objectType, (tuple, list, PersistentList)):
+            return '_write_sub_list', True
+        if issubclass(objectType, (dict, PersistentDict)):
+            return '_write_sub_dict', True
+        if issubclass(objectType, persistent.Persistent):
+            return '_write_persistent', True
+        return '_write_object', True
+
+    def _write_str(self, obj, pobj, seen):
+        # In Python 2, strings can be ASCII, encoded unicode or binary
+        # data. Unfortunately, BSON cannot handle that. So, if we have a
+        # string that cannot be UTF-8 decoded (luckily ASCII is a valid
+        # subset of UTF-8), then we use the BSON binary type.
+        try:
+            obj.decode('utf-8')
+            return obj
+        except UnicodeError:
+            if BLOB_THRESHOLD is not None and len(obj) >= BLOB_THRESHOLD:
+                return self._write_blob(Blob(obj), pobj, seen)
+            return {'_py_type': 'BINARY', 'data': obj.encode('base64')}
+
+    def _write_blob(self, obj, pobj, seen):
+        if obj.id is None:
+            # Blobs are stored with the document, even when they belong to
+            # one of its sub-objects.
+            doc_obj = self._doc_object if self._doc_object is not None \
+                else pobj
+            if self._jar is None or doc_obj is None:
+                # We have nowhere to store the data.
+                return {'_py_type': 'BINARY', 'data': obj.data.encode('base64')}
+            db_name, table = self.get_table_name(doc_obj)
+            obj.id = self._jar._insert_blob(table, obj.data)
+            obj.table = table
+            obj._jar = self._jar
+            self._jar._inserted_blobs.append(obj)
+        return {'_py_type': 'BLOB', 'table': obj.table, 'id': obj.id,
+                'size': obj.size}
+
+    def _write_date(self, obj, pobj, seen):
+        return {'_py_type': 'datetime.date',
+                'value': isodate.format_date(obj)}
+
+    def _write_time(self, obj, pobj, seen):
+        return {'_py_type': 'datetime.time',
+                'value': isodate.format_time(obj)}
+
+    def _write_datetime(self, obj, pobj, seen):
+        return {'_py_type': 'datetime.datetime',
+                'value': isodate.format_datetime(obj)}
+
+    def _write_type(self, obj, pobj, seen):
+        # We frequently store class and function paths as meta-data, so we
+        # need to be able to properly encode those.
+        return {'_py_type': 'type',
+                'path': get_type_tag(obj)}
+
+    def _prepare_sub_object(self, obj, pobj):
         # We need to make sure that the object's jar and doc-object are
         # set. This is important for the case when a sub-object was just
         # added.
@@ -409,46 +936,138 @@ class ObjectWriter(object):
                                 getattr(pobj, '_p_jar', None) is not None:
                     obj._p_jar = pobj._p_jar
                 setattr(obj, interfaces.ATTR_NAME_DOC_OBJECT, pobj)
-
-        if isinstance(obj, (tuple, list, PersistentList)):
-            # Make sure that all values within a list are serialized
-            # correctly. Also convert any sequence-type to a simple list.
-            return [self.get_state(value, pobj, seen) for value in obj]
-        if isinstance(obj, (dict, PersistentDict)):
-            # Same as for sequences, make sure that the contained values are
-            # properly serialized.
-            # Note: A big constraint in JSONB is that keys must be strings!
-            has_non_string_key = False
-            data = []
-            for key, value in obj.items():
-                data.append((key, self.get_state(value, pobj, seen)))
-                has_non_string_key |= not isinstance(key, basestring)
-                if (not isinstance(key, basestring) or '\0' in key):
-                    has_non_string_key = True
-            if not has_non_string_key:
-                # The easy case: all keys are strings:
-                return dict(data)
-            else:
+            return True
+        return False
+
+    def _write_list(self, obj, pobj, seen):
+        # Make sure that all values within a list are serialized
+        # correctly. Also convert any sequence-type to a simple list.
+        native = interfaces.PJ_NATIVE_TYPES
+        for value in obj:
+            if type(value) not in native:
+                return self._write_list_items(obj, pobj, seen)
+        # Lists of native values are by far the most common ones, so they
+        # are copied right away.
+        return list(obj)
+
+    def _write_list_items(self, obj, pobj, seen):
+        # Containers are on the path of the objects being serialized too, so
+        # that containers including themselves are detected.
+        if id(obj) in seen:
+            raise interfaces.CircularReferenceError(obj)
+        seen.add(id(obj))
+        native = interfaces.PJ_NATIVE_TYPES
+        encode = self._encode
+        GeneratorType = types.GeneratorType
+        state = []
+        append = state.append
+        for value in obj:
+            if type(value) not in native:
+                value = encode(value, pobj, seen)
+                if type(value) is GeneratorType:
+                    value = yield value
+            append(value)
+        seen.discard(id(obj))
+        yield state
+
+    def _write_sub_list(self, obj, pobj, seen):
+        self._prepare_sub_object(obj, pobj)
+        return self._write_list(obj, pobj, seen)
+
+    def _write_dict(self, obj, pobj, seen):
+        # Same as for sequences, make sure that the contained values are
+        # properly serialized.
+        # Note: A big constraint in JSONB is that keys must be strings!
+        native = interfaces.PJ_NATIVE_TYPES
+        for key, value in obj.iteritems():
+            if type(value) not in native or \
+                    not isinstance(key, basestring) or '\0' in key:
+                return self._write_dict_items(obj, pobj, seen)
+        return dict(obj.iteritems())
+
+    def _write_dict_items(self, obj, pobj, seen):
+        if id(obj) in seen:
+            raise interfaces.CircularReferenceError(obj)
+        seen.add(id(obj))
+        native = interfaces.PJ_NATIVE_TYPES
+        encode = self._encode
+        GeneratorType = types.GeneratorType
+        data = {}
+        items = obj.iteritems()
+        for key, value in items:
+            if type(value) not in native:
+                value = encode(value, pobj, seen)
+                if type(value) is GeneratorType:
+                    value = yield value
+            if not isinstance(key, basestring) or '\0' in key:
                 # We first need to reduce the keys and then produce a data
                 # structure.
-                data = [(self.get_state(key, pobj), value)
-                        for key, value in data]
-                return {'dict_data': data}
-
-        if isinstance(obj, persistent.Persistent):
-            # Only create a persistent reference, if the object does not want
-            # to be a sub-document.
-            if not getattr(obj, interfaces.ATTR_NAME_SUB_OBJECT, False):
-                return self.get_persistent_state(obj, seen)
-                # This persistent object is a sub-document, so it is treated like
-                # a non-persistent object.
-
-        return self.get_non_persistent_state(obj, seen)
+                data = data.items()
+                data.append((key, value))
+                for key, value in items:
+                    if type(value) not in native:
+                        value = encode(value, pobj, seen)
+                        if type(value) is GeneratorType:
+                            value = yield value
+                    data.append((key, value))
+                state = []
+                for key, value in data:
+                    if type(key) not in native:
+                        key = encode(key, pobj, seen)
+                        if type(key) is GeneratorType:
+                            key = yield key
+                    state.append((key, value))
+                seen.discard(id(obj))
+                yield {'dict_data': state}
+                return
+            # The easy case: all keys are strings:
+            data[key] = value
+        seen.discard(id(obj))
+        yield data
+
+    def _write_sub_dict(self, obj, pobj, seen):
+        self._prepare_sub_object(obj, pobj)
+        return self._write_dict(obj, pobj, seen)
+
+    def _write_lazy_list(self, obj, pobj, seen):
+        self._prepare_sub_object(obj, pobj)
+        if obj._v_pj_raw_state is not None:
+            return obj._v_pj_raw_state
+        return self._write_list(obj, pobj, seen)
+
+    def _write_lazy_dict(self, obj, pobj, seen):
+        self._prepare_sub_object(obj, pobj)
+        if obj._v_pj_raw_state is not None:
+            return obj._v_pj_raw_state
+        return self._write_dict(obj, pobj, seen)
+
+    def _write_persistent(self, obj, pobj, seen):
+        # Only create a persistent reference, if the object does not want
+        # to be a sub-document.
+        if self._prepare_sub_object(obj, pobj):
+            # This persistent object is a sub-document, so it is treated
+            # like a non-persistent object.
+            return self._write_non_persistent(obj, seen)
+        return self.get_persistent_state(obj, seen)
+
+    def _write_object(self, obj, pobj, seen):
+        self._prepare_sub_object(obj, pobj)
+        return self._write_non_persistent(obj, seen)
+
+    def _get_doc_state(self, obj):
+        # Sub-objects know the document they are written for. Referenced
+        # objects that are not stored yet are written in between.
+        doc_object = self._doc_object
+        self._doc_object = obj
+        try:
+            return self.get_state(obj.__getstate__(), obj)
+        finally:
+            self._doc_object = doc_object
 
     def get_full_state(self, obj):
-        doc = self.get_state(obj.__getstate__(), obj)
+        doc = self._get_doc_state(obj)
         # Always add a persistent type info
-        doc[interfaces.ATTR_NAME_PY_TYPE] = get_dotted_name(obj.__class__)
+        doc[interfaces.ATTR_NAME_PY_TYPE] = get_py_type(obj.__class__)
         # Return the full state document
         return doc
 
@@ -470,17 +1089,21 @@ class ObjectWriter(object):
         else:
             # XXX: Handle newargs; see ZODB.serialize.ObjectWriter.serialize
             # Go through each attribute and search for persistent references.
-            doc = self.get_state(obj.__getstate__(), obj)
+            started = self._jar._timing_start('serialize')
+            try:
+                doc = self._get_doc_state(obj)
+            finally:
+                self._jar._timing_stop('serialize', started)
 
         # Always add a persistent type info
-        py_type_attr_name = get_dotted_name(obj.__class__)
+        py_type_attr_name = get_py_type(obj.__class__)
         doc[interfaces.ATTR_NAME_PY_TYPE] = py_type_attr_name
 
         stored = False
         txn_id = self._jar.get_transaction_id()
         if interfaces.IColumnSerialization.providedBy(obj):
             self._jar._ensure_sql_columns(obj, table_name)
-            column_data = obj._pj_get_column_fields()
+            column_data = self._jar._get_column_data(obj, doc)
         else:
             column_data = None
         if obj._p_oid is None:
@@ -492,7 +1115,7 @@ class ObjectWriter(object):
 
             # Make sure that any other code accessing this object in this
             # session, gets the same instance.
-            self._jar._object_cache[obj._p_oid.as_key()] = obj
+            self._jar._object_cache[obj._p_oid] = obj
         else:
             self._jar._update_doc(
                 db_name, table_name, doc, obj._p_oid.id, column_data)
@@ -506,7 +1129,7 @@ class ObjectWriter(object):
         doc[interfaces.ATTR_NAME_PY_TYPE] = py_type_attr_name
         if stored:
             setattr(obj, interfaces.ATTR_NAME_TX_ID, txn_id)
-        DBREF_RESOLVE_CACHE.put(obj._p_oid.as_key(), obj.__class__)
+        DBREF_RESOLVE_CACHE.put(obj._p_oid, obj.__class__)
         return obj._p_oid
 
 
@@ -516,8 +1139,14 @@ class ObjectReader(object):
     def __init__(self, jar):
         self._jar = jar
         self.preferPersistent = True
+        # Set while loading objects that want their nested dicts and lists
+        # to be converted on first access only.
+        self.lazyContainers = False
+        # Set while loading read-only snapshots, see `get_snapshot()`.
+        self.snapshot = False
 
     def simple_resolve(self, path, use_broken=True):
+        path = CLASS_ALIASES.get(path, path)
         path = path.replace('_dot_', '.')
         path = path[1:] if path.startswith('u_') else path
         # We try to look up the klass from a cache. The important part here is
@@ -543,9 +1172,11 @@ class ObjectReader(object):
 
     def resolve(self, dbref, no_cache=False, use_broken=True):
 
-        # 0. Use DBREF_RESOLVE_CACHE
+        # 0. Use the classes found by `resolve_many()` and DBREF_RESOLVE_CACHE
         if not no_cache:
-            klass = DBREF_RESOLVE_CACHE.get(dbref.as_key())
+            klass = getattr(self._jar, '_resolved_classes', {}).get(dbref)
+            if klass is None:
+                klass = DBREF_RESOLVE_CACHE.get(dbref)
             if klass is not None:
                 return prepare_class(klass)
 
@@ -556,7 +1187,7 @@ class ObjectReader(object):
             if len(results) == 1:
                 # there must be just ONE, otherwise we need to check the JSONB
                 klass = list(results)[0]
-                DBREF_RESOLVE_CACHE.put(dbref.as_key(), klass)
+                DBREF_RESOLVE_CACHE.put(dbref, klass)
                 return prepare_class(klass)
 
         # from this point on we need the dbref.id
@@ -573,11 +1204,16 @@ class ObjectReader(object):
             # place so that unghostifying the object later will not cause
             # another database access.
             obj_doc = self._jar._get_doc_by_dbref(dbref)
+            if obj_doc is not None and \
+                    dbref not in self._jar._object_cache:
+                self._jar._latest_states[dbref] = obj_doc
         else:
             # Just read the type from the database, still requires one query
             pytype = self._jar._get_doc_py_type(
                 dbref.database, dbref.table, dbref.id)
-            obj_doc = {interfaces.ATTR_NAME_PY_TYPE: pytype}
+            obj_doc = None
+            if pytype is not None:
+                obj_doc = {interfaces.ATTR_NAME_PY_TYPE: pytype}
         if obj_doc is None:
             # There is no document for this reference in the database.
             if use_broken:
@@ -592,9 +1228,66 @@ class ObjectReader(object):
                 return broken.Broken
             else:
                 raise ImportError(dbref)
-        DBREF_RESOLVE_CACHE.put(dbref.as_key(), klass)
+        DBREF_RESOLVE_CACHE.put(dbref, klass)
         return prepare_class(klass)
 
+    def resolve_many(self, dbrefs):
+        """Resolve the classes of many references at once
+
+        The classes are looked up with one query per table and kept by the
+        data manager until the end of the transaction, where `resolve()`
+        finds them. They are not put into `DBREF_RESOLVE_CACHE`, which is too
+        small to hold all of them for long lists.
+        """
+        jar = self._jar
+        resolved = jar._resolved_classes
+        by_table = {}
+        for dbref in dbrefs:
+            if dbref.id is None or dbref.database != jar.database \
+                    or dbref in jar._object_cache or dbref in resolved \
+                    or DBREF_RESOLVE_CACHE.get(dbref) is not None:
+                continue
+            klasses = TABLE_KLASS_MAP.get(dbref.table)
+            if klasses is not None and len(klasses) == 1:
+                continue
+            by_table.setdefault(dbref.table, []).append(dbref)
+        for table, refs in by_table.iteritems():
+            if len(refs) == 1:
+                # Not worth a batch, `resolve()` will do.
+                continue
+            py_types = jar._get_doc_py_types(
+                jar.database, table, [dbref.id for dbref in refs])
+            for dbref in refs:
+                pytype = py_types.get(dbref.id)
+                if pytype is None:
+                    continue
+                klass = self.simple_resolve(pytype)
+                if klass is not broken.Broken:
+                    resolved[dbref] = klass
+
+    def get_dbref(self, state):
+        """Return the reference stored in either reference format"""
+        ref = state.get('_py_ref')
+        if ref is None:
+            return DBRef(state['table'], state['id'], state['database'])
+        if len(ref) > 2:
+            return DBRef(ref[0], ref[1], ref[2])
+        database = self._jar.database if self._jar is not None else None
+        return DBRef(ref[0], ref[1], database)
+
+    def _resolve_refs(self, states):
+        # Resolve the references among the given states in one go, instead
+        # of one query per reference.
+        if self._jar is None:
+            return
+        dbrefs = [self.get_dbref(state)
+                  for state in states
+                  if type(state) is dict
+                  and (state.get('_py_type') == 'DBREF' or '_py_ref' in state)
+                  and interfaces.ATTR_NAME_PY_TYPE not in state]
+        if len(dbrefs) > 1:
+            self.resolve_many(dbrefs)
+
     def get_non_persistent_object(self, state, obj):
         if '_py_constant' in state:
             klass = self.simple_resolve(state['_py_constant'])
@@ -626,8 +1319,12 @@ class ObjectReader(object):
                 # we risk to store this object in its own table next time.
                 setattr(sub_obj, interfaces.ATTR_NAME_SUB_OBJECT, True)
         if getattr(sub_obj, interfaces.ATTR_NAME_SUB_OBJECT, False):
-            setattr(sub_obj, interfaces.ATTR_NAME_DOC_OBJECT, obj)
-            sub_obj._p_jar = self._jar
+            if self.snapshot:
+                # Attach it to a jar refusing all changes.
+                sub_obj._p_jar = SNAPSHOT_JAR
+            else:
+                setattr(sub_obj, interfaces.ATTR_NAME_DOC_OBJECT, obj)
+                sub_obj._p_jar = self._jar
             sub_obj._p_oid = 1  # set fake oid (needed for update _p_state, _p_changed)
         return sub_obj
 
@@ -643,28 +1340,45 @@ class ObjectReader(object):
                 # Binary data in Python 2 is presented as a string. We will
                 # convert back to binary when serializing again.
                 return state['data'].decode('base64')
-            if state_py_type == 'DBREF':
+            if state_py_type == 'BLOB':
+                # The data is only loaded when needed.
+                return Blob.from_state(self._jar, state)
+            if state_py_type == 'DBREF' or (
+                    state_py_type is None and '_py_ref' in state):
                 # Load a persistent object. Using the _jar.load() method to make
                 # sure we're loading from right database and caching is properly
                 # applied.
-                dbref = DBRef(state['table'], state['id'], state['database'])
-                return self._jar.load(dbref)
+                dbref = self.get_dbref(state)
+                klass = None
+                pytype = state.get(interfaces.ATTR_NAME_PY_TYPE)
+                if pytype is not None:
+                    klass = self.simple_resolve(pytype)
+                    if klass is broken.Broken:
+                        # The class has moved, look it up the usual way.
+                        klass = None
+                return self._jar.load(dbref, klass)
             if state_py_type == 'type':
                 # Convert a simple object reference, mostly classes.
                 return self.simple_resolve(state['path'])
             if state_py_type == 'datetime.date':
-                return datetime.datetime.strptime(
-                    state['value'], FMT_DATE).date()
+                return isodate.parse_date(state['value'])
             if state_py_type == 'datetime.time':
-                return datetime.datetime.strptime(
-                    state['value'], FMT_TIME).time()
+                return isodate.parse_time(state['value'])
             if state_py_type == 'datetime.datetime':
-                return datetime.datetime.strptime(
-                    state['value'], FMT_DATETIME)
+                return isodate.parse_datetime(state['value'])
+        else:
+            state_py_type = None
 
         # Give the custom serializers a chance to weigh in.
-        for serializer in SERIALIZERS:
-            if serializer.can_read(state):
+        if SERIALIZERS:
+            serializer = get_serializer_registry().find_reader(
+                state, state_py_type)
+            if serializer is not None:
+                if serializer.encode_state:
+                    state = dict(
+                        (key, self.get_object(value, obj)
+                         if isinstance(value, dict) else value)
+                        for key, value in state.items())
                 return serializer.read(state)
 
         if stateIsDict and (
@@ -675,9 +1389,16 @@ class ObjectReader(object):
             # Load a non-persistent object.
             return self.get_non_persistent_object(state, obj)
         if isinstance(state, (tuple, list)):
+            if self.snapshot:
+                self._resolve_refs(state)
+                return ReadOnlyList(
+                    [self.get_object(value, obj) for value in state])
+            if self.lazyContainers and self.preferPersistent:
+                return LazyPersistentList(state, self, obj)
             # All lists are converted to persistent lists, so that their state
             # changes are noticed. Also make sure that all value states are
             # converted to objects.
+            self._resolve_refs(state)
             sub_obj = [self.get_object(value, obj) for value in state]
             if self.preferPersistent:
                 sub_obj = PersistentList(sub_obj)
@@ -686,17 +1407,14 @@ class ObjectReader(object):
                 sub_obj._p_oid = 1
             return sub_obj
         if stateIsDict:
+            if self.snapshot:
+                return self.get_dict_items(state, obj)
+            if self.lazyContainers and self.preferPersistent:
+                return LazyPersistentDict(state, self, obj)
             # All dictionaries are converted to persistent dictionaries, so
             # that state changes are detected. Also convert all value states
             # to objects.
-            # Handle non-string key dicts.
-            if 'dict_data' in state:
-                items = state['dict_data']
-            else:
-                items = state.items()
-            sub_obj = dict(
-                [(self.get_object(name, obj), self.get_object(value, obj))
-                 for name, value in items])
+            sub_obj = self.get_dict_items(state, obj)
             if self.preferPersistent:
                 sub_obj = PersistentDict(sub_obj)
                 setattr(sub_obj, interfaces.ATTR_NAME_DOC_OBJECT, obj)
@@ -705,6 +1423,60 @@ class ObjectReader(object):
             return sub_obj
         return state
 
+    def get_dict_items(self, state, obj):
+        """Convert the state of a mapping to a dictionary"""
+        # Handle non-string key dicts.
+        if 'dict_data' in state:
+            items = state['dict_data']
+        else:
+            items = state.items()
+        self._resolve_refs([value for name, value in items])
+        factory = ReadOnlyDict if self.snapshot else dict
+        return factory(
+            [(self.get_object(name, obj), self.get_object(value, obj))
+             for name, value in items])
+
+    def get_snapshot(self, state, obj=None):
+        """Convert the state to an object that cannot be modified.
+
+        Dictionaries and lists become `ReadOnlyDict` and `ReadOnlyList`
+        objects. Persistent sub-objects are attached to `SNAPSHOT_JAR`
+        instead of the data manager, so changing them raises as well.
+        """
+        orig_snapshot = self.snapshot
+        self.snapshot = True
+        try:
+            return self.get_object(state, obj)
+        finally:
+            self.snapshot = orig_snapshot
+
+    def get_snapshot_object(self, dbref, doc):
+        """Load the document of a persistent object as a read-only snapshot.
+
+        The object is attached to `SNAPSHOT_JAR` and not cached by the data
+        manager, so loading the same document normally is not affected.
+        """
+        doc = dict(doc)
+        pytype = doc.pop(interfaces.ATTR_NAME_PY_TYPE, None)
+        if pytype is not None:
+            klass = self.simple_resolve(pytype)
+        else:
+            klass = self.resolve(dbref)
+        obj = klass.__new__(klass)
+        orig_snapshot = self.snapshot
+        self.snapshot = True
+        try:
+            # `__setstate__()` may change the state it gets.
+            state = dict(self.get_dict_items(doc, obj))
+        finally:
+            self.snapshot = orig_snapshot
+        obj.__setstate__(state)
+        obj._p_jar = SNAPSHOT_JAR
+        obj._p_oid = dbref
+        if interfaces.IPersistentSerializationHooks.providedBy(obj):
+            obj._pj_after_load_hook(self._jar._conn)
+        return obj
+
     def set_ghost_state(self, obj, doc=None):
         # # Check whether the object state was stored on the object itself.
         if doc is None:
@@ -715,23 +1487,43 @@ class ObjectReader(object):
         # Check that we really have a state doc now.
         if doc is None:
             raise ImportError(obj._p_oid)
-        # Remove unwanted attributes.
-        pytype = doc.pop(interfaces.ATTR_NAME_PY_TYPE)
-
-        # Now convert the document to a proper Python state dict.
-        state = dict(self.get_object(doc, obj))
-
-        # Sometimes this method is called to update the object state
-        # before storage.
-        doc[interfaces.ATTR_NAME_PY_TYPE] = pytype
-        # Set the state.
-        obj.__setstate__(state)
+        started = self._jar._timing_start('deserialize')
+        try:
+            # Remove unwanted attributes.
+            pytype = doc.pop(interfaces.ATTR_NAME_PY_TYPE, None)
+
+            # Now convert the document to a proper Python state dict.
+            orig_lazy = self.lazyContainers
+            orig_snapshot = self.snapshot
+            self.snapshot = getattr(self._jar, 'snapshot', False)
+            self.lazyContainers = getattr(
+                obj, interfaces.ATTR_NAME_LAZY_CONTAINERS, False)
+            try:
+                if self.snapshot:
+                    # `__setstate__()` may change the state it gets.
+                    state = dict(self.get_dict_items(doc, obj))
+                elif self.lazyContainers:
+                    state = self.get_dict_items(doc, obj)
+                else:
+                    state = dict(self.get_object(doc, obj))
+            finally:
+                self.lazyContainers = orig_lazy
+                self.snapshot = orig_snapshot
+
+            # Sometimes this method is called to update the object state
+            # before storage.
+            if pytype is not None:
+                doc[interfaces.ATTR_NAME_PY_TYPE] = pytype
+            # Set the state.
+            obj.__setstate__(state)
+        finally:
+            self._jar._timing_stop('deserialize', started)
         # Run the custom load functions.
         if interfaces.IPersistentSerializationHooks.providedBy(obj):
             obj._pj_after_load_hook(self._jar._conn)
 
     def get_ghost(self, dbref, klass=None):
-        obj = self._jar._object_cache.get(dbref.as_key(), None)
+        obj = self._jar._object_cache.get(dbref, None)
         if obj is not None:
             return obj
         if klass is None:
@@ -748,20 +1540,22 @@ class ObjectReader(object):
         setattr(obj, interfaces.ATTR_NAME_DATABASE, dbref.database)
         setattr(obj, interfaces.ATTR_NAME_TABLE, dbref.table)
         setattr(obj, interfaces.ATTR_NAME_TX_ID, None)
-        self._jar._object_cache[dbref.as_key()] = obj
+        self._jar._object_cache[dbref] = obj
         return obj
 
     def load(self, data, table, _id, database=None):
         if database is None:
             database = self._jar.database
         dbref = DBRef(table, _id, database)
-        obj = self._jar._object_cache.get(dbref.as_key(), None)
+        obj = self._jar._object_cache.get(dbref, None)
         if obj is not None:
+            if obj._p_changed is None:
+                # A ghost, so we can spare the query for its state.
+                self._jar._latest_states[dbref] = data['data']
             return obj
         pytype = data['data'].get(interfaces.ATTR_NAME_PY_TYPE, None)
         if pytype is None:
             pytype = data['package'] + '.' + data['class_name']
-            data['data'][interfaces.ATTR_NAME_PY_TYPE] = pytype
         klass = self.simple_resolve(pytype)
         obj = klass.__new__(klass)
         obj._p_jar = self._jar
@@ -772,8 +1566,12 @@ class ObjectReader(object):
         setattr(obj, interfaces.ATTR_NAME_DATABASE, dbref.database)
         setattr(obj, interfaces.ATTR_NAME_TABLE, dbref.table)
         setattr(obj, interfaces.ATTR_NAME_TX_ID, data['tid'])
-        self.set_ghost_state(obj, data['data'])
-        self._jar._object_cache[dbref.as_key()] = obj
+        self._jar._object_cache[dbref] = obj
+        # The state is set by the data manager from the fetched document,
+        # either right away or when the object is first accessed.
+        self._jar._latest_states[dbref] = data['data']
+        if not self._jar.defer_load:
+            obj._p_activate()
         return obj
 
 
@@ -786,8 +1584,9 @@ class table:
     otherwise class lookup always needs the JSONB data from PG
     """
 
-    def __init__(self, table_name):
+    def __init__(self, table_name, promoted_fields=None):
         self.table_name = table_name
+        self.promoted_fields = promoted_fields
 
     def __call__(self, ob):
         try:
@@ -796,4 +1595,84 @@ class table:
         except AttributeError:
             raise TypeError(
                 "Can't declare %s" % interfaces.ATTR_NAME_TABLE, ob)
+        if self.promoted_fields:
+            register_promoted_fields(self.table_name, self.promoted_fields)
         return ob
+
+
+PROMOTED_KEY = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+# Types of promoted fields. Their text input is immutable, as generated
+# columns require. Dates and times are not, as they depend on the settings
+# of the session.
+PROMOTED_TYPES = ('text', 'boolean', 'smallint', 'integer', 'bigint',
+                  'numeric', 'real', 'double precision')
+
+
+def register_promoted_fields(table_name, fields):
+    """Keep JSON keys of the documents in the table in typed columns.
+
+    `fields` maps keys, or dotted paths of nested keys, to PostgreSQL types.
+    The data manager creates a generated column and indexes for each of them
+    with the table, or in `create_tables()` for existing tables. Values
+    that do not convert to the type are NULL in the column. Queries reading
+    the text of a key with the `text` type use the column instead.
+    Generated columns need PostgreSQL 12 or later.
+    """
+    promoted = PROMOTED_FIELDS.setdefault(table_name, {})
+    for key, pgtype in fields.items():
+        pgtype = pgtype.lower()
+        if not PROMOTED_KEY.match(key) or pgtype not in PROMOTED_TYPES:
+            raise ValueError('Invalid promoted field: %r %r' % (key, pgtype))
+        promoted[key] = pgtype
+
+
+def get_promoted_column_name(key):
+    return 'data_' + key.replace('.', '_')
+
+
+def get_column_fields(table_name, shared=False):
+    """Return the IColumnSerialization columns of a table.
+
+    The columns of the classes declared with `table` are returned as a
+    mapping from name to PostgreSQL type. With `shared` only the columns
+    written by all of the classes are returned.
+    """
+    columns = {}
+    for index, klass in enumerate(TABLE_KLASS_MAP.get(table_name, ())):
+        if interfaces.IColumnSerialization.implementedBy(klass):
+            fields = dict(
+                (field.__name__, PYTHON_TO_PG_TYPES[field._type])
+                for field in klass._pj_column_fields)
+        else:
+            fields = {}
+        if not shared or not index:
+            columns.update(fields)
+        else:
+            columns = dict(
+                (name, pgtype) for name, pgtype in columns.items()
+                if fields.get(name) == pgtype)
+    return columns
+
+
+def get_query_column(table_name, keys):
+    """Return the column name and type holding the value of a JSON key.
+
+    `keys` is a key or a sequence of nested keys. Promoted fields and
+    IColumnSerialization columns are considered. The latter only when all
+    classes of the table write them, since other documents leave them NULL.
+    None is returned when the value is only kept in the document.
+    """
+    if table_name.endswith('_state'):
+        table_name = table_name[:-len('_state')]
+    if not isinstance(keys, basestring):
+        if not all(isinstance(key, basestring) for key in keys):
+            return None
+        keys = '.'.join(keys)
+    pgtype = PROMOTED_FIELDS.get(table_name, {}).get(keys)
+    if pgtype is not None:
+        return get_promoted_column_name(keys), pgtype
+    if TABLE_KLASS_MAP.get(table_name):
+        pgtype = get_column_fields(table_name, shared=True).get(keys)
+        if pgtype is not None:
+            return keys, pgtype
+    return None
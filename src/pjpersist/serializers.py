@@ -13,62 +13,113 @@
 ##############################################################################
 """Python Serializers for common objects with weird reduce output."""
 import datetime
-from pjpersist import serialize
+from pjpersist import isodate, serialize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class DateSerializer(serialize.ObjectSerializer):
 
-    fmt = "%Y-%m-%d"
+    write_types = (datetime.date,)
+    read_types = ('datetime.date',)
 
     def can_read(self, state):
         return isinstance(state, dict) and \
                state.get('_py_type') == 'datetime.date'
 
     def read(self, state):
-        return datetime.datetime.strptime(state['value'], self.fmt).date()
+        return isodate.parse_date(state['value'])
 
     def can_write(self, obj):
         return isinstance(obj, datetime.date)
 
     def write(self, obj):
         return {'_py_type': 'datetime.date',
-                'value': obj.strftime(self.fmt)}
+                'value': isodate.format_date(obj)}
 
 
 class TimeSerializer(serialize.ObjectSerializer):
 
-    fmt = "%H:%M:%S"
+    write_types = (datetime.time,)
+    read_types = ('datetime.time',)
 
     def can_read(self, state):
         return isinstance(state, dict) and \
                state.get('_py_type') == 'datetime.time'
 
     def read(self, state):
-        return datetime.datetime.strptime(state['value'], self.fmt).time()
+        return isodate.parse_time(state['value'])
 
     def can_write(self, obj):
         return isinstance(obj, datetime.time)
 
     def write(self, obj):
         return {'_py_type': 'datetime.time',
-                'value': obj.strftime(self.fmt)}
+                'value': isodate.format_time(obj)}
 
 
 class DateTimeSerializer(serialize.ObjectSerializer):
 
-    # XXX: timezone?
-    fmt = "%Y-%m-%dT%H:%M:%S"
+    write_types = (datetime.datetime,)
+    read_types = ('datetime.datetime',)
 
     def can_read(self, state):
         return isinstance(state, dict) and \
                state.get('_py_type') == 'datetime.datetime'
 
     def read(self, state):
-        return datetime.datetime.strptime(state['value'], self.fmt)
+        return isodate.parse_datetime(state['value'])
 
     def can_write(self, obj):
         return isinstance(obj, datetime.datetime)
 
     def write(self, obj):
         return {'_py_type': 'datetime.datetime',
-                'value': obj.strftime(self.fmt)}
+                'value': isodate.format_datetime(obj)}
+
+
+class NDArraySerializer(serialize.ObjectSerializer):
+    """Store numpy arrays as dtype, shape and raw buffer
+
+    The buffer is stored as a `Blob` in the blobs table of the document and
+    loaded with `numpy.frombuffer()`, so no per-element conversion happens
+    either way. Arrays of Python objects and subclasses of `numpy.ndarray`
+    are left to the regular serialization, which is why the written type is
+    not declared. Without numpy the serializer does not write anything.
+    """
+
+    read_types = ('numpy.ndarray',)
+    encode_state = True
+
+    def can_read(self, state):
+        return isinstance(state, dict) and \
+               state.get('_py_type') == 'numpy.ndarray'
+
+    def read(self, state):
+        if numpy is None:
+            raise ImportError('numpy is required to load stored arrays')
+        dtype = state['dtype']
+        if isinstance(dtype, list):
+            # Structured dtype description
+            dtype = [tuple(field) for field in dtype]
+        data = state['data']
+        if isinstance(data, serialize.Blob):
+            data = data.data
+        data = bytearray(data)
+        return numpy.frombuffer(data, dtype=numpy.dtype(dtype)).reshape(
+            state['shape'])
+
+    def can_write(self, obj):
+        return numpy is not None and type(obj) is numpy.ndarray and \
+            not obj.dtype.hasobject
+
+    def write(self, obj):
+        dtype = obj.dtype
+        return {'_py_type': 'numpy.ndarray',
+                'dtype': dtype.descr if dtype.fields else dtype.str,
+                'shape': list(obj.shape),
+                'data': serialize.Blob(
+                    numpy.ascontiguousarray(obj).tostring())}
@@ -18,6 +18,8 @@ from sqlbuilder.smartsql import Q, T, compile as parent_comile, Expr, NamedCondi
     PLACEHOLDER, Name, Result, MetaTable, MetaField, FieldProxy, factory, same, \
     LOOKUP_SEP, Field, string_types, Comparable, Table, TableJoin
 
+from . import datamanager, serialize
+
 compile = parent_comile.create_child()
 
 
@@ -317,7 +319,11 @@ class PJMappedVirtualTable(MetaTable("NewBase", (object, ), {})):
 def compile_mapped_table(compile, expr, state):
     mt = expr._mapping.get_table_object(ttype='mt')
     st = expr._mapping.get_table_object(ttype='st')
-    compile(TableJoin(mt).inner_join(st).on((mt.id == st.pid) & (mt.tid == st.tid)), state)
+    if datamanager.PJ_TRACK_CURRENT_STATE:
+        cond = (mt.id == st.pid) & st.is_current
+    else:
+        cond = (mt.id == st.pid) & (mt.tid == st.tid)
+    compile(TableJoin(mt).inner_join(st).on(cond), state)
 
 
 @compile.when(JsonbDataField)
@@ -338,5 +344,12 @@ def compile_jsonb_datafield(compile, expr, state):
         compile(st.data, state)
         return
 
+    # Text values also kept in a column are read from there.
+    column = serialize.get_query_column(
+        expr._prefix._mapping.table, expr._name)
+    if column is not None and column[1] == 'text':
+        compile(getattr(st, column[0]), state)
+        return
+
     # default
     compile(st.data.jsonb_item_text(expr._name), state)
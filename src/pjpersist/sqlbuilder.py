@@ -12,10 +12,12 @@
 #
 ##############################################################################
 """SQLBuilder extensions"""
-import json, re
+import re
 
 from sqlobject.sqlbuilder import *
 
+from pjpersist import jsoncodec, serialize
+
 
 ########################################
 ## Postgres JSON operators
@@ -101,6 +103,9 @@ def JSON_GETITEM(json, key):
     return SQLOp("->", json, key)
 
 def JSON_GETITEM_TEXT(json, key):
+    column = _text_column(json, [key])
+    if column is not None:
+        return column
     return SQLOp("->>", json, key)
 
 def JSON_PATH(json, keys):
@@ -109,8 +114,24 @@ def JSON_PATH(json, keys):
 
 def JSON_PATH_TEXT(json, keys):
     """keys is an SQL array"""
+    column = _text_column(json, keys)
+    if column is not None:
+        return column
     return SQLOp("#>>", json, PGArrayLiteral(keys))
 
+def _text_column(json, keys):
+    """Return the text column holding the value of a JSON key, if any.
+
+    Only text columns hold exactly what `->>` returns. Other types would
+    change the outcome of comparisons.
+    """
+    if not isinstance(json, Field) or json.fieldName != 'data':
+        return None
+    column = serialize.get_query_column(json.tableName, keys)
+    if column is None or column[1] != 'text':
+        return None
+    return Field(json.tableName, column[0])
+
 def JSONB_SUPERSET(superset, subset):
     return SQLOp("@>", superset, subset)
 
@@ -179,25 +200,25 @@ class JGET(object):
         self.selector = selector
 
     def __lt__(self, other):
-        return SQLOp("<", self, JSONB(json.dumps(other)))
+        return SQLOp("<", self, JSONB(jsoncodec.dumps(other)))
     def __le__(self, other):
-        return SQLOp("<=", self, JSONB(json.dumps(other)))
+        return SQLOp("<=", self, JSONB(jsoncodec.dumps(other)))
     def __gt__(self, other):
-        return SQLOp(">", self, JSONB(json.dumps(other)))
+        return SQLOp(">", self, JSONB(jsoncodec.dumps(other)))
     def __ge__(self, other):
-        return SQLOp(">=", self, JSONB(json.dumps(other)))
+        return SQLOp(">=", self, JSONB(jsoncodec.dumps(other)))
     def __eq__(self, other):
-        return SQLOp("=", self, JSONB(json.dumps(other)))
+        return SQLOp("=", self, JSONB(jsoncodec.dumps(other)))
     def __ne__(self, other):
-        return SQLOp("<>", self, JSONB(json.dumps(other)))
+        return SQLOp("<>", self, JSONB(jsoncodec.dumps(other)))
     def __and__(self, other):
-        return SQLOp("AND", self, JSONB(json.dumps(other)))
+        return SQLOp("AND", self, JSONB(jsoncodec.dumps(other)))
     def __rand__(self, other):
-        return SQLOp("AND", JSONB(json.dumps(other), self))
+        return SQLOp("AND", JSONB(jsoncodec.dumps(other), self))
     def __or__(self, other):
-        return SQLOp("OR", self, JSONB(json.dumps(other)))
+        return SQLOp("OR", self, JSONB(jsoncodec.dumps(other)))
     def __ror__(self, other):
-        return SQLOp("OR", JSONB(json.dumps(other), self))
+        return SQLOp("OR", JSONB(jsoncodec.dumps(other), self))
     def __invert__(self):
         return SQLPrefix("NOT", self)
 
@@ -14,6 +14,7 @@
 """Mongo Persistence Testing Support"""
 from __future__ import absolute_import
 import atexit
+import contextlib
 import doctest
 import logging
 import psycopg2
@@ -31,6 +32,7 @@ import zope.component
 from zope.testing import module, renormalizing
 
 from pjpersist import datamanager, serialize, serializers, interfaces
+from pjpersist import querystats
 
 checker = renormalizing.RENormalizing([
     # Date/Time objects
@@ -111,7 +113,7 @@ def cleanDB(conn=None):
 
 
 def setUpSerializers(test):
-    serialize.SERIALIZERS = []
+    serialize.SERIALIZERS = serialize.SerializerList()
 
 
 def tearDownSerializers(test):
@@ -223,6 +225,12 @@ def resetCaches():
     serialize.AVAILABLE_NAME_MAPPINGS.__init__()
     serialize.PATH_RESOLVE_CACHE = {}
     serialize.TABLE_KLASS_MAP = {}
+    serialize.PROMOTED_FIELDS = {}
+    datamanager.CHECKED_SQL_COLUMNS.clear()
+    serialize.DBREF_RESOLVE_CACHE.clear()
+    serialize.SERIALIZATION_PLANS = {}
+    serialize.PY_TYPE_CACHE = {}
+    serialize.TYPE_TAG_CACHE = {}
 
 
 def log_sql_to_file(fname, add_tb=True, tb_limit=15):
@@ -231,7 +239,8 @@ def log_sql_to_file(fname, add_tb=True, tb_limit=15):
     datamanager.PJ_ENABLE_QUERY_STATS = True
     datamanager.PJ_ACCESS_LOGGING = True
     datamanager.TABLE_LOG.setLevel(logging.DEBUG)
-    datamanager.PJPersistCursor.TB_LIMIT = tb_limit
+    querystats.REPORT_TRACEBACK = add_tb
+    querystats.TB_LIMIT = tb_limit
 
     fh = logging.FileHandler(fname)
     fh.setLevel(logging.DEBUG)
@@ -241,6 +250,43 @@ def log_sql_to_file(fname, add_tb=True, tb_limit=15):
     datamanager.TABLE_LOG.addHandler(fh)
 
 
+@contextlib.contextmanager
+def raise_on_n_plus_one(dm, threshold=None):
+    """Raise NPlusOneQueryError when a N+1 query pattern is detected
+
+    Use it to guard code under test against loading objects one by one:
+
+        with testing.raise_on_n_plus_one(dm, threshold=5):
+            names = [person.name for person in people]
+    """
+    if threshold is None:
+        threshold = querystats.N_PLUS_ONE_THRESHOLD
+    saved = (datamanager.PJ_ENABLE_QUERY_STATS,
+             querystats.DETECT_N_PLUS_ONE,
+             querystats.RAISE_ON_N_PLUS_ONE,
+             querystats.N_PLUS_ONE_THRESHOLD)
+    datamanager.PJ_ENABLE_QUERY_STATS = True
+    querystats.DETECT_N_PLUS_ONE = True
+    querystats.RAISE_ON_N_PLUS_ONE = True
+    querystats.N_PLUS_ONE_THRESHOLD = threshold
+    # The data manager might already have a report for this transaction.
+    report = dm._query_report
+    report.detect_n_plus_one = True
+    report.raise_on_n_plus_one = True
+    report.n_plus_one_threshold = threshold
+    try:
+        yield
+    finally:
+        (datamanager.PJ_ENABLE_QUERY_STATS,
+         querystats.DETECT_N_PLUS_ONE,
+         querystats.RAISE_ON_N_PLUS_ONE,
+         querystats.N_PLUS_ONE_THRESHOLD) = saved
+        report = dm._query_report
+        report.detect_n_plus_one = querystats.DETECT_N_PLUS_ONE
+        report.raise_on_n_plus_one = querystats.RAISE_ON_N_PLUS_ONE
+        report.n_plus_one_threshold = querystats.N_PLUS_ONE_THRESHOLD
+
+
 class StdoutHandler(logging.StreamHandler):
     """Logging handler that follows the current binding of sys.stdout."""
 
@@ -0,0 +1,90 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Reference format speed test, creates the test database"""
+import optparse
+import persistent
+import transaction
+from timeit import timeit
+
+from pjpersist import datamanager, jsoncodec, serialize, testing
+
+LOOPS = 100
+SIZE = 1000
+
+
+@serialize.table('tag')
+class Tag(persistent.Persistent):
+
+    def __init__(self, name):
+        self.name = name
+
+
+FORMATS = [
+    # (title, DBREF_COMPACT)
+    ('DBREF', False),
+    ('compact', True),
+]
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-l', '--loops', dest='loops', type='int', default=LOOPS,
+        help='Number of loops per test.')
+    parser.add_option(
+        '-s', '--size', dest='size', type='int', default=SIZE,
+        help='Number of references in the list.')
+    options, args = parser.parse_args(args)
+
+    testing.setUpSerializers(None)
+    testing.createDB()
+    conn = testing.getConnection(testing.DBNAME)
+    dm = datamanager.PJDataManager(conn)
+    tags = [Tag(u'tag %i' % i) for i in range(options.size)]
+    for tag in tags:
+        dm.insert(tag)
+    transaction.commit()
+
+    writer = serialize.ObjectWriter(dm)
+    reader = serialize.ObjectReader(dm)
+
+    def store():
+        return jsoncodec.dumps(writer.get_state(tags))
+
+    def load(data):
+        # Make sure the ghosts get created again.
+        dm._object_cache.clear()
+        return reader.get_object(jsoncodec.loads(data), None)
+
+    print "Running tests (%d LOOPS, %d references each)" % (
+        options.loops, options.size)
+    print '%-10s %12s %12s %12s' % (
+        'Format', 'Bytes', 'Store secs', 'Load secs')
+    orig_compact = serialize.DBREF_COMPACT
+    try:
+        for title, compact in FORMATS:
+            serialize.DBREF_COMPACT = compact
+            data = store()
+            stime = timeit(store, number=options.loops)
+            ltime = timeit(lambda: load(data), number=options.loops)
+            print '%-10s %12d %12.4f %12.4f' % (title, len(data), stime, ltime)
+    finally:
+        serialize.DBREF_COMPACT = orig_compact
+        transaction.abort()
+        conn.close()
+        testing.dropDB()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ import pprint
 from timeit import timeit
 
 from pjpersist.tests import random_data
+from pjpersist import jsoncodec
 from pjpersist import testing
 from pjpersist import serialize
 
@@ -53,6 +54,14 @@ tests = [
     #('msgpack-python-0.3.0', 'import msgpack; %s' % setup_msgpack, 'msgpack.dumps(d)', 'msgpack.loads(src)'),
 ]
 
+# The codecs pjpersist can be configured with, see jsoncodec.set_codec()
+for name in sorted(jsoncodec.CODECS):
+    tests.append(
+        ('pjpersist %s' % name,
+         'from pjpersist import jsoncodec; '
+         'dumps, loads = jsoncodec.CODECS[%r]; %s' % (name, setup_json),
+         'dumps(d)', 'loads(src)'))
+
 def main():
     enc_table = []
     dec_table = []
@@ -61,6 +70,11 @@ def main():
     print "Data repr length: %d" % len(setup)
 
     for title, mod, enc, dec in tests:
+        try:
+            exec mod in {}
+        except ImportError:
+            print title, "(not installed)"
+            continue
         print title
 
         print "  [Encode]", enc
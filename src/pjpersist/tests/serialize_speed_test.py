@@ -0,0 +1,110 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Object serialization speed test, no database required"""
+import datetime
+import optparse
+from timeit import timeit
+
+from pjpersist.tests import random_data
+from pjpersist import testing
+from pjpersist import serialize
+
+LOOPS = 200
+
+
+class Address(object):
+
+    def __init__(self, city, zip):
+        self.city = city
+        self.zip = zip
+
+
+class Person(object):
+
+    def __init__(self, name, age):
+        self.name = name
+        self.age = age
+        self.address = Address(u'Boston', '02134')
+        self.phones = [u'+1 617 555 %04i' % i for i in range(3)]
+        self.data = random_data.BIGDICT
+
+
+class AddressBook(object):
+
+    def __init__(self, size):
+        self.addresses = [Address(u'Boston', '%05i' % i) for i in range(size)]
+
+
+PEOPLE = [Person(u'Person %i' % i, i) for i in range(100)]
+
+TIMESTAMPS = [
+    {'action': u'login',
+     'created': datetime.datetime(2014, 1, 1) + datetime.timedelta(minutes=i),
+     'day': datetime.date(2014, 1, 1) + datetime.timedelta(days=i % 365)}
+    for i in range(1000)]
+
+# 100k small containers, nested a few levels deep
+NESTED = [
+    {u'group': i,
+     u'items': [{u'id': j, u'tags': [u'a', u'b'], u'pos': (i, j)}
+                for j in range(100)]}
+    for i in range(1000)]
+
+
+def write(obj):
+    return serialize.ObjectWriter(None).get_state(obj)
+
+
+def read(state):
+    reader = serialize.ObjectReader(None)
+    return reader.get_object(state, None)
+
+
+def read_snapshot(state):
+    return serialize.ObjectReader(None).get_snapshot(state)
+
+
+DATA = [
+    # (title, object)
+    ('BIGDICT', random_data.BIGDICT),
+    ('HUGEDICT', random_data.HUGEDICT),
+    ('100 Persons', PEOPLE),
+    ('1000 Timestamps', TIMESTAMPS),
+    ('100k Nested', NESTED),
+    ('10k Sub-objects', AddressBook(10000)),
+]
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '-l', '--loops', dest='loops', type='int', default=LOOPS,
+        help='Number of loops per test.')
+    options, args = parser.parse_args(args)
+
+    testing.setUpSerializers(None)
+
+    print "Running tests (%d LOOPS each)" % options.loops
+    print '%-25s %12s %12s %14s' % (
+        'Data', 'Write secs', 'Read secs', 'Snapshot secs')
+    for title, obj in DATA:
+        state = write(obj)
+        wtime = timeit(lambda: write(obj), number=options.loops)
+        rtime = timeit(lambda: read(state), number=options.loops)
+        stime = timeit(lambda: read_snapshot(state), number=options.loops)
+        print '%-25s %12.4f %12.4f %14.4f' % (title, wtime, rtime, stime)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@
 """PJ Data Manager Tests"""
 import doctest
 import persistent
+import psycopg2
+import re
 import unittest
 import logging
 from pprint import pprint
@@ -23,6 +25,7 @@ import mock
 from zope.testing import module
 
 from pjpersist import interfaces, serialize, testing, datamanager
+from pjpersist import sqlbuilder as sb
 
 
 class Root(persistent.Persistent):
@@ -1245,6 +1248,497 @@ def doctest_cache():
     """
 
 
+def doctest_raise_on_n_plus_one():
+    """Loading objects one by one in a loop is detected
+
+      >>> dm.root.foos = [Foo('foo-%i' % i) for i in range(5)]
+      >>> transaction.commit()
+
+      >>> foos = dm.root.foos
+      >>> with testing.raise_on_n_plus_one(dm, threshold=3):
+      ...     names = [foo.name for foo in foos]
+      Traceback (most recent call last):
+      ...
+      NPlusOneQueryError: RepeatedQuery(query='SELECT m.tid, ...', count=3,
+          call_site=('<doctest ...>', 2, '<module>'))
+
+    A few loads stay below the threshold:
+
+      >>> transaction.abort()
+      >>> foos = dm.root.foos
+      >>> with testing.raise_on_n_plus_one(dm, threshold=10):
+      ...     names = [foo.name for foo in foos]
+      >>> names
+      [u'foo-0', u'foo-1', u'foo-2', u'foo-3', u'foo-4']
+
+    The detection is turned off afterwards:
+
+      >>> dm._query_report.detect_n_plus_one
+      False
+      >>> datamanager.PJ_ENABLE_QUERY_STATS
+      False
+    """
+
+
+def doctest_explain_slow_queries():
+    """Slow queries get explained
+
+      >>> dm.root.foo = Foo('one')
+      >>> transaction.commit()
+
+      >>> log = testing.setUpLogging(datamanager.TABLE_LOG, level=logging.INFO)
+      >>> with mock.patch('pjpersist.datamanager.PJ_EXPLAIN_SLOW_QUERY_TIME', 0), \\
+      ...      mock.patch('pjpersist.datamanager.PJ_ENABLE_QUERY_STATS', True):
+      ...     dm.root.foo.name
+      u'one'
+
+    The plan is attached to the query statistics:
+
+      >>> stats = dm._query_report.qlog[-1]
+      >>> print stats.query
+      SELECT m.tid, ...
+      >>> stats.plan
+      [{u'Plan': {...}}]
+
+    And it is logged too:
+
+      >>> print log.getvalue()
+      Slow query ...
+       plan:[{"Plan": {...}}]
+      ...
+      >>> testing.tearDownLogging(datamanager.TABLE_LOG)
+
+    Statements which cannot be explained are just skipped:
+
+      >>> with mock.patch('pjpersist.datamanager.PJ_EXPLAIN_SLOW_QUERY_TIME', 0), \\
+      ...      mock.patch('pjpersist.datamanager.PJ_ENABLE_QUERY_STATS', True):
+      ...     with dm.getCursor() as cur:
+      ...         cur.execute('SHOW transaction_isolation')
+      ...         print cur.fetchone()[0]
+      serializable
+      >>> print dm._query_report.qlog[-1].plan
+      None
+
+    Failing to explain a query, for example when the savepoint cannot be
+    created, is logged and does not affect the query:
+
+      >>> broken = mock.Mock()
+      >>> broken.cursor().execute.side_effect = psycopg2.OperationalError(
+      ...     'SAVEPOINT can only be used in transaction blocks')
+      >>> log = testing.setUpLogging(datamanager.LOG, level=logging.WARNING)
+      >>> with mock.patch('pjpersist.datamanager.PJ_EXPLAIN_SLOW_QUERY_TIME', 0), \\
+      ...      mock.patch.object(datamanager.PJPersistCursor, 'connection',
+      ...                        property(lambda cur: broken)):
+      ...     with dm.getCursor() as cur:
+      ...         cur.execute('SELECT 42')
+      ...         print cur.fetchone()[0]
+      42
+      >>> print log.getvalue()
+      Failed to explain SELECT 42
+      Traceback (most recent call last):
+      ...
+      OperationalError: SAVEPOINT can only be used in transaction blocks
+      >>> testing.tearDownLogging(datamanager.LOG)
+    """
+
+
+def doctest_PJDataManager_last_timings():
+    """Time spent per transaction phase is available after the transaction
+
+      >>> dm.last_timings is None
+      True
+
+      >>> dm.root.foo = Foo('one')
+      >>> transaction.commit()
+
+      >>> timings = dm.last_timings
+      >>> sorted(timings)
+      ['commit', 'deserialize', 'flush', 'serialize', 'sql', 'vote']
+      >>> timings['commit']
+      {'count': 1, 'time': ...}
+      >>> timings['vote']['count']
+      1
+      >>> timings['serialize']['count'] >= 2
+      True
+      >>> timings['sql']['count'] > 0 and timings['sql']['time'] > 0
+      True
+
+    Loading objects is accounted as deserialization:
+
+      >>> dm.root.foo.name
+      u'one'
+      >>> transaction.commit()
+      >>> dm.last_timings['deserialize']['count'] >= 2
+      True
+      >>> dm.last_timings['serialize']['count']
+      0
+
+    Timings can be turned off:
+
+      >>> with mock.patch('pjpersist.datamanager.PJ_COLLECT_TIMINGS', False):
+      ...     transaction.abort()
+      ...     dm.root.foo.name
+      ...     transaction.commit()
+      u'one'
+      >>> dm.last_timings['deserialize']['count'] >= 2
+      True
+      >>> dm._timings is None
+      True
+      >>> transaction.abort()
+    """
+
+
+def doctest_PJDataManager_promoted_fields():
+    """Promoted fields are kept in generated, indexed columns
+
+      >>> @serialize.table('person', promoted_fields={
+      ...     'name': 'text', 'age': 'integer', 'address.city': 'text'})
+      ... class Person(persistent.Persistent):
+      ...     def __init__(self, name, age, city):
+      ...         self.name = name
+      ...         self.age = age
+      ...         self.address = {'city': city}
+
+      >>> dm.insert(Person(u'Stephan', 34, u'Boston'))
+      DBRef('person', ..., 'pjpersist_test')
+      >>> dm.insert(Person(u'Roy', 28, u'Hartford'))
+      DBRef('person', ..., 'pjpersist_test')
+
+      >>> cur = dm.getCursor()
+      >>> cur.execute(
+      ...     'SELECT data_name, data_age, data_address_city '
+      ...     'FROM person_state ORDER BY data_age')
+      >>> [tuple(row) for row in cur.fetchall()]
+      [(u'Roy', 28, u'Hartford'), (u'Stephan', 34, u'Boston')]
+
+      >>> cur.execute(
+      ...     "SELECT indexname FROM pg_indexes WHERE tablename = "
+      ...     "'person_state' AND indexname LIKE 'person_data_%' "
+      ...     "ORDER BY indexname")
+      >>> print ' '.join(row[0] for row in cur.fetchall())
+      person_data_address_city person_data_address_city_jsonb
+      person_data_age person_data_age_jsonb
+      person_data_gin
+      person_data_name person_data_name_jsonb
+
+    Reading the text of a promoted text field uses the column:
+
+      >>> name = sb.JSON_GETITEM_TEXT(sb.Field('person_state', 'data'), 'name')
+      >>> print sb.sqlrepr(name, 'postgres')
+      person_state.data_name
+      >>> city = sb.JSON_PATH_TEXT(
+      ...     sb.Field('person_state', 'data'), ['address', 'city'])
+      >>> print sb.sqlrepr(city, 'postgres')
+      person_state.data_address_city
+
+    Other types are not used, since they compare differently:
+
+      >>> age = sb.JSON_GETITEM_TEXT(sb.Field('person_state', 'data'), 'age')
+      >>> print sb.sqlrepr(age, 'postgres')
+      ((person_state.data) ->> ('age'))
+
+    Both the columns and the JSONB values of the keys are indexed:
+
+      >>> def explain(where):
+      ...     cur.execute('SET enable_seqscan = off')
+      ...     cur.execute('EXPLAIN SELECT data FROM person_state WHERE %s'
+      ...                 % sb.sqlrepr(where, 'postgres'))
+      ...     plan = ' '.join(row[0] for row in cur.fetchall())
+      ...     cur.execute('RESET enable_seqscan')
+      ...     print re.findall('(?:Index Scan using|Index Scan on) (\\w+)', plan)
+      >>> explain(name == 'Roy')
+      [u'person_data_name']
+      >>> explain(sb.JGET(sb.Field('person_state', 'data'), 'age') > 30)
+      [u'person_data_age_jsonb']
+
+    Values that do not convert to the type of the column are NULL there,
+    instead of failing to write the document:
+
+      >>> dm.insert(Person(u'Adam', u'n/a', u'Boston'))
+      DBRef('person', ..., 'pjpersist_test')
+      >>> dm.insert(Person(u'Albertas', 34.5, u'Boston'))
+      DBRef('person', ..., 'pjpersist_test')
+      >>> cur.execute(
+      ...     'SELECT data_name, data_age FROM person_state ORDER BY sid')
+      >>> [tuple(row) for row in cur.fetchall()]
+      [(u'Stephan', 34), (u'Roy', 28), (u'Adam', None), (u'Albertas', None)]
+
+    Existing tables get the columns in `create_tables()`:
+
+      >>> serialize.register_promoted_fields('person', {'nick': 'text'})
+      >>> dm.create_tables('person')
+      >>> cur = dm.getCursor()
+      >>> cur.execute('SELECT data_nick FROM person_state')
+      >>> cur.fetchall()
+      [[None], [None], [None], [None]]
+
+    Keys and types are checked, since they become part of SQL statements:
+
+      >>> serialize.register_promoted_fields('person', {"a'b": 'text'})
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid promoted field: "a'b" 'text'
+
+    Only types that convert from text independently of the session can be
+    used in generated columns:
+
+      >>> serialize.register_promoted_fields('person', {'born': 'date'})
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid promoted field: 'born' 'date'
+    """
+
+
+def doctest_PJDataManager_column_serialization():
+    """IColumnSerialization columns are created, checked and indexed
+
+      >>> import zope.schema
+      >>> from pjpersist.persistent import SimpleColumnSerialization
+
+      >>> @serialize.table('colperson')
+      ... class ColumnPerson(SimpleColumnSerialization,
+      ...                    persistent.Persistent):
+      ...     _pj_column_fields = (
+      ...         zope.schema.TextLine(__name__='name'),
+      ...         zope.schema.Int(__name__='age'))
+      ...     def __init__(self, name, age):
+      ...         self.name = name
+      ...         self.age = age
+
+      >>> dm.insert(ColumnPerson(u'Stephan', 34))
+      DBRef('colperson', ..., 'pjpersist_test')
+
+      >>> cur = dm.getCursor()
+      >>> cur.execute('SELECT name, age FROM colperson_state')
+      >>> [tuple(row) for row in cur.fetchall()]
+      [(u'Stephan', 34L)]
+      >>> cur.execute(
+      ...     "SELECT indexname FROM pg_indexes "
+      ...     "WHERE tablename = 'colperson_state' ORDER BY indexname")
+      >>> print ' '.join(row[0] for row in cur.fetchall())
+      colperson_age colperson_data_gin colperson_name colperson_pid_tid_unique
+      colperson_state_pkey
+
+    The columns are checked once per table only:
+
+      >>> with mock.patch.object(dm, '_create_doc_table') as create:
+      ...     dm.insert(ColumnPerson(u'Roy', 28))
+      DBRef('colperson', ..., 'pjpersist_test')
+      >>> create.called
+      False
+
+    Missing columns are added to existing tables. Text columns are filled
+    from the documents, also the ones written before. Adam's city is a
+    class default, which is not part of his document:
+
+      >>> albert = ColumnPerson(u'Albert', 50)
+      >>> albert.city = u'Paris'
+      >>> dm.insert(albert)
+      DBRef('colperson', ..., 'pjpersist_test')
+
+      >>> ColumnPerson._pj_column_fields += (
+      ...     zope.schema.TextLine(__name__='city'),)
+      >>> ColumnPerson.city = u'Boston'
+      >>> dm.insert(ColumnPerson(u'Adam', 40))
+      DBRef('colperson', ..., 'pjpersist_test')
+      >>> cur.execute('SELECT name, city FROM colperson_state ORDER BY sid')
+      >>> [tuple(row) for row in cur.fetchall()]
+      [(u'Stephan', None), (u'Roy', None), (u'Albert', u'Paris'),
+       (u'Adam', None)]
+
+    The checked columns are remembered once the transaction is committed:
+
+      >>> transaction.commit()
+      >>> sorted(datamanager.CHECKED_SQL_COLUMNS[
+      ...     ('pjpersist_test', 'colperson')])
+      ['age', 'city', 'name']
+
+    Queries reading the text of the key use the column, with the same
+    results as reading the document:
+
+      >>> data = sb.Field('colperson_state', 'data')
+      >>> city = sb.JSON_GETITEM_TEXT(data, 'city')
+      >>> print sb.sqlrepr(city, 'postgres')
+      colperson_state.city
+      >>> doc_city = sb.SQLOp('->>', data, 'city')
+
+      >>> def names(where):
+      ...     cur = dm.getCursor()
+      ...     cur.execute(sb.sqlrepr(sb.Select(
+      ...         sb.Field('colperson_state', 'name'), where=where,
+      ...         orderBy=sb.Field('colperson_state', 'sid')), 'postgres'))
+      ...     return [row[0] for row in cur.fetchall()]
+      >>> names(city == u'Boston'), names(city == u'Paris')
+      ([], [u'Albert'])
+      >>> names(doc_city == u'Boston'), names(doc_city == u'Paris')
+      ([], [u'Albert'])
+      >>> names(sb.ISNULL(city)) == names(sb.ISNULL(doc_city))
+      True
+
+    Columns added in an aborted transaction are checked again:
+
+      >>> ColumnPerson._pj_column_fields += (
+      ...     zope.schema.TextLine(__name__='zip'),)
+      >>> ColumnPerson.zip = None
+      >>> adam = ColumnPerson(u'Adam', 40)
+      >>> adam.zip = u'02134'
+      >>> dm.insert(adam)
+      DBRef('colperson', ..., 'pjpersist_test')
+      >>> dm.reset()
+      >>> sorted(datamanager.CHECKED_SQL_COLUMNS[
+      ...     ('pjpersist_test', 'colperson')])
+      ['age', 'city', 'name']
+      >>> adam = ColumnPerson(u'Adam', 40)
+      >>> adam.zip = u'02134'
+      >>> dm.insert(adam)
+      DBRef('colperson', ..., 'pjpersist_test')
+      >>> cur = dm.getCursor()
+      >>> cur.execute('SELECT name, zip FROM colperson_state')
+      >>> [tuple(row) for row in cur.fetchall()]
+      [(u'Stephan', None), (u'Roy', None), (u'Albert', None),
+       (u'Adam', None), (u'Adam', u'02134')]
+      >>> dm.reset()
+
+    Columns of the wrong type are reported:
+
+      >>> cur = dm.getCursor()
+      >>> cur.execute('ALTER TABLE colperson_state ALTER age TYPE text')
+      >>> datamanager.CHECKED_SQL_COLUMNS.clear()
+      >>> dm.insert(ColumnPerson(u'Albertas', 40))
+      Traceback (most recent call last):
+      ...
+      TypeError: Column age of colperson_state has type text instead of bigint
+
+    Queries reading the text of a key use its text column:
+
+      >>> name = sb.JSON_GETITEM_TEXT(
+      ...     sb.Field('colperson_state', 'data'), 'name')
+      >>> print sb.sqlrepr(name, 'postgres')
+      colperson_state.name
+      >>> age = sb.JSON_GETITEM_TEXT(
+      ...     sb.Field('colperson_state', 'data'), 'age')
+      >>> print sb.sqlrepr(age, 'postgres')
+      ((colperson_state.data) ->> ('age'))
+
+    Documents of other classes in the table do not fill the column, so it
+    is only used when all classes of the table write it:
+
+      >>> @serialize.table('colperson')
+      ... class Robot(persistent.Persistent):
+      ...     pass
+      >>> name = sb.JSON_GETITEM_TEXT(
+      ...     sb.Field('colperson_state', 'data'), 'name')
+      >>> print sb.sqlrepr(name, 'postgres')
+      ((colperson_state.data) ->> ('name'))
+    """
+
+
+def doctest_PJDataManager_current_state():
+    """The current states of documents can be flagged
+
+      >>> patcher = mock.patch(
+      ...     'pjpersist.datamanager.PJ_TRACK_CURRENT_STATE', True)
+      >>> _ = patcher.start()
+
+      >>> foo = Foo('one')
+      >>> dm.root.foo = foo
+      >>> transaction.commit()
+      >>> foo.name = 'two'
+      >>> transaction.commit()
+
+    Every transaction wrote a state, but only the last one is current:
+
+      >>> table = 'pjpersist_dot_tests_dot_test_datamanager_dot_Foo'
+      >>> cur = dm.getCursor()
+      >>> cur.execute(
+      ...     'SELECT data, is_current FROM %s_state ORDER BY sid' % table)
+      >>> [tuple(row) for row in cur.fetchall()]
+      [({u'name': u'one'}, False), ({u'name': u'two'}, True)]
+
+    Documents are loaded from the current state:
+
+      >>> dm.reset()
+      >>> dm.root.foo.name
+      u'two'
+
+    The current states are searched through partial indexes. The index of
+    all states is kept for queries of the state table itself:
+
+      >>> cur.execute(
+      ...     "SELECT indexname, indexdef FROM pg_indexes "
+      ...     "WHERE tablename = lower(%s) ORDER BY indexname",
+      ...     (table + '_state',))
+      >>> for name, definition in cur.fetchall():
+      ...     print name, definition.endswith('WHERE is_current')
+      pjpersist_dot_tests_dot_test_datamanager_dot_foo_cur_gin True
+      pjpersist_dot_tests_dot_test_datamanager_dot_foo_cur_pid True
+      pjpersist_dot_tests_dot_test_datamanager_dot_foo_data_gin False
+      pjpersist_dot_tests_dot_test_datamanager_dot_foo_pid_tid_unique False
+      pjpersist_dot_tests_dot_test_datamanager_dot_foo_state_pkey False
+
+    Index names that PostgreSQL would truncate end with a hash instead, so
+    that they do not collide:
+
+      >>> table = 'pjpersist_dot_tests_dot_test_datamanager_dot_VeryLongName'
+      >>> datamanager.get_index_name(table, 'cur_pid')
+      'pjpersist_dot_tests_dot_test_datamanager_dot_VeryLongN_...'
+      >>> len(datamanager.get_index_name(table, 'cur_pid'))
+      63
+      >>> (datamanager.get_index_name(table, 'cur_pid') ==
+      ...  datamanager.get_index_name(table, 'cur_gin'))
+      False
+
+      >>> patcher.stop()
+    """
+
+
+def doctest_PJDataManager_partial_update():
+    """Objects flushed again in a transaction are updated partially
+
+      >>> foo = Foo('one')
+      >>> foo.data = {'a': 1, 'b': {'c': 2, 'd': [1, 2]}}
+      >>> dm.root.foo = foo
+      >>> dm.flush()
+
+    Only the changed keys are sent to the database:
+
+      >>> foo.name = 'two'
+      >>> foo.data = {'b': {'c': 2.0, 'd': [1, 2]}, 'e': None}
+      >>> with mock.patch('pjpersist.datamanager.PJ_ENABLE_QUERY_STATS', True):
+      ...     dm.flush()
+      >>> query = dm._query_report.qlog[-1].query
+      >>> print query
+      UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo_state
+      SET data=... WHERE tid=%s AND pid=%s
+      >>> query.count('jsonb_set('), query.count('#-')
+      (3, 1)
+
+      >>> transaction.commit()
+      >>> dm.reset()
+      >>> foo = dm.root.foo
+      >>> foo.name, foo.data
+      (u'two', {u'b': {u'c': 2.0, u'd': [1, 2]}, u'e': None})
+
+    Larger changes write the complete document again:
+
+      >>> foo.data = dict(('k%i' % i, i) for i in range(20))
+      >>> dm.flush()
+      >>> foo.name = 'three'
+      >>> with mock.patch(
+      ...         'pjpersist.datamanager.PJ_PARTIAL_UPDATE_MAX_CHANGES', 5), \\
+      ...      mock.patch('pjpersist.datamanager.PJ_ENABLE_QUERY_STATS', True):
+      ...     foo.data = dict(('k%i' % i, -i) for i in range(20))
+      ...     dm.flush()
+      >>> print dm._query_report.qlog[-1].query
+      UPDATE pjpersist_dot_tests_dot_test_datamanager_dot_Foo
+      SET tid=... WHERE id = ...
+
+      >>> transaction.commit()
+      >>> dm.root.foo.data['k3'], dm.root.foo.name
+      (-3, u'three')
+    """
+
+
 def doctest_get_database_name_from_dsn():
 
     """Test dsn parsing
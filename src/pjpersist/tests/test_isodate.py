@@ -0,0 +1,149 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""ISO 8601 codec tests"""
+import datetime
+import doctest
+import pickle
+
+from pjpersist import isodate, serialize, serializers, testing
+
+
+def doctest_format():
+    """Formatting dates, times and datetimes
+
+    Naive values without microseconds use the same format as before:
+
+      >>> isodate.format_date(datetime.date(2011, 11, 1))
+      '2011-11-01'
+      >>> isodate.format_time(datetime.time(9, 5, 3))
+      '09:05:03'
+      >>> isodate.format_datetime(datetime.datetime(2011, 11, 1, 9, 5, 3))
+      '2011-11-01T09:05:03'
+
+    Microseconds and UTC offsets are added when present:
+
+      >>> isodate.format_time(datetime.time(9, 5, 3, 1500))
+      '09:05:03.001500'
+      >>> isodate.format_datetime(datetime.datetime(
+      ...     2011, 11, 1, 9, 5, 3, 1500, isodate.get_offset(-330)))
+      '2011-11-01T09:05:03.001500-05:30'
+      >>> isodate.format_time(datetime.time(9, 5, 3, tzinfo=isodate.UTC))
+      '09:05:03+00:00'
+
+    Unlike `strftime()`, years before 1900 work as well:
+
+      >>> isodate.format_date(datetime.date(1850, 1, 1))
+      '1850-01-01'
+    """
+
+
+def doctest_parse():
+    """Parsing dates, times and datetimes
+
+      >>> isodate.parse_date('2011-11-01')
+      datetime.date(2011, 11, 1)
+      >>> isodate.parse_time('09:05:03')
+      datetime.time(9, 5, 3)
+      >>> isodate.parse_datetime('2011-11-01T09:05:03')
+      datetime.datetime(2011, 11, 1, 9, 5, 3)
+
+    Fractions of a second are read up to microseconds:
+
+      >>> isodate.parse_time('09:05:03.0015')
+      datetime.time(9, 5, 3, 1500)
+      >>> isodate.parse_time('09:05:03.123456789')
+      datetime.time(9, 5, 3, 123456)
+
+    UTC offsets are read in the common notations:
+
+      >>> isodate.parse_time('09:05:03Z')
+      datetime.time(9, 5, 3, tzinfo=<FixedOffset UTC>)
+      >>> isodate.parse_time('09:05:03+02')
+      datetime.time(9, 5, 3, tzinfo=<FixedOffset +02:00>)
+      >>> isodate.parse_time('09:05:03-0530')
+      datetime.time(9, 5, 3, tzinfo=<FixedOffset -05:30>)
+
+      >>> dt = isodate.parse_datetime('2011-11-01 09:05:03.5+01:00')
+      >>> dt.isoformat()
+      '2011-11-01T09:05:03.500000+01:00'
+      >>> dt == datetime.datetime(2011, 11, 1, 8, 5, 3, 500000, isodate.UTC)
+      True
+
+    The timezones are shared and can be pickled:
+
+      >>> dt.tzinfo is isodate.get_offset(60)
+      True
+      >>> pickle.loads(pickle.dumps(dt)).tzinfo is dt.tzinfo
+      True
+
+    Malformed values are rejected:
+
+      >>> isodate.parse_date('2011/11/01')
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid ISO date: '2011/11/01'
+      >>> isodate.parse_time('09:05')
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid ISO time: '09:05'
+      >>> isodate.parse_datetime('2011-11-01X09:05:03')
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid ISO datetime: '2011-11-01X09:05:03'
+      >>> isodate.parse_time('09:05:03 CET')
+      Traceback (most recent call last):
+      ...
+      ValueError: Invalid UTC offset: '09:05:03 CET'
+    """
+
+
+def doctest_roundtrip():
+    """Round trip through the object writer and reader
+
+      >>> writer = serialize.ObjectWriter(None)
+      >>> reader = serialize.ObjectReader(None)
+
+      >>> values = [
+      ...     datetime.date(2011, 11, 1),
+      ...     datetime.time(9, 5, 3, 42),
+      ...     datetime.datetime(2011, 11, 1, 9, 5, 3, 42),
+      ...     datetime.datetime(2011, 11, 1, 9, 5, 3, 0, isodate.get_offset(90)),
+      ...     ]
+      >>> state = writer.get_state(values)
+      >>> state
+      [{'_py_type': 'datetime.date', 'value': '2011-11-01'},
+       {'_py_type': 'datetime.time', 'value': '09:05:03.000042'},
+       {'_py_type': 'datetime.datetime', 'value': '2011-11-01T09:05:03.000042'},
+       {'_py_type': 'datetime.datetime', 'value': '2011-11-01T09:05:03+01:30'}]
+      >>> reader.get_object(state, None) == values
+      True
+
+    The custom serializers use the same codec:
+
+      >>> serialize.SERIALIZERS.extend([
+      ...     serializers.DateTimeSerializer(),
+      ...     serializers.DateSerializer(),
+      ...     serializers.TimeSerializer()])
+      >>> writer.get_state(values) == state
+      True
+      >>> reader.get_object(state, None) == values
+      True
+    """
+
+
+def test_suite():
+    return doctest.DocTestSuite(
+        setUp=testing.setUpSerializers,
+        tearDown=testing.tearDownSerializers,
+        optionflags=testing.OPTIONFLAGS)
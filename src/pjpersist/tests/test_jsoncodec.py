@@ -0,0 +1,166 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""JSON codec tests"""
+import doctest
+import persistent
+import transaction
+
+from pjpersist import jsoncodec, testing
+
+# Values each codec must round trip
+MATRIX = [
+    ('ascii', u'foo'),
+    ('unicode', u'\u017elu\u0165ou\u010dk\xfd k\u016f\u0148'),
+    ('astral', u'\U0001f600'),
+    ('escapes', u'"quoted"\n\\'),
+    ('float', 0.1),
+    ('float precision', 3.141592653589793),
+    ('float small', 1e-10),
+    ('float big', 1.7976931348623157e+308),
+    ('float sum', 0.1 + 0.2),
+    ('int', 42),
+    ('negative int', -42),
+    ('big int', 2 ** 63),
+    ('huge int', 2 ** 70),
+    ('nested', {u'list': [1, 2.5, None, True, False], u'dict': {u'a': u'b'}}),
+    ]
+
+
+def same(result, value):
+    """Compare the values and the types of all nested items"""
+    if type(result) is not type(value):
+        return False
+    if isinstance(value, dict):
+        return same(sorted(result.items()), sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return len(result) == len(value) and all(
+            same(item, orig) for item, orig in zip(result, value))
+    return result == value
+
+
+def check_codec(name):
+    """Return the names of the values the codec does not round trip"""
+    dumps, loads = jsoncodec.CODECS[name]
+    failures = []
+    for title, value in MATRIX:
+        try:
+            result = loads(dumps(value))
+        except (ValueError, OverflowError):
+            failures.append(title)
+            continue
+        if not same(result, value):
+            failures.append(title)
+    return failures
+
+
+class Item(persistent.Persistent):
+    pass
+
+
+def doctest_compatibility_matrix():
+    """Compatibility of the available codecs
+
+      >>> check_codec('json')
+      []
+      >>> check_codec('simplejson')
+      []
+
+    Strings have to come back as `unicode`, also the ASCII ones, which
+    simplejson itself returns as `str`:
+
+      >>> simplejson_loads = jsoncodec.CODECS['simplejson'][1]
+      >>> simplejson_loads('{"a": ["foo"]}')
+      {u'a': [u'foo']}
+
+    Other codecs are only checked when they are installed. ujson cannot read
+    integers beyond 64 bits. Versions before 2.0 also lose the last digits
+    of some floats:
+
+      >>> failures = dict((name, check_codec(name))
+      ...                 for name in jsoncodec.CODECS)
+      >>> failures.get('ujson', ['huge int'])
+      ['huge int']
+    """
+
+
+def doctest_set_codec():
+    """Selecting a codec
+
+      >>> jsoncodec.CODEC
+      'json'
+
+      >>> jsoncodec.set_codec('simplejson')
+      >>> jsoncodec.CODEC
+      'simplejson'
+      >>> jsoncodec.dumps({'a': [1, 2]})
+      '{"a": [1, 2]}'
+
+      >>> jsoncodec.set_codec('foo')
+      Traceback (most recent call last):
+      ...
+      ValueError: Unknown JSON codec: 'foo'
+
+    Custom codecs can be registered:
+
+      >>> def dumps(obj):
+      ...     return jsoncodec.CODECS['json'][0](obj, sort_keys=True)
+      >>> jsoncodec.register_codec('sorted', dumps, jsoncodec.loads)
+      >>> jsoncodec.set_codec('sorted')
+      >>> jsoncodec.dumps({'b': 1, 'a': 2})
+      '{"a": 2, "b": 1}'
+    """
+
+
+def doctest_codec_roundtrip():
+    """Storing and loading objects with another codec
+
+      >>> jsoncodec.set_codec('simplejson')
+
+      >>> item = Item()
+      >>> item.values = [value for title, value in MATRIX
+      ...                if not isinstance(value, unicode) or title == 'ascii']
+      >>> dm.root.item = item
+      >>> transaction.commit()
+      >>> dm.reset()
+
+      >>> dm.root.item.values == item.values
+      True
+
+    The same documents can be read with the default codec:
+
+      >>> jsoncodec.set_codec('json')
+      >>> dm.reset()
+      >>> dm.root.item.values == item.values
+      True
+    """
+
+
+def setUp(test):
+    testing.setUp(test)
+    test.orig_codec = jsoncodec.CODEC
+
+
+def tearDown(test):
+    jsoncodec.set_codec(test.orig_codec)
+    jsoncodec.CODECS.pop('sorted', None)
+    testing.tearDown(test)
+
+
+def test_suite():
+    suite = doctest.DocTestSuite(
+        setUp=setUp, tearDown=tearDown,
+        checker=testing.checker,
+        optionflags=testing.OPTIONFLAGS)
+    suite.layer = testing.db_layer
+    return suite
@@ -69,6 +69,63 @@ def doctest_PJTableMapping_simple():
     """
 
 
+def doctest_PJTableMapping_defer_load():
+    r"""PJTableMapping: deferred loading
+
+        >>> class SimpleContainer(mapping.PJTableMapping):
+        ...     table = 'pjpersist_dot_tests_dot_test_mapping_dot_Item'
+        ...     mapping_key = 'name'
+
+        >>> container = SimpleContainer(dm)
+        >>> container['one'] = Item()
+        >>> transaction.commit()
+        >>> dm.reset()
+
+    Let's count the queries loading object states:
+
+        >>> loaded = []
+        >>> orig_get_doc = dm._get_doc_by_dbref
+        >>> def get_doc(dbref):
+        ...     loaded.append(dbref)
+        ...     return orig_get_doc(dbref)
+        >>> dm._get_doc_by_dbref = get_doc
+
+    By default the state is set from the fetched row right away:
+
+        >>> one = container['one']
+        >>> one._p_changed
+        False
+        >>> one.name
+        u'one'
+        >>> loaded
+        []
+
+    When loading is deferred, we get a ghost that keeps the fetched
+    document:
+
+        >>> dm.reset()
+        >>> dm.defer_load = True
+
+        >>> one = container['one']
+        >>> one._p_changed is None
+        True
+        >>> dm._latest_states.values()
+        [{u'name': u'one', u'site': None}]
+
+    The state is set when the object is first accessed, without querying
+    the database again:
+
+        >>> one.name
+        u'one'
+        >>> dm._latest_states
+        {}
+        >>> loaded
+        []
+
+        >>> dm._get_doc_by_dbref = orig_get_doc
+    """
+
+
 def doctest_PJTableMapping_filter():
     r"""PJTableMapping: filter
 
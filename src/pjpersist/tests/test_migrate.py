@@ -0,0 +1,175 @@
+##############################################################################
+#
+# Copyright (c) 2014 Shoobx, Inc.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE.
+#
+##############################################################################
+"""Document migration tests"""
+import doctest
+import mock
+import persistent
+import transaction
+
+from pjpersist import migrate, serialize, testing
+
+
+class Address(object):
+    pass
+
+
+class Person(persistent.Persistent):
+    _p_pj_table = 'person'
+
+
+def doctest_migrate_type_tags():
+    """Switching stored documents to class aliases
+
+      >>> person = Person()
+      >>> person.address = Address()
+      >>> person.kind = Address
+      >>> dm.root.person = person
+      >>> transaction.commit()
+      >>> dumpTable('person')
+      [{'class_name': u'Person',
+        'data': {u'address': {u'_py_type': u'pjpersist.tests.test_migrate.Address'},
+                 u'kind': {u'_py_type': u'type',
+                           u'path': u'pjpersist.tests.test_migrate.Address'}},
+        'id': 1L,
+        'package': u'pjpersist.tests.test_migrate',
+        'pid': 1L,
+        'sid': ...L,
+        'tid': ...L}]
+
+    After registering an alias, the existing documents can be migrated:
+
+      >>> serialize.register_class_alias('Address', Address)
+      >>> migrate.migrate_type_tags(conn, ['person'])
+      1
+      >>> conn.commit()
+      >>> dumpTable('person')
+      [{'class_name': u'Person',
+        'data': {u'address': {u'_py_type': u'Address'},
+                 u'kind': {u'_py_type': u'type', u'path': u'Address'}},
+        'id': 1L,
+        'package': u'pjpersist.tests.test_migrate',
+        'pid': 1L,
+        'sid': ...L,
+        'tid': ...L}]
+
+      >>> dm.reset()
+      >>> dm.root.person.address
+      <pjpersist.tests.test_migrate.Address object at ...>
+      >>> dm.root.person.kind
+      <class 'pjpersist.tests.test_migrate.Address'>
+
+    Documents that are up to date are left alone:
+
+      >>> migrate.migrate_type_tags(conn)
+      0
+
+    The aliases can be expanded to the dotted names again:
+
+      >>> migrate.migrate_type_tags(conn, expand=True)
+      1
+      >>> conn.commit()
+      >>> dumpTable('person')
+      [{'class_name': u'Person',
+        'data': {u'address': {u'_py_type': u'pjpersist.tests.test_migrate.Address'},
+                 u'kind': {u'_py_type': u'type',
+                           u'path': u'pjpersist.tests.test_migrate.Address'}},
+        'id': 1L,
+        'package': u'pjpersist.tests.test_migrate',
+        'pid': 1L,
+        'sid': ...L,
+        'tid': ...L}]
+    """
+
+
+def doctest_mark_current_states():
+    """Flagging the current states of existing tables
+
+      >>> person = Person()
+      >>> person.name = u'one'
+      >>> dm.root.person = person
+      >>> transaction.commit()
+      >>> person.name = u'two'
+      >>> transaction.commit()
+
+      >>> migrate.mark_current_states(conn)
+      2
+      >>> conn.commit()
+      >>> cur = conn.cursor()
+      >>> cur.execute('SELECT data, is_current FROM person_state ORDER BY sid')
+      >>> cur.fetchall()
+      [({u'name': u'one'}, False), ({u'name': u'two'}, True)]
+
+    Afterwards the states are tracked by the data manager:
+
+      >>> with mock.patch(
+      ...         'pjpersist.datamanager.PJ_TRACK_CURRENT_STATE', True):
+      ...     dm.reset()
+      ...     dm.root.person.name = u'three'
+      ...     transaction.commit()
+      ...     dm.reset()
+      ...     print dm.root.person.name
+      three
+      >>> cur.execute('SELECT is_current FROM person_state ORDER BY sid')
+      >>> cur.fetchall()
+      [(False,), (False,), (True,)]
+
+    Tables that are up to date are left alone:
+
+      >>> migrate.mark_current_states(conn)
+      0
+    """
+
+
+def doctest_remove_unused_blobs():
+    """Removing blobs no document refers to
+
+      >>> person = Person()
+      >>> person.photo = serialize.Blob('\xff' * 10)
+      >>> person.address = Address()
+      >>> person.address.map = serialize.Blob('\xfe' * 10)
+      >>> dm.root.person = person
+      >>> transaction.commit()
+
+    Blobs of existing states are kept:
+
+      >>> migrate.remove_unused_blobs(conn)
+      0
+
+    Blobs are removed once no state refers to them anymore:
+
+      >>> dm.remove(dm.root.person)
+      >>> transaction.commit()
+      >>> migrate.remove_unused_blobs(conn)
+      2
+      >>> conn.commit()
+      >>> cur = conn.cursor()
+      >>> cur.execute('SELECT count(*) FROM person_blobs')
+      >>> cur.fetchone()
+      (0L,)
+    """
+
+
+def tearDown(test):
+    serialize.CLASS_ALIASES.clear()
+    serialize.CLASS_ALIAS_NAMES.clear()
+    testing.tearDown(test)
+
+
+def test_suite():
+    suite = doctest.DocTestSuite(
+        setUp=testing.setUp, tearDown=tearDown,
+        checker=testing.checker,
+        optionflags=testing.OPTIONFLAGS)
+    suite.layer = testing.db_layer
+    return suite
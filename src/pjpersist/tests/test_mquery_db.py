@@ -14,6 +14,9 @@
 ##############################################################################
 import doctest
 import json
+import mock
+import persistent
+import transaction
 
 from pjpersist import testing, mquery, sqlbuilder as sb
 
@@ -187,6 +190,100 @@ def doctest_operators():
     """
 
 
+class Person(persistent.Persistent):
+    _p_pj_table = 'person'
+
+    def __init__(self, name, friend=None):
+        self.name = name
+        self.friend = friend
+
+
+def doctest_references():
+    """References are queried in the format they are stored in
+
+       >>> stephan = Person(u'Stephan')
+       >>> dm.root.stephan = stephan
+       >>> with mock.patch('pjpersist.serialize.DBREF_COMPACT', True):
+       ...     dm.root.roy = Person(u'Roy', stephan)
+       ...     transaction.commit()
+       ...     converter = mquery.Converter('person_state', 'data', dm)
+       ...     where = converter.convert({'friend': stephan})
+       >>> print sb.sqlrepr(where, 'postgres')
+       ((((person_state.data) -> ('friend')) = ('{"_py_ref": ["person", ...]}'))
+        OR (('[{"_py_ref": ["person", ...]}]'::jsonb) <@
+             ((person_state.data) -> ('friend'))))
+
+       >>> def names(where):
+       ...     with conn.cursor() as cur:
+       ...         cur.execute(sb.sqlrepr(sb.Select(
+       ...             sb.Field('person_state', 'data'), where=where,
+       ...             orderBy=sb.Field('person_state', 'sid')), 'postgres'))
+       ...         return [row[0]['name'] for row in cur.fetchall()]
+       >>> names(where)
+       [u'Roy']
+
+    Objects that are not stored yet cannot be referenced, and queries never
+    store them:
+
+       >>> converter = mquery.Converter('person_state', 'data', dm)
+       >>> converter.convert({'friend': Person(u'Adam')})
+       Traceback (most recent call last):
+       ...
+       ValueError: Unsaved objects cannot be queried for:
+           <pjpersist.tests.test_mquery_db.Person object at 0x...>
+       >>> transaction.commit()
+       >>> with conn.cursor() as cur:
+       ...     cur.execute('SELECT count(*) FROM person')
+       ...     cur.fetchone()[0]
+       2L
+    """
+
+
+class Address(object):
+
+    def __init__(self, city):
+        self.city = city
+
+
+def doctest_class_aliases():
+    """Values naming classes match documents written before the class got
+    an alias
+
+       >>> from pjpersist import serialize
+       >>> dm.root.stephan = Person(u'Stephan')
+       >>> dm.root.stephan.address = Address(u'Boston')
+       >>> transaction.commit()
+
+       >>> serialize.register_class_alias('Address', Address)
+       >>> dm.root.roy = Person(u'Roy')
+       >>> dm.root.roy.address = Address(u'Boston')
+       >>> transaction.commit()
+
+       >>> def names(query):
+       ...     converter = mquery.Converter('person_state', 'data', dm)
+       ...     with conn.cursor() as cur:
+       ...         cur.execute(sb.sqlrepr(sb.Select(
+       ...             sb.Field('person_state', 'data'),
+       ...             where=converter.convert(query),
+       ...             orderBy=sb.Field('person_state', 'sid')), 'postgres'))
+       ...         return [row[0]['name'] for row in cur.fetchall()]
+       >>> names({'address': Address(u'Boston')})
+       [u'Stephan', u'Roy']
+       >>> names({'address': {'$ne': Address(u'Boston')}})
+       []
+
+    Once all documents are migrated, only the alias needs to be matched:
+
+       >>> with mock.patch('pjpersist.mquery.MATCH_DOTTED_TYPE_TAGS', False):
+       ...     names({'address': Address(u'Boston')})
+       [u'Roy']
+
+       >>> serialize.CLASS_ALIASES.clear()
+       >>> serialize.CLASS_ALIAS_NAMES.clear()
+       >>> serialize.TYPE_TAG_CACHE.clear()
+    """
+
+
 def test_suite():
     suite =  doctest.DocTestSuite(
         setUp=setUp, tearDown=testing.tearDown,
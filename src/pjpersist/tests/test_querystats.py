@@ -14,9 +14,11 @@
 """Query statistics reporter tests"""
 
 import doctest
+import sys
 
 from pjpersist import testing
-from pjpersist.querystats import QueryReport
+from pjpersist import querystats
+from pjpersist.querystats import QueryReport, AggregatedQueryReport
 
 
 def doctest_calculate_empty():
@@ -61,10 +63,10 @@ def doctest_calc_and_report_several():
     Record several queries and produce report
 
         >>> qr = QueryReport()
+        >>> qr.report_traceback = True
         >>> qr.record("SELECT 1", [], 0.005)
         >>> qr.record("SELECT 2", (1, 2, 3), 0.0001)
         >>> qr.record("SELECT 3", ["a", "b", 3], 0.8)
-        >>> qr.report_traceback = True
 
         >>> print qr.calc_and_report()
         Query report:
@@ -91,6 +93,259 @@ def doctest_calc_and_report_several():
     """
 
 
+def doctest_calc_and_report_plan():
+    """
+    Query plans of explained queries show up in the report
+
+        >>> qr = QueryReport()
+        >>> qr.record("SELECT 1", [], 0.8, plan=[{'Plan': {'Node Type': 'Result'}}])
+        >>> print qr.calc_and_report()
+        Query report:
+        ------------------------------------------------------------
+        10 most expensive queries:
+        *** SELECT 1
+        ... ARGS: []
+        ... TIME: 800.0000ms
+        ... PLAN: [{"Plan": {"Node Type": "Result"}}]
+        <BLANKLINE>
+        ...
+
+        >>> qr = AggregatedQueryReport()
+        >>> qr.record("SELECT 1", [], 0.8, plan=[{'Plan': {'Node Type': 'Result'}}])
+        >>> print qr.calc_and_report()
+        Query report:
+        ...
+        ... P50: 800.0000ms P95: 800.0000ms P99: 800.0000ms
+        ... PLAN: [{"Plan": {"Node Type": "Result"}}]
+        ...
+    """
+
+
+def doctest_traceback_collection():
+    """
+    Tracebacks are only collected when they are reported
+
+        >>> qr = QueryReport()
+        >>> qr.record("SELECT 1", [], 0.005)
+        >>> qr.qlog[0].traceback is None
+        True
+
+    They are stored as raw frames, formatting happens in the report
+
+        >>> qr.report_traceback = True
+        >>> qr.record("SELECT 2", [], 0.005)
+        >>> frames = qr.qlog[1].traceback
+        >>> isinstance(frames, tuple), len(frames[0])
+        (True, 4)
+
+        >>> def query_with_info():
+        ...     __traceback_info__ = 'some info'
+        ...     return querystats.extract_frames(sys._getframe(), 2)
+        >>> print querystats.format_frames(query_with_info())
+          File "<doctest ...>", line 1, in <module>
+            print querystats.format_frames(query_with_info())
+          File "<doctest ...>", line 3, in query_with_info
+            return querystats.extract_frames(sys._getframe(), 2)
+           - __traceback_info__: some info
+        <BLANKLINE>
+
+    Only a sample of the queries gets a traceback, but slow queries always
+
+        >>> qr = QueryReport()
+        >>> qr.report_traceback = True
+        >>> qr.traceback_sample_rate = 0
+        >>> qr.traceback_slow_threshold = 0.1
+        >>> qr.record("SELECT 1", [], 0.005)
+        >>> qr.record("SELECT 2", [], 0.5)
+        >>> [q.traceback is not None for q in qr.qlog]
+        [False, True]
+    """
+
+
+def doctest_n_plus_one_detection():
+    """
+    Repeated SELECTs from the same call site are reported
+
+        >>> qr = QueryReport()
+        >>> qr.detect_n_plus_one = True
+        >>> qr.n_plus_one_threshold = 3
+
+        >>> for id in range(5):
+        ...     qr.record("SELECT data FROM foo WHERE id = %s" % id, [], 0.001)
+
+        >>> qr.record("SELECT data FROM foo WHERE id = 42", [], 0.001)
+        >>> for id in range(5):
+        ...     qr.record("UPDATE foo SET data = %s", [id], 0.001)
+
+        >>> qr.calc_repeated_queries()
+        [RepeatedQuery(query='SELECT data FROM foo WHERE id = ?', count=5,
+                       call_site=('<doctest ...>', 2, '<module>'))]
+
+        >>> print qr.calc_and_report()
+        Query report:
+        ...
+        Possible N+1 queries:
+        *** SELECT data FROM foo WHERE id = ?
+        ... COUNT: 5
+        ... FROM: File "<doctest ...>", line 2, in <module>
+        <BLANKLINE>
+        ------------------------------------------------------------
+        Queries executed: 11
+        Time spent: ...
+
+    Optionally the report raises an error right away
+
+        >>> qr.clear()
+        >>> qr.raise_on_n_plus_one = True
+        >>> for id in range(5):
+        ...     qr.record("SELECT data FROM foo WHERE id = %s" % id, [], 0.001)
+        Traceback (most recent call last):
+        ...
+        NPlusOneQueryError: RepeatedQuery(query='SELECT data FROM foo WHERE id = ?',
+                            count=3, call_site=('<doctest ...>', 2, '<module>'))
+    """
+
+
+def doctest_fingerprint():
+    """
+    Literals and placeholders are stripped from statements
+
+        >>> print querystats.fingerprint(
+        ...     "SELECT * FROM person WHERE id = 42 AND name = 'O''Neil'")
+        SELECT * FROM person WHERE id = ? AND name = ?
+
+        >>> print querystats.fingerprint(
+        ...     "SELECT data FROM person_state\\n  WHERE pid = %s AND tid = %(tid)s")
+        SELECT data FROM person_state WHERE pid = ? AND tid = ?
+
+    Digits being part of identifiers are kept, lists of values are collapsed
+
+        >>> print querystats.fingerprint(
+        ...     "SELECT * FROM table1 WHERE id IN (1, 2, 3, -4.5)")
+        SELECT * FROM table1 WHERE id IN (?, ...)
+
+        >>> print querystats.fingerprint(
+        ...     "SELECT * FROM table1 WHERE id IN (%s, %s)")
+        SELECT * FROM table1 WHERE id IN (?, ...)
+    """
+
+
+def doctest_LatencyHistogram():
+    """
+    The histogram approximates percentiles with the bucket bounds
+
+        >>> hist = querystats.LatencyHistogram()
+        >>> hist.percentile(50)
+        0
+
+        >>> for i in range(98):
+        ...     hist.add(0.001)
+        >>> hist.add(0.5)
+        >>> hist.add(2.0)
+
+        >>> hist.count, hist.min, hist.max
+        (100, 0.001, 2.0)
+
+        >>> 0.001 <= hist.percentile(50) < 0.0014
+        True
+        >>> 0.001 <= hist.percentile(95) < 0.0014
+        True
+        >>> 0.5 <= hist.percentile(99) < 0.65
+        True
+        >>> hist.percentile(100)
+        2.0
+
+    The memory does not grow with the number of recorded values
+
+        >>> len(hist.buckets) == len(querystats.HISTOGRAM_BUCKETS) + 1
+        True
+    """
+
+
+def doctest_AggregatedQueryReport_calculate():
+    """
+    Queries are aggregated by their fingerprint
+
+        >>> qr = AggregatedQueryReport()
+        >>> qr.calc_totals()
+        QueryTotals(total_queries=0, total_time=0, sorted_queries=[])
+
+        >>> qr.record("SELECT * FROM foo WHERE id = 1", [], 0.005)
+        >>> qr.record("SELECT * FROM foo WHERE id = 2", [], 0.001)
+        >>> qr.record("SELECT * FROM bar WHERE id = %s", [1], 0.003)
+
+        >>> stats = qr.calc_totals()
+        >>> stats
+        QueryTotals(total_queries=3, total_time=0.009..., sorted_queries=[...])
+
+        >>> stats.sorted_queries
+        [<FingerprintStats 'SELECT * FROM bar WHERE id = ?' count=1>,
+         <FingerprintStats 'SELECT * FROM foo WHERE id = ?' count=2>]
+
+        >>> qr.clear()
+        >>> qr.calc_totals()
+        QueryTotals(total_queries=0, total_time=0, sorted_queries=[])
+    """
+
+
+def doctest_AggregatedQueryReport_bounded():
+    """
+    The number of fingerprints is limited, the rest gets summed up
+
+        >>> orig_max = querystats.MAX_FINGERPRINTS
+        >>> querystats.MAX_FINGERPRINTS = 2
+
+        >>> qr = AggregatedQueryReport()
+        >>> qr.record("SELECT 1 FROM foo", [], 0.001)
+        >>> qr.record("SELECT 1 FROM bar", [], 0.001)
+        >>> qr.record("SELECT 1 FROM baz", [], 0.001)
+        >>> qr.record("SELECT 1 FROM qux", [], 0.001)
+        >>> qr.record("SELECT 1 FROM foo", [], 0.001)
+
+        >>> sorted((s.fingerprint, s.count) for s in qr.stats.values())
+        [('<other statements>', 2),
+         ('SELECT ? FROM bar', 1),
+         ('SELECT ? FROM foo', 2)]
+
+        >>> querystats.MAX_FINGERPRINTS = orig_max
+    """
+
+
+def doctest_AggregatedQueryReport_calc_and_report():
+    """
+    Print out the aggregated report
+
+        >>> qr = AggregatedQueryReport()
+        >>> print qr.calc_and_report()
+        Query report: no queries were executed
+
+        >>> qr.record("SELECT * FROM foo WHERE id = 1", [], 0.005)
+        >>> qr.record("SELECT * FROM foo WHERE id = 2", [], 0.005)
+        >>> qr.record("SELECT * FROM bar WHERE id = 1", [], 0.8)
+
+        >>> print qr.calc_and_report()
+        Query report:
+        ------------------------------------------------------------
+        10 most expensive statements by total time:
+        *** SELECT * FROM foo WHERE id = ?
+        ... COUNT: 2
+        ... TOTAL: 10.0000ms
+        ... MEAN: 5.0000ms
+        ... P50: 5.0000ms P95: 5.0000ms P99: 5.0000ms
+        <BLANKLINE>
+        *** SELECT * FROM bar WHERE id = ?
+        ... COUNT: 1
+        ... TOTAL: 800.0000ms
+        ... MEAN: 800.0000ms
+        ... P50: 800.0000ms P95: 800.0000ms P99: 800.0000ms
+        <BLANKLINE>
+        ------------------------------------------------------------
+        Queries executed: 3
+        Distinct statements: 2
+        Time spent: 810.0000ms
+    """
+
+
 def test_suite():
     dtsuite = doctest.DocTestSuite(
         optionflags=testing.OPTIONFLAGS)
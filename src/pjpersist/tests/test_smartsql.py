@@ -18,7 +18,7 @@ import doctest
 import unittest
 
 from pjpersist.mapping import PJTableMapping
-from pjpersist import testing, smartsql
+from pjpersist import datamanager, serialize, testing, smartsql
 from pjpersist.smartsql import T, compile
 
 
@@ -52,6 +52,13 @@ def doctest_smartsql():
         >>> compile(vt)
         ('mapping INNER JOIN mapping_state ON (mapping.id = mapping_state.pid AND mapping.tid = mapping_state.tid)', [])
 
+        Tracking the current states only joins the live states
+
+        >>> datamanager.PJ_TRACK_CURRENT_STATE = True
+        >>> compile(vt)
+        ('mapping INNER JOIN mapping_state ON (mapping.id = mapping_state.pid AND mapping_state.is_current)', [])
+        >>> datamanager.PJ_TRACK_CURRENT_STATE = False
+
         >>> compile(vt.test == 5)
         ("mapping_state.data->>'test' = %s", [5])
 
@@ -95,6 +102,13 @@ def doctest_smartsql():
         >>> compile(smartsql.JsonbContainsAll(vt.test, None))
         ('mapping_state.data ?& NULL', [])
 
+        Promoted text fields are read from their column
+
+        >>> serialize.register_promoted_fields('mapping', {'test': 'text'})
+        >>> compile(vt.test == 'x')
+        ('mapping_state.data_test = %s', ['x'])
+        >>> del serialize.PROMOTED_FIELDS['mapping']
+
     """
 
 
@@ -259,6 +259,13 @@ class PJContainer(contained.Contained,
         self._cache[obj.__name__] = obj
         return obj
 
+    def _load_snapshot(self, id, doc):
+        """Get a read-only python object from the id/doc state"""
+        dbref = serialize.DBRef(self._pj_table, id, self._pj_jar.database)
+        obj = self._pj_jar._reader.get_snapshot_object(dbref, doc)
+        self._locate(obj, id, doc)
+        return obj
+
     def __cmp__(self, other):
         # UserDict implements the semantics of implementing comparison of
         # items to determine equality, which is not what we want for a
@@ -434,7 +441,7 @@ class PJContainer(contained.Contained,
     def convert_mongo_query(self, spec):
         warnings.warn("Using mongo queries is deprecated",
                       DeprecationWarning, stacklevel=3)
-        c = Converter(self._pj_table, 'data')
+        c = Converter(self._pj_table, 'data', self._pj_jar)
         qry = c.convert(spec)
         return qry
 
@@ -453,11 +460,12 @@ class PJContainer(contained.Contained,
             cur.execute(sb.Select(self._get_sb_fields(fields), qry, **kwargs))
         return cur
 
-    def find(self, qry=None, **kwargs):
-        # Search for matching objects.
+    def find(self, qry=None, snapshot=False, **kwargs):
+        # Search for matching objects, optionally as read-only snapshots.
+        load = self._load_snapshot if snapshot else self._load_one
         result = self.raw_find(qry, **kwargs)
         for row in result:
-            obj = self._load_one(row['id'], row['data'])
+            obj = load(row['id'], row['data'])
             yield obj
 
     def raw_find_one(self, qry=None, id=None):
@@ -481,10 +489,12 @@ class PJContainer(contained.Contained,
                 raise ValueError('Multiple results returned.')
             return cur.fetchone()
 
-    def find_one(self, qry=None, id=None):
+    def find_one(self, qry=None, id=None, snapshot=False):
         res = self.raw_find_one(qry, id)
         if res is None:
             return None
+        if snapshot:
+            return self._load_snapshot(res['id'], res['data'])
         return self._load_one(res['id'], res['data'])
 
     def count(self, qry=None):
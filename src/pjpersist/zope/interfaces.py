@@ -73,11 +73,12 @@ class IPJContainer(zope.interface.Interface):
         Note: The user is responsible of closing the cursor after use.
         """
 
-    def find(qry, **kwargs):
+    def find(qry, snapshot=False, **kwargs):
         """Return a Python object result set for the specified query.
 
         The qry is updated to also contain the container's filter condition.
         ``kwargs`` allows you to pass parameters to sqlbuilder.Select
+        With ``snapshot``, the objects are loaded as read-only snapshots.
 
         Note: The user is responsible of closing the cursor after use.
         """
@@ -93,10 +94,11 @@ class IPJContainer(zope.interface.Interface):
         Note: The user is responsible of closing the cursor after use.
         """
 
-    def find_one(qry=None, id=None):
+    def find_one(qry=None, id=None, snapshot=False):
         """Return a single Python object for the specified query.
 
-        At least one of the arguments must be specified.
+        At least one of the arguments must be specified. With ``snapshot``,
+        the object is loaded as a read-only snapshot.
 
         The qry is updated to also contain the container's filter condition.
 
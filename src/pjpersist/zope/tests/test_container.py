@@ -844,6 +844,25 @@ def doctest_PJContainer_find():
 
       >>> dm.root['people'].find_one(id=stephan._p_oid.id)
       <Person Stephan>
+
+    Objects can be loaded as read-only snapshots. They are not the cached
+    objects and refuse all changes:
+
+      >>> roy = list(dm.root['people'].find(qry, snapshot=True))[0]
+      >>> roy, roy.__name__, roy.__parent__ is dm.root['people']
+      (<Person Roy>, u'roy', True)
+      >>> roy is dm.root['people'][u'roy']
+      False
+      >>> roy.name = u'Roy Jr.'
+      Traceback (most recent call last):
+      ...
+      ReadOnlyError: ('Objects loaded as snapshots cannot be modified',
+                      <Person Roy>)
+
+      >>> dm.root['people'].find_one(qry2, snapshot=True)
+      <Person Stephan>
+      >>> dm.root['people'][u'roy'].name
+      u'Roy'
     """
 
 def doctest_PJ_Container_count():